@@ -0,0 +1,335 @@
+"""Generates synthetic routing tables and rulebases, times each stage of firewall_autozoner.py on them, and writes the
+timings as JSON, failing when a stage got slower than in a previous run or than a fixed limit"""
+import argparse
+import contextlib
+import csv
+import ipaddress
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from firewall_autozoner import (IP_VERSIONS, LOG_FORMAT, Autozoner, HostTable, LinearizedFib, check_protected_string,
+                                compress_fib, fib_total_zones, gather_objects, parallel_linearized_fib, parse_rib,
+                                policy_columns, populate_linearized_fib, reduce_rib, rib_routes, split_linearized_fib,
+                                sweep_linearized_fib, zone_finder, zone_row_options)
+
+
+PROFILES = {
+    'small': {'v4_routes': 20000, 'v6_routes': 5000, 'policies': 5000, 'objects': 5000},
+    'firt': {'v4_routes': 900000, 'v6_routes': 0, 'policies': 20000, 'objects': 20000},
+    'v6': {'v4_routes': 0, 'v6_routes': 200000, 'policies': 20000, 'objects': 20000},
+    'nested': {'v4_routes': 200000, 'v6_routes': 50000, 'policies': 20000, 'objects': 20000, 'nesting': 0.5,
+               'ecmp': 0.1},
+    'rulebase': {'v4_routes': 100000, 'v6_routes': 10000, 'policies': 500000, 'objects': 200000},
+}
+PROFILE_DEFAULTS = {'nesting': 0.1, 'ecmp': 0.02, 'zones': 64, 'members': 4}
+# Prefix length weights, roughly those of the IPv4 and IPv6 full routing tables
+V4_PREFIXLEN_WEIGHTS = {8: 1, 12: 2, 14: 3, 15: 4, 16: 40, 17: 10, 18: 20, 19: 35, 20: 50, 21: 60, 22: 120, 23: 90,
+                        24: 560, 25: 2, 28: 1, 30: 1, 32: 1}
+V6_PREFIXLEN_WEIGHTS = {19: 1, 28: 2, 29: 30, 32: 120, 36: 30, 40: 40, 44: 60, 46: 20, 47: 20, 48: 600, 56: 30, 64: 20,
+                        128: 5}
+STAGES = ['rib_parse', 'rib_reduce', 'flatten', 'compress', 'pack', 'host_table', 'gather', 'resolve', 'output']
+MIN_REGRESSION_SECONDS = 0.05  # Stages faster than this are too noisy to compare
+
+
+def random_network(rng, ver, weights, within=None):
+    """Returns a random network of one IP version with a prefix length drawn from weights, inside within if given, or
+    in the global unicast space otherwise"""
+    bits = IP_VERSIONS[ver][0]
+    if within is not None:
+        plen = min(bits, within.prefixlen + rng.randint(1, 8))
+        base = int(within.network_address)
+        span = within.prefixlen
+    else:
+        plen = rng.choices(list(weights), list(weights.values()))[0]
+        if ver == 4:
+            base = rng.randint(1, 223) << 24
+            span = 8
+        else:
+            base = 0x2000 << 112
+            span = 3
+    return ipaddress.ip_network((base | rng.getrandbits(bits - span), plen), strict=False)
+
+
+def generate_rib(path, v4_routes, v6_routes, nesting, ecmp, zones, seed=0):
+    """Writes a rib csv, without header, with a default route per IP version and the given number of routes, each
+    route being a more specific route of an earlier one with probability nesting, and having a second ECMP zone with
+    probability ecmp"""
+    rng = random.Random(seed)
+    zone_names = [f'ZONE-{x}' for x in range(zones)]
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        for ver, count, weights in ((4, v4_routes, V4_PREFIXLEN_WEIGHTS), (6, v6_routes, V6_PREFIXLEN_WEIGHTS)):
+            writer.writerow([IP_VERSIONS[ver][1], rng.choice(zone_names)])
+            recent = []
+            for _ in range(count):
+                within = rng.choice(recent) if recent and rng.random() < nesting else None
+                net = random_network(rng, ver, weights, within)
+                zone = rng.choice(zone_names)
+                writer.writerow([net, zone])
+                if rng.random() < ecmp:
+                    writer.writerow([net, rng.choice(zone_names)])
+                if net.prefixlen < IP_VERSIONS[ver][0]:
+                    recent = recent[-255:] + [net]
+
+
+def random_object(rng):
+    """Returns a random policy object string: mostly IPv4 hosts and subnets, some wide ranges, IPv6 objects and a few
+    /0"""
+    kind = rng.random()
+    if kind < 0.5:
+        return str(ipaddress.IPv4Address(rng.randint(1 << 24, 224 << 24)))
+    if kind < 0.7:
+        return str(ipaddress.ip_network((rng.randint(1 << 24, 224 << 24), rng.randint(16, 30)), strict=False))
+    if kind < 0.8:
+        start = rng.randint(1 << 24, 223 << 24)
+        return f'{ipaddress.IPv4Address(start)}-{ipaddress.IPv4Address(start + rng.randint(1, 1 << 20))}'
+    if kind < 0.9:
+        return str(ipaddress.ip_network(((0x2000 << 112) | rng.getrandbits(125), rng.choice([48, 56, 64, 128])),
+                                        strict=False))
+    if kind < 0.97:
+        start = (0x2000 << 112) | rng.getrandbits(125)
+        return f'{ipaddress.IPv6Address(start)}-{ipaddress.IPv6Address(start + rng.getrandbits(80))}'
+    return rng.choice(['0.0.0.0/0', '::/0'])
+
+
+def generate_policies(path, policies, objects, members, seed=0):
+    """Writes a policy csv with source and destination columns holding up to members objects each, drawn from a pool
+    of distinct objects in which a few objects are used much more often than the others"""
+    rng = random.Random(seed)
+    pool = [random_object(rng) for _ in range(objects)]
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['name', 'source', 'destination', 'service'])
+        for idx in range(policies):
+            cells = [';'.join(pool[min(int(rng.paretovariate(0.5)) - 1, objects - 1) if rng.random() < 0.5
+                                   else rng.randrange(objects)] for _ in range(rng.randint(1, members)))
+                     for _ in range(2)]
+            writer.writerow([f'rule-{idx}', cells[0], cells[1], 'tcp/443'])
+
+
+def run_stages(ribfile, policyfile, engine='sweep', workers=1, null_route=False, batch=False, jobs=1,
+               host_table=False, reduce=False, memory=0):
+    """Zones a policy file against a rib file through the functions of firewall_autozoner.py, timing each stage, and
+    returns the timings in seconds along with the sizes of the inputs and of the fib, and the fib"""
+    timings = {}
+    routes_reduced = None  # Not counted by the parallel build
+
+    @contextlib.contextmanager
+    def stage(name):
+        logging.info('Running stage %s', name)
+        start = time.perf_counter()
+        yield
+        timings[name] = timings.get(name, 0) + time.perf_counter() - start
+
+    if memory:
+        # The out of core build parses, flattens and packs through files in one go
+        with stage('flatten'):
+            fib = populate_linearized_fib(ribfile, ',', memory=memory)
+    elif workers != 1:
+        # The parallel build parses, flattens and compresses in one go
+        with stage('flatten'):
+            fib = parallel_linearized_fib(ribfile, ',', workers, reduce)
+    else:
+        with stage('rib_parse'):
+            rib_dict_list = parse_rib(ribfile, ',')
+        if reduce:
+            with stage('rib_reduce'):
+                routes_reduced = reduce_rib(rib_dict_list)
+        with stage('flatten'):
+            if engine == 'split':
+                fib_list = split_linearized_fib(rib_dict_list)
+            else:
+                fib_list = {ver: sweep_linearized_fib(rib_routes(rib_dict_list, ver)) for ver in IP_VERSIONS}
+        with stage('compress'):
+            fib_list = {ver: compress_fib(fib_list[ver]) for ver in IP_VERSIONS}
+        with stage('pack'):
+            fib = LinearizedFib.from_points(fib_list)
+    if host_table:
+        with stage('host_table'):
+            fib.host_table = HostTable.from_fib(fib)
+    autozoner = Autozoner(fib, null_route, batch, jobs)
+    options = {'source': True}
+    with stage('gather'):
+        with open(policyfile, 'r', encoding='utf-8') as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            check_protected_string(header, 0)
+            src_index, dest_index, _ = policy_columns(header, zone_row_options(options))
+            objects_list, policy_count = gather_objects(reader, src_index, dest_index, ';', progress=False)
+    with stage('resolve'):
+        autozoner.resolve_all(objects_list)
+    with stage('output'):
+        with open(policyfile, 'r', encoding='utf-8') as f, open(os.devnull, 'w', newline='', encoding='utf-8') as o:
+            csv.writer(o).writerows(autozoner.zone_rows(csv.reader(f), options))
+    sizes = {'policies': policy_count, 'objects': len(objects_list), 'routes_reduced': routes_reduced,
+             'boundaries': {ver: len(fib.set_ids[ver]) for ver in IP_VERSIONS}, 'zone_sets': len(fib.zone_sets)}
+    return timings, sizes, fib
+
+
+def time_host_lookups(fib, count, seed=0):
+    """Looks count random IPv4 hosts up with zone_finder, binary searching the fib and then reading its HostTable,
+    and returns the lookups per second of each"""
+    rng = random.Random(seed)
+    hosts = [ipaddress.ip_network(rng.randint(1 << 24, 224 << 24)) for _ in range(count)]
+    total_zones = fib_total_zones(fib, True)[0]
+    host_table = fib.host_table or HostTable.from_fib(fib)
+    rates = {}
+    for name, table in (('bisect', None), ('host_table', host_table)):
+        fib.host_table = table
+        start = time.perf_counter()
+        for host in hosts:
+            zone_finder(host, fib, total_zones, True)
+        rates[name] = round(count / (time.perf_counter() - start))
+    return rates
+
+
+def check_regressions(timings, baseline, tolerance, thresholds):
+    """Returns a message for each stage slower than in the baseline timings by more than tolerance, a fraction, or
+    slower than its limit in thresholds"""
+    failures = []
+    for name, seconds in timings.items():
+        previous = baseline.get(name)
+        if previous is not None and seconds > MIN_REGRESSION_SECONDS and seconds > previous * (1 + tolerance):
+            failures.append(f'Stage {name} took {seconds:.3f}s, {seconds / previous - 1:.0%} more than the '
+                            f'{previous:.3f}s of the baseline')
+        if name in thresholds and seconds > thresholds[name]:
+            failures.append(f'Stage {name} took {seconds:.3f}s, more than its limit of {thresholds[name]:.3f}s')
+    return failures
+
+
+def parse_threshold(value):
+    """Parses a STAGE=SECONDS command line argument"""
+    name, _, seconds = value.partition('=')
+    if name not in STAGES + ['total']:
+        raise argparse.ArgumentTypeError(f'Unknown stage {name}, expected one of {", ".join(STAGES + ["total"])}')
+    try:
+        return name, float(seconds)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Invalid number of seconds in {value}')
+
+
+def parse_repeat(value):
+    """Parses the number of runs, at least one so that there are timings to report"""
+    try:
+        repeat = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Invalid number of runs {value}')
+    if repeat < 1:
+        raise argparse.ArgumentTypeError(f'The number of runs must be at least 1, not {repeat}')
+    return repeat
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Times each stage of firewall_autozoner.py on generated or given '
+                                                 'inputs and writes the results as JSON')
+    parser.add_argument('-P', '--profile', type=str, choices=list(PROFILES), default='small',
+                        help='Size and shape of the generated rib and rulebase: ' + '; '.join(
+                            f'{name}: {profile["v4_routes"]} IPv4 and {profile["v6_routes"]} IPv6 routes, '
+                            f'{profile["policies"]} policies' for name, profile in PROFILES.items()) +
+                        '. Default: small')
+    parser.add_argument('--rib', type=str, default=None, help='Time this rib csv instead of a generated one. Default: '
+                                                              'None')
+    parser.add_argument('--policies', type=str, default=None,
+                        help='Time this policy csv, with "source" and "destination" columns, instead of a generated '
+                             'one. Default: None')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the generated inputs. Default: 0')
+    parser.add_argument('--keep', type=str, default=None,
+                        help='Directory where the generated inputs are written and kept, to be reused by the next '
+                             'runs with the same profile and seed. Default: a temporary directory')
+    parser.add_argument('-e', '--fib-engine', type=str, choices=['sweep', 'split'], default='sweep',
+                        help='Engine flattening the routes. Default: sweep')
+    parser.add_argument('--fib-workers', type=int, default=1,
+                        help='Processes flattening the routes, timed as a single flatten stage. Default: 1')
+    parser.add_argument('--fib-memory-mb', type=int, default=0,
+                        help='Build the fib out of core in about this many megabytes, timed as a single flatten '
+                             'stage. Default: 0, in memory')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Processes resolving the objects and zoning the policies. Default: 1')
+    parser.add_argument('--batch-resolve', action='store_true', default=False,
+                        help='Resolve the objects in batch. Default: False')
+    parser.add_argument('--reduce-rib', action='store_true', default=False,
+                        help='Reduce the routes before flattening them, timed as the rib_reduce stage. Default: False')
+    parser.add_argument('--host-table', action='store_true', default=False,
+                        help='Build the IPv4 host table of the fib, timed as the host_table stage, and resolve the '
+                             'objects with it. Default: False')
+    parser.add_argument('--host-lookups', type=int, default=0,
+                        help='Also time this many lookups of random IPv4 hosts, with and without the host table, and '
+                             'report the lookups per second of each. Default: 0')
+    parser.add_argument('--repeat', type=parse_repeat, default=1,
+                        help='Run the stages this many times and keep the fastest time of each. Default: 1')
+    parser.add_argument('-o', '--output-file', type=str, default=None,
+                        help='JSON file to write the results to. Default: standard output')
+    parser.add_argument('-b', '--baseline', type=str, default=None,
+                        help='JSON results of a previous run, with the same profile, to compare the stage timings '
+                             'with. Default: None')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.5,
+                        help='Fraction by which a stage can be slower than in the baseline before it counts as a '
+                             'regression. Default: 0.5')
+    parser.add_argument('--threshold', type=parse_threshold, action='append', default=[], metavar='STAGE=SECONDS',
+                        help='Fail if a stage, or the "total", takes longer than this. Can be repeated. Default: '
+                             'None')
+    parser.add_argument('-x', '--debug-level', type=str, choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+                        default='ERROR', help='Logging message verbosity. The stages log their progress as '
+                                              'warnings. Default: ERROR')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.debug_level, format=LOG_FORMAT)
+    profile = dict(PROFILE_DEFAULTS, **PROFILES[args.profile])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = args.keep or tmp_dir
+        os.makedirs(work_dir, exist_ok=True)
+        ribfile = args.rib
+        if not ribfile:
+            ribfile = os.path.join(work_dir, f'rib-{args.profile}-{args.seed}.csv')
+        if not os.path.exists(ribfile):
+            print(f'Generating rib {ribfile}', file=sys.stderr)
+            generate_rib(ribfile, profile['v4_routes'], profile['v6_routes'], profile['nesting'], profile['ecmp'],
+                         profile['zones'], args.seed)
+        policyfile = args.policies
+        if not policyfile:
+            policyfile = os.path.join(work_dir, f'policies-{args.profile}-{args.seed}.csv')
+        if not os.path.exists(policyfile):
+            print(f'Generating rulebase {policyfile}', file=sys.stderr)
+            generate_policies(policyfile, profile['policies'], profile['objects'], profile['members'], args.seed)
+        best = {}
+        host_lookups = {}
+        for run in range(args.repeat):
+            print(f'Run {run + 1} of {args.repeat}', file=sys.stderr)
+            timings, sizes, fib = run_stages(ribfile, policyfile, args.fib_engine, args.fib_workers,
+                                             batch=args.batch_resolve, jobs=args.jobs, host_table=args.host_table,
+                                             reduce=args.reduce_rib, memory=args.fib_memory_mb * 2 ** 20)
+            timings['total'] = sum(timings.values())
+            best = {x: min(y, best.get(x, y)) for x, y in timings.items()}
+            if args.host_lookups:
+                rates = time_host_lookups(fib, args.host_lookups, args.seed)
+                host_lookups = {x: max(y, host_lookups.get(x, y)) for x, y in rates.items()}
+    results = {'profile': args.profile if not (args.rib or args.policies) else 'custom', 'seed': args.seed,
+               'rib': args.rib, 'policies': args.policies, 'engine': args.fib_engine, 'fib_workers': args.fib_workers,
+               'fib_memory_mb': args.fib_memory_mb, 'jobs': args.jobs, 'batch_resolve': args.batch_resolve,
+               'host_table': args.host_table, 'reduce_rib': args.reduce_rib, 'repeat': args.repeat,
+               'python': platform.python_version(), 'platform': platform.platform(),
+               'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'sizes': sizes,
+               'stages': {x: round(y, 4) for x, y in best.items()}}
+    if args.host_lookups:
+        results['host_lookups'] = dict(host_lookups, count=args.host_lookups)
+    output = json.dumps(results, indent=2)
+    if args.output_file:
+        with open(args.output_file, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    baseline = {'profile': results['profile'], 'stages': {}}
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    if baseline.get('profile') != results['profile']:
+        logging.critical('Baseline profile %s differs from %s. Exiting...', baseline.get('profile'), results['profile'])
+        sys.exit(1)
+    failures = check_regressions(results['stages'], baseline['stages'], args.tolerance, dict(args.threshold))
+    for failure in failures:
+        logging.critical('%s', failure)
+    sys.exit(1 if failures else 0)
@@ -6,56 +6,350 @@ import argparse
 import logging
 import ipaddress
 import re
-import pickle
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import array
+import gzip
+import hashlib
+import heapq
+import http.server
+import io
+import json
+import mmap
+import os
+import shutil
+import socket
+import socketserver
+import stat
+import struct
+import tempfile
+import threading
+import time
+from multiprocessing import shared_memory
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 MAX_WAIT_SECONDS = 3600
+LOG_FORMAT = '%(asctime)s [%(levelname)s] %(message)s'
 IP_VERSIONS = {4: (32, '0.0.0.0/0'), 6: (128, '::/0')}
-FIB_DISK_CACHE = 'pickle_fib.pkl'
+IP_ADDRESS_CLASSES = {4: ipaddress.IPv4Address, 6: ipaddress.IPv6Address}
+MASK_64 = 2 ** 64 - 1
+BATCH_WIDE_SLICE = 4096  # Objects spanning more fib boundaries than this are reduced one by one in batch mode
+FIB_CACHE_DIR = '.autozoner_cache'
+FIB_CACHE_MAX_ENTRIES = 8
+FIB_BUILDER_VERSION = 1  # Bump when the flattening changes, so that fibs cached by older versions are not reused
+FIB_MAGIC = b'AZFIB\x00\x00\x00'
+FIB_FORMAT_VERSION = 1
+FIB_BYTE_ORDER_MARK = 0x01020304
+FIB_HEADER = struct.Struct('=8sIIQ')  # Magic, format version, byte order mark, metadata length
+FIB_ENGINES = ['sweep', 'split', 'compare']
+HOST_TABLE_MAGIC = b'AZHOST\x00\x00'
+HOST_TABLE_FORMAT_VERSION = 1
+HOST_TABLE_HEADER = struct.Struct('=8sIIQ')  # Magic, format version, byte order mark, number of overflow blocks
+HOST_TABLE_BLOCK_BITS = 8  # Address bits indexing the overflow blocks, the other 24 index the first stage
+HOST_TABLE_OVERFLOW = 0x80000000  # Flags the first stage entries holding an overflow block index
+FIB_PARTITION_PREFIXLEN = {4: 8, 6: 16}  # Size of the address space partitions flattened in parallel
+# Route records of the out of core build: high and low address words, prefix length and zone ID, big endian so that
+# the records sort as the routes do
+FIB_RUN_RECORD = struct.Struct('>QQBI')
+FIB_RUN_CHUNK_RECORDS = 4096  # Most records read from each sorted run, and boundaries written, at a time
+FIB_MERGE_FAN_IN = 64  # Most sorted runs merged at once, more are merged in several passes
+OBJECT_CACHE_FORMAT_VERSION = 2
+POLICY_INDEX_FORMAT_VERSION = 3
+QUERY_MATCHES = ['overlap', 'cover', 'within']
+POLICY_CHUNK_ROWS = 1000  # Policies zoned by each task with --jobs
+PROGRESS_INTERVAL_SECONDS = 10  # Minimum time between two progress messages of the same loop
+RIB_DELTA_ACTIONS = ['add', 'withdraw', 'replace']
+ZONE_ROW_DEFAULTS = {'source': False, 'source_column': 'source', 'destination_column': 'destination',
+                     'address_separator': ';', 'all_zones': False, 'zone_limit': 0, 'split_behavior': False}
+SERVE_ADDRESS_REGEX = re.compile(r'^[^/]*:[0-9]+$')
+# Options a job of a --manifest can set, the others being those of the command line
+MANIFEST_JOB_KEYS = ['rib', 'rib_delta', 'input', 'output_file', 'csv_separator', 'null_route'] + \
+    list(ZONE_ROW_DEFAULTS)
+MANIFEST_SUMMARY_FIELDS = ['job', 'rib', 'input', 'output_file', 'status', 'policies', 'objects', 'output_rows', 'fib',
+                           'seconds', 'error']
 IP_SANITY_REGEX = re.compile(r'^[0-9a-fA-F:./-]+$')
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
 
 
-def populate_linearized_fib(ribfile, sep):
-    """Takes a csv file as in '192.0.2.0/24, IFACE_OR_ZONE' and returns a list of addresses in decimal form
-    corresponding to the point in the address space where the forwarding decision changes, e.g.
-    [ [ 0, 'ethernet1/1' ] , [ 3221225983, 'ethernet1/1' ], [ 3221225984, 'ethernet1/2' ] ,
-    [ 3221226239, 'ethernet1/2' ] , [ 3221226240 , 'ethernet1/1' ], [ 4294967295 , 'ethernet1/1' ] ]
-    For a routing table with routes: 0.0.0.0/0 ethernet1/1; 192.0.2.0/24 ethernet1/2
-    The interesting points are 0.0.0.0, 192.0.1.255, 192.0.2.0, 192.0.2.255, 192.0.3.0, and 255.255.255.255"""
-    rib_dict_list = {ver: [{} for x in range(0, bits[0] + 1)] for ver, bits in IP_VERSIONS.items()}
-    fib_list = {ver: [] for ver in IP_VERSIONS}
-    with open(ribfile, 'r', encoding='utf-8') as a:
-        reader = list(csv.reader(a, delimiter=sep))
-    try:
-        logging.debug('Checking if rib file has a header')
-        ipaddress.ip_network(reader[0][0], strict=False)
-        if '.' in reader[0][0] or ':' in reader[0][0]:
-            start = 0
-        else:
-            logging.info('Found header in rib file')
-            start = 1
-    except ipaddress.AddressValueError:
-        logging.info('Found header in rib file')
-        start = 1
-    for idx, line in enumerate(reader[start:], start=1):
-        if not line[1]:
-            logging.error('route %s has no interface, skipping', line)
-            continue
-        item = ipaddress.ip_network(line[0], strict=False)
-        ipver = item.version
-        logging.debug('Analyzing line %s of rib file', line)
+class PolicyError(Exception):
+    """Raised for policies which cannot be zoned, with a message saying where and why"""
+
+
+class Progress:
+    """Progress messages of a long loop, logged with the arguments of update at most once every interval seconds
+    instead of every N items, so that update can be called on every item of a fast or a slow loop alike"""
+
+    def __init__(self, message, enabled=True, interval=PROGRESS_INTERVAL_SECONDS):
+        self.message = message
+        self.interval = interval
+        self.due = time.monotonic() + interval if enabled else float('inf')
+
+    def update(self, *args):
+        now = time.monotonic()
+        if now >= self.due:
+            logging.warning(self.message, *args)
+            self.due = now + self.interval
+
+
+class Metrics:
+    """Wall time, CPU time, including that of the worker processes which exited, and peak memory of each stage of a
+    run, along with counters of the work done, written as JSON by --metrics-file. Counters are added to outside of
+    the inner loops, and worker processes report theirs through the results of their tasks"""
+
+    def __init__(self):
+        self.started = self.clock()
+        self.stages = {}
+        self.counters = collections.Counter()
+
+    @staticmethod
+    def clock():
+        """Returns the wall time, the CPU time of this process and of its children which exited, and the peak
+        resident memory in bytes of this process or of any of those children, None without the resource module"""
+        cpu = time.process_time()
+        peak_rss = None
+        if resource is not None:
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            cpu += children.ru_utime + children.ru_stime
+            # Kilobytes on Linux, bytes on macOS
+            unit = 1 if sys.platform == 'darwin' else 1024
+            peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, children.ru_maxrss) * unit
+        return time.perf_counter(), cpu, peak_rss
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Adds the time spent in the with block to the stage, which may be entered more than once"""
+        wall, cpu, _ = self.clock()
         try:
-            rib_dict_list[ipver][item.prefixlen][item].add(line[1])
-            logging.debug('ECMP/Duplicate route found: %s', line[0])
-        except KeyError:
-            rib_dict_list[ipver][item.prefixlen][item] = {line[1]}
-        logging.debug('Added to rib: %s', item)
-        if idx % 10000 == 0:
-            logging.warning('Added %d routes to RIB', idx)
+            yield
+        finally:
+            end_wall, end_cpu, peak_rss = self.clock()
+            stage = self.stages.setdefault(name, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+            stage['calls'] += 1
+            stage['wall_seconds'] += end_wall - wall
+            stage['cpu_seconds'] += end_cpu - cpu
+            stage['peak_rss_bytes'] = peak_rss
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def report(self):
+        """Returns the stages, the counters and the totals since the metrics were created"""
+        wall, cpu, peak_rss = self.clock()
+        return {'stages': {name: {x: round(y, 4) if isinstance(y, float) else y for x, y in stage.items()}
+                           for name, stage in self.stages.items()},
+                'counters': dict(sorted(self.counters.items())),
+                'total': {'wall_seconds': round(wall - self.started[0], 4),
+                          'cpu_seconds': round(cpu - self.started[1], 4), 'peak_rss_bytes': peak_rss}}
+
+    def to_file(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, indent=2)
+            f.write('\n')
+
+
+metrics = Metrics()
+
+
+def open_text(path):
+    """Opens a file for reading as text, decompressing it on the fly if it starts with the gzip or zstd magic
+    number, so that route dumps can be read without unpacking them first"""
+    with open(path, 'rb') as f:
+        magic = f.read(len(ZSTD_MAGIC))
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+    if magic == ZSTD_MAGIC:
+        if zstandard is None:
+            logging.critical('File %s is zstd compressed, which requires the zstandard package: pip install '
+                             'zstandard. Exiting...', path)
+            sys.exit(1)
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True, closefd=True)
+        return io.TextIOWrapper(reader, encoding='utf-8', newline='')
+    return open(path, 'r', encoding='utf-8', newline='')
+
+
+def parse_prefix(prefix):
+    """Returns the IP version, the network address as an integer and the prefix length of a network or host
+    address string, with the host bits cleared as ipaddress.ip_network(prefix, strict=False) would. The address is
+    converted by inet_pton rather than ipaddress, and the forms inet_pton does not take, such as a netmask instead of
+    a prefix length, go through ipaddress. Raises ValueError for invalid prefixes"""
+    addr, slash, plen = prefix.partition('/')
+    ver, family = (6, socket.AF_INET6) if ':' in addr else (4, socket.AF_INET)
+    bits = IP_VERSIONS[ver][0]
+    try:
+        net = int.from_bytes(socket.inet_pton(family, addr), 'big')
+    except (OSError, ValueError):
+        net = None
+    if not slash:
+        plen = bits
+    elif plen.isascii() and plen.isdigit() and int(plen) <= bits:
+        plen = int(plen)
+    else:
+        net = None
+    if net is None:
+        item = ipaddress.ip_network(prefix, strict=False)
+        return item.version, int(item.network_address), item.prefixlen
+    return ver, net >> (bits - plen) << (bits - plen), plen
+
+
+def parse_address(address):
+    """Returns the IP version and the integer of an address string, converted by inet_pton with ipaddress for the
+    forms it does not take, as parse_prefix does. Raises ValueError for invalid addresses"""
+    ver, family = (6, socket.AF_INET6) if ':' in address else (4, socket.AF_INET)
+    try:
+        return ver, int.from_bytes(socket.inet_pton(family, address), 'big')
+    except (OSError, ValueError):
+        item = ipaddress.ip_address(address)
+        return item.version, int(item)
+
+
+def parse_object(member):
+    """Returns the IP version and the first and last address, as integers, of an address string as found in the
+    policies: a host or a network as parse_prefix takes it, or a range of two addresses separated by "-". Raises
+    ValueError for invalid addresses, and for ranges mixing IP versions or ending before they start"""
+    first, dash, last = member.partition('-')
+    if not dash:
+        ver, net, plen = parse_prefix(member)
+        return ver, net, net | ((1 << (IP_VERSIONS[ver][0] - plen)) - 1)
+    first_version, first_address = parse_address(first)
+    last_version, last_address = parse_address(last)
+    if first_version != last_version or first_address > last_address:
+        raise ValueError(f'Invalid range {member}')
+    return first_version, first_address, last_address
+
+
+def read_rib_rows(ribfile, sep):
+    """Reads a csv file as in '192.0.2.0/24, IFACE_OR_ZONE', compressed or not, and yields its rows one at a time,
+    without the header if it has one. Rows without an interface or zone are logged and skipped"""
+    with open_text(ribfile) as a:
+        for idx, line in enumerate(csv.reader(a, delimiter=sep), start=1):
+            if idx == 1:
+                # The first row is only a route if it holds an address, so that a numeric header is not taken for one
+                cell = line[0] if line else ''
+                try:
+                    parse_prefix(cell)
+                    header = '.' not in cell and ':' not in cell
+                except ValueError:
+                    header = True
+                if header:
+                    logging.info('Found header in rib file')
+                    continue
+            if len(line) < 2 or not line[1]:
+                logging.error('route %s has no interface, skipping', line)
+                continue
+            yield line
+
+
+def parse_rib(ribfile, sep):
+    """Reads a csv file as in '192.0.2.0/24, IFACE_OR_ZONE' and returns one list of dictionaries per IP version,
+    indexed by prefix length, mapping the network address of each route, as an integer, to the set of interfaces or
+    zones it is routed to. A default route pointing to ####NULL_ROUTED#### is added for IP versions which lack one"""
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    progress = Progress('Added %d routes to RIB')
+    rib_dict_list = {ver: [{} for x in range(0, bits[0] + 1)] for ver, bits in IP_VERSIONS.items()}
+    idx = 0
+    ecmp = 0
+    with metrics.stage('rib_parse'):
+        for idx, line in enumerate(read_rib_rows(ribfile, sep), start=1):
+            ipver, net, plen = parse_prefix(line[0])
+            if debug:
+                logging.debug('Analyzing line %s of rib file', line)
+            level = rib_dict_list[ipver][plen]
+            if net in level:
+                level[net].add(line[1])
+                ecmp += 1
+                if debug:
+                    logging.debug('ECMP/Duplicate route found: %s', line[0])
+            else:
+                level[net] = {line[1]}
+            progress.update(idx)
+    metrics.count('routes', idx)
+    metrics.count('ecmp_routes', ecmp)
     # Add a default if not present
-    for ver, bits in IP_VERSIONS.items():
+    for ver in IP_VERSIONS:
         if not rib_dict_list[ver][0]:
-            rib_dict_list[ver][0][ipaddress.ip_network(bits[1])] = {'####NULL_ROUTED####'}
+            rib_dict_list[ver][0][0] = {'####NULL_ROUTED####'}
+    return rib_dict_list
+
+
+def rib_routes(rib_dict_list, ver):
+    """Returns the routes of one IP version of a parsed rib as (start, end, prefixlen, zones) tuples with integer
+    addresses, as sweep_linearized_fib takes them"""
+    bits = IP_VERSIONS[ver][0]
+    return [(net, net | ((1 << (bits - plen)) - 1), plen, list(zones))
+            for plen, level in enumerate(rib_dict_list[ver]) for net, zones in level.items()]
+
+
+def reduce_rib(rib_dict_list):
+    """Removes from a parsed rib, in place, the routes the flattening would only merge back into others, and returns
+    how many routes were removed. Two sibling routes with the same zones are replaced by their parent route, from the
+    longest prefixes up so that the parents can in turn be merged, then each route with the same zones as the longest
+    route covering it is removed. No address changes zones, so the fib built from the reduced rib is the same"""
+    removed = 0
+    with metrics.stage('rib_reduce'):
+        for ver, bits in IP_VERSIONS.items():
+            removed += _reduce_levels(rib_dict_list[ver], bits[0])
+    logging.info('Removed %d routes from the rib before flattening', removed)
+    metrics.count('routes_reduced', removed)
+    return removed
+
+
+def _reduce_levels(levels, bits):
+    """Reduces the routes of one IP version, as {network address: zones} dictionaries indexed by prefix length, as
+    reduce_rib does, and returns how many routes were removed"""
+    removed = 0
+    for plen in range(bits, 0, -1):
+        level = levels[plen]
+        half = 1 << (bits - plen)
+        for net in [x for x in level if not x & half and x | half in level]:
+            zones = level[net]
+            if level[net | half] == zones:
+                # The parent, if any, is entirely covered by the siblings so its own zones are never used
+                removed += 2 if net in levels[plen - 1] else 1
+                del level[net], level[net | half]
+                levels[plen - 1][net] = zones
+    # Sorted by address then prefix length, the routes enclosing each route are on the stack, the longest on top
+    masks = [(1 << (bits - x)) - 1 for x in range(bits + 1)]
+    ends = [1 << bits]
+    stack_zones = [None]
+    for key in sorted([net << 8 | plen for plen, level in enumerate(levels) for net in level]):
+        net = key >> 8
+        while ends[-1] < net:
+            ends.pop()
+            stack_zones.pop()
+        level = levels[key & 0xff]
+        zones = level[net]
+        if stack_zones[-1] == zones:
+            del level[net]
+            removed += 1
+        else:
+            ends.append(net | masks[key & 0xff])
+            stack_zones.append(zones)
+    return removed
+
+
+def split_linearized_fib(rib_dict_list):
+    """Original engine. Fragments every covering route around the more specific routes it contains, level by level,
+    until the routes describe the entire forwarding space with no overlaps, then returns the uncompressed address
+    line. The routes of rib_dict_list are converted to ip_network objects first"""
+    fib_list = {ver: [] for ver in IP_VERSIONS}
+    network_class = {4: ipaddress.IPv4Network, 6: ipaddress.IPv6Network}
+    rib_dict_list = {ver: [{network_class[ver]((net, plen)): zones for net, zones in level.items()}
+                           for plen, level in enumerate(rib_dict_list[ver])] for ver in IP_VERSIONS}
     """
     rib_dict_list[v4]:
     level 25: { 192.0.2.0/25: eth1 }
@@ -76,12 +370,17 @@ def populate_linearized_fib(ribfile, sep):
     10. once all levels are coalesced the result describes the entire forwarding space with no overlapping routes
     11. this can be turned into a list of integers identifying the start and end of each route
     """
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    progress = Progress('Sliced %d of %d IPv%d routes in plen level %d')
+    routes_split = 0
+    fragments = 0
     for ver, bits in IP_VERSIONS.items():
         supernet_cache = {}
         for plen in range(bits[0], 0, -1):  # 32 to 1
             logging.info('Analyzing prefix length %d of v%drib', plen, ver)
             for idx, route in enumerate(rib_dict_list[ver][plen], start=1):
-                logging.debug('Checking route %s in lower levels', route)
+                if debug:
+                    logging.debug('Checking route %s in lower levels', route)
                 iter_supernet_cache = supernet_cache.copy()
                 for old_plen, old_supernet in iter_supernet_cache.items():
                     if not route.overlaps(old_supernet):
@@ -89,8 +388,9 @@ def populate_linearized_fib(ribfile, sep):
                 for lvl_cursor in range(plen - 1, -1, -1):  # x-1 to 0
                     done = False
                     if route in rib_dict_list[ver][lvl_cursor]:
-                        logging.debug('Route %s in level %d is already present in lower level, no need to split', route,
-                                      plen)
+                        if debug:
+                            logging.debug('Route %s in level %d is already present in lower level, no need to split',
+                                          route, plen)
                         break  # Route comes from a previous split operation
                     for decreasing_plen in range(route.prefixlen - 1, lvl_cursor - 1, -1):  # x-1 to smallest plen in
                         # the level
@@ -100,21 +400,26 @@ def populate_linearized_fib(ribfile, sep):
                             supernet = route.supernet(new_prefix=decreasing_plen)
                             supernet_cache[decreasing_plen] = supernet
                         if supernet in rib_dict_list[ver][lvl_cursor]:
-                            logging.debug('Supernet %s of route %s found in level %d', supernet, route, lvl_cursor)
+                            if debug:
+                                logging.debug('Supernet %s of route %s found in level %d', supernet, route, lvl_cursor)
                             # Fragment the supernet, inherit its interface for fragments and then discard the supernet
                             for subnet in supernet.address_exclude(route):
                                 if subnet != route:  # Remove original route from fragments
-                                    logging.debug('Adding fragment %s of supernet to level %d', subnet, lvl_cursor)
+                                    if debug:
+                                        logging.debug('Adding fragment %s of supernet to level %d', subnet, lvl_cursor)
                                     rib_dict_list[ver][lvl_cursor][subnet] = rib_dict_list[ver][lvl_cursor][supernet]
-                            logging.debug('Removing supernet %s from level %d', supernet, lvl_cursor)
+                                    fragments += 1
+                            if debug:
+                                logging.debug('Removing supernet %s from level %d', supernet, lvl_cursor)
                             del rib_dict_list[ver][lvl_cursor][supernet]
+                            routes_split += 1
                             done = True
                             break
                     if done:
                         break
-                if idx % 10000 == 0:
-                    logging.warning('Sliced %d of %d IPv%d routes in plen level %d', idx, len(rib_dict_list[ver][plen]),
-                                    ver, plen)
+                progress.update(idx, len(rib_dict_list[ver][plen]), ver, plen)
+    metrics.count('routes_split', routes_split)
+    metrics.count('fragments', fragments)
     # Add all levels to one big dictionary preferring the higher prefix length entries
     logging.info('Done splitting routes')
     logging.info('Coalescing and sorting levels')
@@ -132,89 +437,2627 @@ def populate_linearized_fib(ribfile, sep):
         rib_list[ver].sort(key=lambda x: x[0].network_address, reverse=False)
         for r in rib_list[ver]:
             fib_list[ver].append([int(r[0][0]), r[1]])
-            logging.debug('Added start of route to the address line: %s', fib_list[ver][-1])
+            if debug:
+                logging.debug('Added start of route to the address line: %s', fib_list[ver][-1])
             if r[0][-1] != r[0][0]:
                 fib_list[ver].append([int(r[0][-1]), r[1]])
-                logging.debug('Added end of route to the address line: %s', fib_list[ver][-1])
-            else:
+                if debug:
+                    logging.debug('Added end of route to the address line: %s', fib_list[ver][-1])
+            elif debug:
                 logging.debug('Single IP route, not adding end to address line')
-    fib_list_compressed = {ver: [] for ver in IP_VERSIONS}
+    return fib_list
+
+
+def sweep_runs(routes, lo=0, hi=None, presorted=False):
+    """Takes (start, end, prefixlen, zones) tuples with integer addresses for one IP version and yields the
+    (first, last, zones) stretches of addresses between lo and hi forwarded by the longest matching route, in
+    O(n log n). Routes are ordered on the number line with covering routes first, and a stack of the routes enclosing
+    the cursor decides which zones apply to each stretch between two route boundaries. Between lo and hi the routes
+    must leave no address uncovered, which a default route or a route covering the whole interval guarantees. With
+    presorted the routes are taken in the order they come, which must be that one, so that they can be streamed"""
+    stack = []
+    cursor = lo
+    for start, end, _, zones in routes if presorted else sorted(routes, key=lambda x: (x[0], x[2])):
+        while stack and stack[-1][0] < start:
+            # Close the enclosing routes which end before this one starts
+            top_end, top_zones = stack.pop()
+            if cursor <= top_end:
+                yield cursor, top_end, top_zones
+                cursor = top_end + 1
+        if cursor < start:
+            # Gap between the last boundary and this route belongs to the innermost enclosing route
+            yield cursor, start - 1, stack[-1][1]
+            cursor = start
+        stack.append((end, zones))
+    while stack:
+        top_end, top_zones = stack.pop()
+        if hi is not None:
+            top_end = min(top_end, hi)
+        if cursor <= top_end:
+            yield cursor, top_end, top_zones
+            cursor = top_end + 1
+
+
+def sweep_linearized_fib(routes):
+    """Sweep-line engine. Takes (start, end, prefixlen, zones) tuples with integer addresses for one IP version, which
+    must include a default route, and returns the same uncompressed address line as the original engine"""
+    fib_list = []
+    for first, last, zones in sweep_runs(routes):
+        fib_list.append([first, zones])
+        if last != first:
+            fib_list.append([last, zones])
+    return fib_list
+
+
+def compress_fib(fib_list):
+    """Merges adjacent routes with the same interface on the address line of one IP version"""
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    fib_list_compressed = []
     # Max 2 identical consecutive zones for efficiency
     # [ a_str, a_end, b_srt, b_end, b_srt, b_end, a_str, a_end ] -> [ a_str, a_end, b_srt, b_end, a_str, a_end ]
-    logging.info('Compressing adjacent routes with the same interface on the fib')
-    for ver in IP_VERSIONS:
-        prev = [None, None]
-        for idx, point in enumerate(fib_list[ver]):
-            if point[1] != prev:
+    prev = [None, None]
+    for idx, point in enumerate(fib_list):
+        if point[1] != prev:
+            if debug:
                 logging.debug('Interface change from %s to %s at address %s, marking it', prev, point[1], point[0])
-                if idx > 1 and fib_list_compressed[ver][-1] != fib_list[ver][idx - 1]:  # Don't add host routes twice
-                    fib_list_compressed[ver].append(fib_list[ver][idx - 1])
-                fib_list_compressed[ver].append(point)
-                prev = point[1]
-        # Cap off the list if not
-        if fib_list_compressed[ver][-1] != fib_list[ver][-1]:
-            fib_list_compressed[ver].append(fib_list[ver][-1])
+            if idx > 1 and fib_list_compressed[-1] != fib_list[idx - 1]:  # Don't add host routes twice
+                fib_list_compressed.append(fib_list[idx - 1])
+            fib_list_compressed.append(point)
+            prev = point[1]
+    # Cap off the list if not
+    if fib_list_compressed[-1] != fib_list[-1]:
+        fib_list_compressed.append(fib_list[-1])
+    return fib_list_compressed
+
+
+def flatten_rib(ribfile, sep, engine='sweep', reduce=False):
+    """Takes a csv file as in '192.0.2.0/24, IFACE_OR_ZONE' and returns a list of addresses in decimal form
+    corresponding to the point in the address space where the forwarding decision changes, e.g.
+    [ [ 0, 'ethernet1/1' ] , [ 3221225983, 'ethernet1/1' ], [ 3221225984, 'ethernet1/2' ] ,
+    [ 3221226239, 'ethernet1/2' ] , [ 3221226240 , 'ethernet1/1' ], [ 4294967295 , 'ethernet1/1' ] ]
+    For a routing table with routes: 0.0.0.0/0 ethernet1/1; 192.0.2.0/24 ethernet1/2
+    The interesting points are 0.0.0.0, 192.0.1.255, 192.0.2.0, 192.0.2.255, 192.0.3.0, and 255.255.255.255
+    The engine is one of FIB_ENGINES: 'sweep' flattens the routes in a single pass, 'split' uses the original
+    level-by-level fragmentation and 'compare' runs both, exiting if their results differ. With reduce the routes
+    are reduced with reduce_rib before being flattened"""
+    if engine == 'compare':
+        fib_sweep = flatten_rib(ribfile, sep, 'sweep', reduce)
+        fib_split = flatten_rib(ribfile, sep, 'split', reduce)
+        for ver in IP_VERSIONS:
+            if fib_sweep[ver] != fib_split[ver]:
+                logging.critical('The sweep and split engines produced different IPv%d fibs. Exiting...', ver)
+                sys.exit(1)
+        logging.warning('The sweep and split engines produced identical fibs')
+        return fib_sweep
+    rib_dict_list = parse_rib(ribfile, sep)
+    if reduce:
+        reduce_rib(rib_dict_list)
+    with metrics.stage('flatten'):
+        if engine == 'split':
+            fib_list = split_linearized_fib(rib_dict_list)
+        else:
+            logging.info('Flattening routes')
+            fib_list = {ver: sweep_linearized_fib(rib_routes(rib_dict_list, ver)) for ver in IP_VERSIONS}
+            logging.info('Done flattening routes')
+    logging.info('Compressing adjacent routes with the same interface on the fib')
+    with metrics.stage('compress'):
+        fib_list_compressed = {ver: compress_fib(fib_list[ver]) for ver in IP_VERSIONS}
     logging.info('Done compressing fib')
     return fib_list_compressed
 
 
+class WideBoundaries:
+    """Read-only sequence of 128 bit boundaries stored as two parallel arrays of 64 bit words, which is what bisect
+    needs to search IPv6 boundaries without keeping a Python int for each of them"""
+
+    def __init__(self, hi, lo):
+        self.hi = hi
+        self.lo = lo
+
+    def __len__(self):
+        return len(self.lo)
+
+    def __getitem__(self, idx):
+        return (self.hi[idx] << 64) | self.lo[idx]
+
+    def __iter__(self):
+        return ((hi << 64) | lo for hi, lo in zip(self.hi, self.lo))
+
+
+class LinearizedFib:
+    """Compact flattened forwarding table. For each IP version the boundaries where the forwarding decision changes
+    are kept sorted in arrays of 64 bit words, one word per IPv4 boundary and two (high and low) per IPv6 boundary,
+    with a parallel array of zone set IDs. Each zone set is a sorted tuple of zone IDs, which in turn index the zone
+    names, so every interface or zone string and every ECMP combination is stored only once"""
+
+    def __init__(self, zone_names, zone_sets, boundary_words, set_ids):
+        self.zone_names = zone_names
+        self.zone_sets = zone_sets
+        self.zone_set_names = [tuple(zone_names[x] for x in zone_set) for zone_set in zone_sets]
+        self.zone_index = None
+        self.set_index = None
+        self.host_table = None
+        self.boundary_words = {}
+        self.set_ids = {}
+        self.boundaries = {}
+        for ver, words in boundary_words.items():
+            self.set_arrays(ver, words, set_ids[ver])
+
+    def set_arrays(self, ver, boundary_words, set_ids):
+        """Replaces the boundaries and zone set IDs of one IP version, dropping the HostTable if they are IPv4"""
+        if ver == 4:
+            self.host_table = None
+        self.boundary_words[ver] = boundary_words
+        self.set_ids[ver] = set_ids
+        self.boundaries[ver] = boundary_words[0] if len(boundary_words) == 1 else WideBoundaries(*boundary_words)
+
+    def set_points(self, ver, id_points):
+        """Replaces the boundaries of one IP version with compressed [ [ address, zone set ID ] ] points"""
+        if IP_VERSIONS[ver][0] > 64:
+            boundary_words = [array.array('Q', [x[0] >> 64 for x in id_points]),
+                              array.array('Q', [x[0] & MASK_64 for x in id_points])]
+        else:
+            boundary_words = [array.array('Q', [x[0] for x in id_points])]
+        self.set_arrays(ver, boundary_words, array.array('I', [x[1] for x in id_points]))
+
+    def intern_zone_set(self, zones):
+        """Returns the ID of the set of zone names, adding the zones and the set to the tables if they are new"""
+        if self.zone_index is None:
+            self.zone_index = {x: idx for idx, x in enumerate(self.zone_names)}
+            self.set_index = {x: idx for idx, x in enumerate(self.zone_sets)}
+        zones = sorted(set(zones))
+        # New zones are added in sorted order, so that the tables do not depend on the order of ECMP zones
+        for zone in zones:
+            if zone not in self.zone_index:
+                self.zone_index[zone] = len(self.zone_names)
+                self.zone_names.append(zone)
+        zone_set = tuple(self.zone_index[x] for x in zones)
+        if zone_set not in self.set_index:
+            self.set_index[zone_set] = len(self.zone_sets)
+            self.zone_sets.append(zone_set)
+            self.zone_set_names.append(tuple(self.zone_names[x] for x in zone_set))
+        return self.set_index[zone_set]
+
+    @classmethod
+    def from_points(cls, fib_list_compressed):
+        """Builds the table from the output of flatten_rib, interning zones and zone sets. Zone sets are compared as
+        sets, so adjacent boundaries listing the same zones in a different order are compressed together"""
+        fib = cls([], [], {}, {})
+        for ver, points in fib_list_compressed.items():
+            interned = {}  # Points split from the same route share their zones list
+            id_points = []
+            for point in points:
+                try:
+                    set_id = interned[id(point[1])]
+                except KeyError:
+                    set_id = interned[id(point[1])] = fib.intern_zone_set(point[1])
+                id_points.append([point[0], set_id])
+            fib.set_points(ver, compress_fib(id_points))
+        return fib
+
+    def runs(self, ver):
+        """Returns the start address and zone set ID of each run of addresses with the same forwarding decision, as
+        two lists. Each run ends where the next one starts"""
+        set_ids = self.set_ids[ver]
+        starts = []
+        run_ids = []
+        prev = None
+        for addr, set_id in zip(self.boundaries[ver], set_ids):
+            if set_id != prev:
+                starts.append(addr)
+                run_ids.append(set_id)
+                prev = set_id
+        return starts, run_ids
+
+    def set_runs(self, ver, starts, run_ids):
+        """Replaces the boundaries of one IP version with runs in the form returned by runs()"""
+        self.set_points(ver, _run_points(starts, run_ids, 2 ** IP_VERSIONS[ver][0] - 1))
+
+    def splice(self, ver, patches):
+        """Overlays patches, in the form taken by splice_runs, on the boundaries of one IP version. Only the runs
+        around each patch are rebuilt, from the run before it to the run after it, which keeps the runs outside them
+        unchanged, and the arrays between them are copied as they are"""
+        boundaries = self.boundaries[ver]
+        set_ids = self.set_ids[ver]
+        count = len(set_ids)
+        # Each run is stored as its first and last address, or as a single point, so it spans at most two points
+        windows = []
+        for lo, hi, runs in patches:
+            first = bisect.bisect_right(boundaries, lo) - 1
+            for _ in range(2):
+                if first > 0 and set_ids[first - 1] == set_ids[first]:
+                    first -= 1
+                if first > 0 and boundaries[first] >= lo:
+                    first -= 1
+            last = bisect.bisect_right(boundaries, hi) - 1
+            for _ in range(2):
+                if last + 1 < count and set_ids[last + 1] == set_ids[last]:
+                    last += 1
+                if last + 1 < count and boundaries[last] <= hi:
+                    last += 1
+            if windows and first <= windows[-1][1]:
+                windows[-1][1] = max(windows[-1][1], last)
+                windows[-1][2].append((lo, hi, runs))
+            else:
+                windows.append([first, last, [(lo, hi, runs)]])
+        words = [memoryview(x) for x in self.boundary_words[ver]]
+        new_words = [array.array('Q') for _ in words]
+        new_set_ids = array.array('I')
+        copied = 0
+        for first, last, window_patches in windows:
+            for word, new_word in zip(words, new_words):
+                new_word.frombytes(word[copied:first].cast('B'))
+            new_set_ids.frombytes(memoryview(set_ids)[copied:first].cast('B'))
+            starts = []
+            run_ids = []
+            for idx in range(first, last + 1):
+                if not run_ids or run_ids[-1] != set_ids[idx]:
+                    starts.append(boundaries[idx])
+                    run_ids.append(set_ids[idx])
+            id_points = _run_points(*splice_runs(starts, run_ids, window_patches, boundaries[last]),
+                                    boundaries[last])
+            if len(words) > 1:
+                new_words[0].extend(x[0] >> 64 for x in id_points)
+                new_words[1].extend(x[0] & MASK_64 for x in id_points)
+            else:
+                new_words[0].extend(x[0] for x in id_points)
+            new_set_ids.extend(x[1] for x in id_points)
+            copied = last + 1
+        for word, new_word in zip(words, new_words):
+            new_word.frombytes(word[copied:].cast('B'))
+        new_set_ids.frombytes(memoryview(set_ids)[copied:].cast('B'))
+        self.set_arrays(ver, new_words, new_set_ids)
+
+    @classmethod
+    def from_buffer(cls, buffer):
+        """Builds the table on top of a buffer in the format written by to_file, such as a memory mapped file. The
+        arrays are used in place without being copied or deserialized. Raises ValueError if the buffer is not a
+        complete fib file"""
+        view = memoryview(buffer)
+        magic, format_version, byte_order_mark, meta_len = _buffer_array(view, 0, 1, FIB_HEADER)[0]
+        if magic != FIB_MAGIC:
+            raise ValueError('Not a fib file')
+        if format_version != FIB_FORMAT_VERSION or byte_order_mark != FIB_BYTE_ORDER_MARK:
+            raise ValueError(f'Incompatible fib file format {format_version}')
+        data_start = _align(FIB_HEADER.size + meta_len)
+        boundary_words = {}
+        set_ids = {}
+        try:
+            meta = json.loads(bytes(_buffer_array(view, FIB_HEADER.size, meta_len, 'B')))
+            zone_names = list(meta['zone_names'])
+            zone_sets = [tuple(x) for x in meta['zone_sets']]
+            if not all(isinstance(y, int) and 0 <= y < len(zone_names) for x in zone_sets for y in x):
+                raise ValueError('Zone set with an unknown zone')
+            for ver, bits in IP_VERSIONS.items():
+                section = meta['sections'][str(ver)]
+                count = section['count']
+                if len(section['words']) != (2 if bits[0] > 64 else 1):
+                    raise ValueError(f'Wrong number of boundary arrays for IPv{ver}')
+                boundary_words[ver] = [_buffer_array(view, data_start + x, count, 'Q') for x in section['words']]
+                set_ids[ver] = _buffer_array(view, data_start + section['set_ids'], count, 'I')
+        except (KeyError, TypeError) as e:
+            raise ValueError(f'Invalid fib metadata: {e}') from None
+        return cls(zone_names, zone_sets, boundary_words, set_ids)
+
+    @classmethod
+    def load(cls, path):
+        """Memory maps a fib file written by to_file"""
+        with open(path, 'rb') as f:
+            return cls.from_buffer(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def to_file(self, f):
+        """Writes the table to a binary file object: a header, a json metadata block holding the zone tables and the
+        offset of each array, then the arrays themselves aligned to 8 bytes"""
+        write_fib_file(f, self.zone_names, self.zone_sets, {x: len(y) for x, y in self.set_ids.items()},
+                       lambda ver, idx: f.write((list(self.boundary_words[ver]) + [self.set_ids[ver]])[idx]))
+
+    def points(self, ver):
+        """Returns the boundaries of one IP version in the original [ [ address, [ zones ] ] ] form"""
+        return [[x, list(self.zone_set_names[y])] for x, y in zip(self.boundaries[ver], self.set_ids[ver])]
+
+    def version_zones(self, ver):
+        """Returns the set of every zone found in the table for one IP version"""
+        return {x for y in set(self.set_ids[ver]) for x in self.zone_set_names[y]}
+
+    def digest(self):
+        """Returns the hex digest of the zones and boundaries of the table, which identifies its contents whether it
+        was built from a rib, loaded from the cache or patched with a rib delta"""
+        digest = hashlib.sha256(json.dumps([self.zone_names, self.zone_sets]).encode('utf-8'))
+        for ver in IP_VERSIONS:
+            for words in self.boundary_words[ver]:
+                digest.update(memoryview(words).cast('B'))
+            digest.update(memoryview(self.set_ids[ver]).cast('B'))
+        return digest.hexdigest()
+
+
+def _run_points(starts, run_ids, last_addr):
+    """Returns runs in the form returned by LinearizedFib.runs, the last one ending at last_addr, as compressed
+    [ [ address, zone set ID ] ] points"""
+    id_points = []
+    for idx, start in enumerate(starts):
+        end = starts[idx + 1] - 1 if idx + 1 < len(starts) else last_addr
+        id_points.append([start, run_ids[idx]])
+        if end != start:
+            id_points.append([end, run_ids[idx]])
+    return id_points
+
+
+def _align(size):
+    """Rounds a byte count up to a multiple of 8"""
+    return (size + 7) & ~7
+
+
+def _buffer_array(view, start, count, item_format):
+    """Returns count items of a memoryview from the byte offset start, cast in place to the format item_format, or
+    unpacked as a list of tuples if item_format is a struct.Struct. Raises ValueError if the view is too short to hold
+    them, so a truncated file is reported as unreadable instead of failing later"""
+    item_size = item_format.size if isinstance(item_format, struct.Struct) else struct.calcsize(item_format)
+    if not isinstance(start, int) or not isinstance(count, int) or start < 0 or count < 0:
+        raise ValueError(f'Invalid array offset {start} or length {count}')
+    end = start + count * item_size
+    if end > len(view):
+        raise ValueError(f'Truncated file, {end} bytes expected but {len(view)} found')
+    if isinstance(item_format, struct.Struct):
+        return list(item_format.iter_unpack(view[start:end]))
+    return view[start:end].cast(item_format)
+
+
+def write_fib_file(f, zone_names, zone_sets, counts, write_array):
+    """Writes a fib in the format of LinearizedFib.to_file to a binary file object, from its zone tables and the
+    number of boundaries of each IP version. The arrays are written by write_array(ver, idx), which writes the array
+    idx of an IP version to f: its boundary words, high first for IPv6, then its zone set IDs"""
+    sections = {}
+    sizes = {}
+    offset = 0
+    for ver, bits in IP_VERSIONS.items():
+        count = counts[ver]
+        sections[str(ver)] = {'count': count, 'words': [], 'set_ids': 0}
+        sizes[ver] = []
+        for _ in range(2 if bits[0] > 64 else 1):
+            sections[str(ver)]['words'].append(offset)
+            sizes[ver].append(count * 8)
+            offset += _align(count * 8)
+        sections[str(ver)]['set_ids'] = offset
+        sizes[ver].append(count * 4)
+        offset += _align(count * 4)
+    meta = json.dumps({'zone_names': zone_names, 'zone_sets': zone_sets, 'sections': sections}).encode('utf-8')
+    f.write(FIB_HEADER.pack(FIB_MAGIC, FIB_FORMAT_VERSION, FIB_BYTE_ORDER_MARK, len(meta)))
+    f.write(meta)
+    f.write(bytes(_align(FIB_HEADER.size + len(meta)) - FIB_HEADER.size - len(meta)))
+    for ver in IP_VERSIONS:
+        for idx, size in enumerate(sizes[ver]):
+            write_array(ver, idx)
+            f.write(bytes(_align(size) - size))
+
+
+class HostTable:
+    """Two stage lookup table of the IPv4 boundaries of a LinearizedFib, in the style of the DIR-24-8 route lookup.
+    The first stage holds the zone set ID of each /24, or, for the /24s in which the forwarding decision changes, the
+    index of an overflow block holding the zone set ID of each of its 256 addresses. The zone sets of an object
+    within a /24, such as a host, are then read from one or two arrays instead of binary searching the boundaries"""
+
+    def __init__(self, first_stage, blocks):
+        self.first_stage = first_stage
+        self.blocks = blocks
+
+    @classmethod
+    def from_fib(cls, fib):
+        """Builds the table from the IPv4 runs of a fib"""
+        block_size = 1 << HOST_TABLE_BLOCK_BITS
+        starts, run_ids = fib.runs(4)
+        first_stage = array.array('I', [0]) * (1 << (IP_VERSIONS[4][0] - HOST_TABLE_BLOCK_BITS))
+        split = []
+        for idx, start in enumerate(starts):
+            end = starts[idx + 1] - 1 if idx + 1 < len(starts) else 2 ** IP_VERSIONS[4][0] - 1
+            # A run gives its zone set to the blocks whose first address it holds
+            first = (start + block_size - 1) >> HOST_TABLE_BLOCK_BITS
+            last = end >> HOST_TABLE_BLOCK_BITS
+            if last >= first:
+                first_stage[first:last + 1] = array.array('I', [run_ids[idx]]) * (last + 1 - first)
+            if start & (block_size - 1) and (not split or split[-1] != start >> HOST_TABLE_BLOCK_BITS):
+                split.append(start >> HOST_TABLE_BLOCK_BITS)
+        blocks = array.array('I')
+        for block in split:
+            first_stage[block] = HOST_TABLE_OVERFLOW | (len(blocks) >> HOST_TABLE_BLOCK_BITS)
+            addr = block << HOST_TABLE_BLOCK_BITS
+            block_end = addr + block_size
+            idx = bisect.bisect_right(starts, addr) - 1
+            while addr < block_end:
+                run_end = min(starts[idx + 1], block_end) if idx + 1 < len(starts) else block_end
+                blocks.extend(array.array('I', [run_ids[idx]]) * (run_end - addr))
+                addr = run_end
+                idx += 1
+        logging.info('Built IPv4 host table with %d overflow blocks', len(split))
+        return cls(first_stage, blocks)
+
+    def set_ids(self, first, last):
+        """Returns the zone set IDs of the addresses from first to last, which must be within the same /24"""
+        entry = self.first_stage[first >> HOST_TABLE_BLOCK_BITS]
+        if entry < HOST_TABLE_OVERFLOW:
+            return (entry,)
+        offset = (entry ^ HOST_TABLE_OVERFLOW) << HOST_TABLE_BLOCK_BITS
+        mask = (1 << HOST_TABLE_BLOCK_BITS) - 1
+        return self.blocks[offset + (first & mask):offset + (last & mask) + 1]
+
+    @classmethod
+    def from_buffer(cls, buffer):
+        """Builds the table on top of a buffer in the format written by to_file, as LinearizedFib.from_buffer does"""
+        view = memoryview(buffer)
+        magic, format_version, byte_order_mark, block_count = _buffer_array(view, 0, 1, HOST_TABLE_HEADER)[0]
+        if magic != HOST_TABLE_MAGIC:
+            raise ValueError('Not a host table file')
+        if format_version != HOST_TABLE_FORMAT_VERSION or byte_order_mark != FIB_BYTE_ORDER_MARK:
+            raise ValueError(f'Incompatible host table file format {format_version}')
+        first_stage_count = 1 << (IP_VERSIONS[4][0] - HOST_TABLE_BLOCK_BITS)
+        first_stage_end = HOST_TABLE_HEADER.size + first_stage_count * 4
+        return cls(_buffer_array(view, HOST_TABLE_HEADER.size, first_stage_count, 'I'),
+                   _buffer_array(view, first_stage_end, block_count << HOST_TABLE_BLOCK_BITS, 'I'))
+
+    @classmethod
+    def load(cls, path):
+        """Memory maps a host table file written by to_file"""
+        with open(path, 'rb') as f:
+            return cls.from_buffer(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def to_file(self, f):
+        """Writes the table to a binary file object: a header, then the first stage and the overflow blocks"""
+        f.write(HOST_TABLE_HEADER.pack(HOST_TABLE_MAGIC, HOST_TABLE_FORMAT_VERSION, FIB_BYTE_ORDER_MARK,
+                                       len(self.blocks) >> HOST_TABLE_BLOCK_BITS))
+        f.write(self.first_stage)
+        f.write(self.blocks)
+
+
+def populate_linearized_fib(ribfile, sep, engine='sweep', workers=1, reduce=False, memory=0, tmp_dir=None):
+    """Flattens the routes in a csv file as in '192.0.2.0/24, IFACE_OR_ZONE' with flatten_rib and returns them as a
+    LinearizedFib. With more than one worker the sweep engine flattens partitions of the address space in parallel
+    with parallel_linearized_fib. With reduce the routes are reduced with reduce_rib first. With memory the fib is
+    built out of core with external_linearized_fib, in about that many bytes, into a temporary file in tmp_dir which
+    is memory mapped, whatever the engine, workers and reduce"""
+    if memory:
+        with tempfile.TemporaryFile(dir=tmp_dir) as f:
+            external_linearized_fib(ribfile, sep, f, memory, tmp_dir)
+            f.flush()
+            return LinearizedFib.from_buffer(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    if workers != 1:
+        if engine == 'sweep':
+            with metrics.stage('flatten'):
+                return parallel_linearized_fib(ribfile, sep, workers, reduce)
+        logging.warning('Only the sweep engine can flatten routes in parallel, using a single process')
+    fib_list_compressed = flatten_rib(ribfile, sep, engine, reduce)
+    logging.info('Interning zones and packing the fib into arrays')
+    with metrics.stage('pack'):
+        return LinearizedFib.from_points(fib_list_compressed)
+
+
+def _partition_key(prefix):
+    """Returns the IP version and the partition of a route from its prefix string, using only the first octet or
+    hextet and the prefix length so that the address does not need to be parsed. The partition is None when the
+    route is shorter than FIB_PARTITION_PREFIXLEN, or when the prefix is written in a form this cannot tell"""
+    addr, _, plen = prefix.partition('/')
+    ver = 6 if ':' in addr else 4
+    if plen and (not plen.isdigit() or int(plen) < FIB_PARTITION_PREFIXLEN[ver]):
+        return ver, None
+    try:
+        if ver == 6:
+            first = 0 if addr.startswith('::') else int(addr[:addr.index(':')], 16)
+        else:
+            first = int(addr[:addr.index('.')])
+    except ValueError:
+        return ver, None
+    return ver, first if 0 <= first < 2 ** FIB_PARTITION_PREFIXLEN[ver] else None
+
+
+def _flatten_partitions(task):
+    """Process pool task. Takes (IP version, lo, hi, covering route, rib rows) partitions, where the covering route
+    is the longest of those shorter than the partition which contain it, and whether to reduce their routes, and
+    returns the (IP version, lo, hi, runs) patches flattened from them, with each zone set as a sorted tuple of zone
+    names, along with the number of routes reduced"""
+    partitions, reduce = task
+    patches = []
+    removed = 0
+    for ver, lo, hi, covering, rows in partitions:
+        bits = IP_VERSIONS[ver][0]
+        levels = [{} for _ in range(bits + 1)]
+        levels[covering[2]][covering[0]] = set(covering[3])
+        for line in rows:
+            _, net, plen = parse_prefix(line[0])
+            levels[plen].setdefault(net, set()).add(line[1])
+        if reduce:
+            # The covering route stands for the routes outside the partition, which cannot be merged with its own
+            removed += _reduce_levels(levels, bits)
+        routes = [(net, net | ((1 << (bits - plen)) - 1), plen, tuple(sorted(zones)))
+                  for plen, level in enumerate(levels) for net, zones in level.items()]
+        patches.append((ver, lo, hi, list(sweep_runs(routes, lo, hi))))
+    return patches, removed
+
+
+def parallel_linearized_fib(ribfile, sep, workers=0, reduce=False):
+    """Flattens the routes in a csv file as in '192.0.2.0/24, IFACE_OR_ZONE' in a pool of worker processes, one per
+    CPU if workers is 0, and returns them as a LinearizedFib equivalent to populate_linearized_fib. The address space
+    of each IP version is split in partitions of prefix length FIB_PARTITION_PREFIXLEN, which the workers parse and
+    flatten independently. Routes shorter than a partition, such as the default route, are flattened here instead,
+    and the partitions are spliced into them. With reduce the routes of each partition are reduced as reduce_rib
+    does, the partition standing on its own under its covering route"""
+    workers = workers or os.cpu_count() or 1
+    short_rows = []
+    partition_rows = {}
+    idx = 0
+    for idx, line in enumerate(read_rib_rows(ribfile, sep), start=1):
+        ver, partition = _partition_key(line[0])
+        if partition is None:
+            ver, net, plen = parse_prefix(line[0])
+            if plen < FIB_PARTITION_PREFIXLEN[ver]:
+                short_rows.append((ver, net, plen, line[1]))
+                continue
+            partition = net >> (IP_VERSIONS[ver][0] - FIB_PARTITION_PREFIXLEN[ver])
+        partition_rows.setdefault((ver, partition), []).append(line)
+    metrics.count('routes', idx)
+    short_routes = {ver: {(0, 0): {'####NULL_ROUTED####'}} for ver in IP_VERSIONS}
+    defaults = set()
+    for ver, net, plen, zone in short_rows:
+        key = (plen, net)
+        if plen == 0 and ver not in defaults:
+            # The default added for a rib without one is replaced by the first default route found
+            short_routes[ver][key] = set()
+            defaults.add(ver)
+        short_routes[ver].setdefault(key, set()).add(zone)
+    partitions = []
+    for (ver, partition), rows in sorted(partition_rows.items()):
+        bits = IP_VERSIONS[ver][0]
+        size = bits - FIB_PARTITION_PREFIXLEN[ver]
+        lo = partition << size
+        for plen in range(FIB_PARTITION_PREFIXLEN[ver] - 1, -1, -1):
+            start = lo & ~((1 << (bits - plen)) - 1)
+            if (plen, start) in short_routes[ver]:
+                covering = (start, start + (1 << (bits - plen)) - 1, plen,
+                            tuple(sorted(short_routes[ver][(plen, start)])))
+                break
+        partitions.append((len(rows), (ver, lo, lo + (1 << size) - 1, covering, rows)))
+    # Balance the tasks by number of routes, handing the largest partitions out first
+    tasks = [[] for _ in range(min(len(partitions), workers * 4))]
+    loads = [0] * len(tasks)
+    for load, partition in sorted(partitions, key=lambda x: x[0], reverse=True):
+        idx = loads.index(min(loads))
+        tasks[idx].append(partition)
+        loads[idx] += load
+    logging.info('Flattening %d partitions of the address space with %d workers', len(partitions), workers)
+    metrics.count('partitions', len(partitions))
+    patches = {ver: [] for ver in IP_VERSIONS}
+    removed = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        for result, task_removed in pool.map(_flatten_partitions, [(x, reduce) for x in tasks]):
+            for ver, lo, hi, runs in result:
+                patches[ver].append((lo, hi, runs))
+            removed += task_removed
+    if reduce:
+        logging.info('Removed %d routes from the rib before flattening', removed)
+        metrics.count('routes_reduced', removed)
+    logging.info('Splicing the partitions into the routes shorter than a partition')
+    fib = LinearizedFib([], [], {}, {})
+    set_ids = {}
+    for ver, bits in IP_VERSIONS.items():
+        routes = [(start, start + (1 << (bits[0] - plen)) - 1, plen, tuple(sorted(zones)))
+                  for (plen, start), zones in short_routes[ver].items()]
+        base_runs = list(sweep_runs(routes))
+        for zones in {x[2] for runs in [base_runs] + [x[2] for x in patches[ver]] for x in runs}:
+            if zones not in set_ids:
+                set_ids[zones] = fib.intern_zone_set(zones)
+        starts = []
+        run_ids = []
+        for first, _, zones in base_runs:
+            if not run_ids or run_ids[-1] != set_ids[zones]:
+                starts.append(first)
+                run_ids.append(set_ids[zones])
+        id_patches = [(lo, hi, [(first, last, set_ids[zones]) for first, last, zones in runs])
+                      for lo, hi, runs in sorted(patches[ver], key=lambda x: x[0])]
+        fib.set_runs(ver, *splice_runs(starts, run_ids, id_patches, 2 ** bits[0] - 1))
+    # The zone sets were interned as the partitions came back, so intern them again in address order as from_points
+    # does, which gives the same tables and digest as populate_linearized_fib whatever the order and hash seed
+    ordered = LinearizedFib([], [], {}, {})
+    for ver in IP_VERSIONS:
+        new_ids = {x: ordered.intern_zone_set(fib.zone_set_names[x]) for x in dict.fromkeys(fib.set_ids[ver])}
+        ordered.set_arrays(ver, fib.boundary_words[ver], array.array('I', map(new_ids.__getitem__, fib.set_ids[ver])))
+    return ordered
+
+
+def _spill_run(records, tmp_dir):
+    """Sorts route records and writes them to a new file in tmp_dir, returning its path"""
+    records.sort()
+    fd, path = tempfile.mkstemp(suffix='.run', dir=tmp_dir)
+    with os.fdopen(fd, 'wb') as f:
+        f.writelines(records)
+    return path
+
+
+def _read_run(path, chunk_records):
+    """Yields the route records of a sorted run file in order, reading chunk_records at a time without buffering
+    more"""
+    size = FIB_RUN_RECORD.size
+    with open(path, 'rb', buffering=0) as f:
+        for chunk in iter(lambda: f.read(size * chunk_records), b''):
+            for idx in range(0, len(chunk), size):
+                yield chunk[idx:idx + size]
+
+
+def _merge_plan(memory):
+    """Returns the number of sorted runs merged at once and the number of records read from each at a time so that
+    the chunks being merged fit in memory bytes: up to FIB_MERGE_FAN_IN runs read FIB_RUN_CHUNK_RECORDS at a time,
+    fewer runs with less memory, down to two, then smaller chunks, down to one record"""
+    size = FIB_RUN_RECORD.size
+    fan_in = min(max(memory // (size * FIB_RUN_CHUNK_RECORDS), 2), FIB_MERGE_FAN_IN)
+    return fan_in, min(max(memory // (size * fan_in), 1), FIB_RUN_CHUNK_RECORDS)
+
+
+def _merge_runs(paths, tmp_dir, fan_in=FIB_MERGE_FAN_IN, chunk_records=FIB_RUN_CHUNK_RECORDS):
+    """Returns an iterator over the route records of sorted run files, merged in order, reading chunk_records of each
+    at a time. With more than fan_in runs, groups of them are first merged into new runs in tmp_dir, so that no more
+    than fan_in files are read at once"""
+    while len(paths) > fan_in:
+        merged = []
+        for idx in range(0, len(paths), fan_in):
+            group = paths[idx:idx + fan_in]
+            fd, path = tempfile.mkstemp(suffix='.run', dir=tmp_dir)
+            with os.fdopen(fd, 'wb') as f:
+                f.writelines(heapq.merge(*(_read_run(x, chunk_records) for x in group)))
+            for run in group:
+                os.remove(run)
+            merged.append(path)
+        paths = merged
+    return heapq.merge(*(_read_run(x, chunk_records) for x in paths))
+
+
+def _record_routes(records, bits, zone_names):
+    """Takes the merged route records of one IP version and yields its routes as (start, end, prefixlen, zones)
+    tuples in the order sweep_runs takes them, the zones of the records of the same route being merged as parse_rib
+    does for ECMP and duplicate routes. A default route pointing to ####NULL_ROUTED#### comes first if there is no
+    default route"""
+    unpack = FIB_RUN_RECORD.unpack
+    key = None
+    zones = set()
+    count = 0
+    for record in records:
+        hi, lo, plen, zone = unpack(record)
+        net = (hi << 64) | lo
+        if (net, plen) != key:
+            if key is not None:
+                yield key[0], key[0] | ((1 << (bits - key[1])) - 1), key[1], tuple(sorted(zones))
+            elif plen:
+                yield 0, (1 << bits) - 1, 0, ('####NULL_ROUTED####',)
+            key = (net, plen)
+            zones = set()
+            count += 1
+        zones.add(zone_names[zone])
+    if key is None:
+        yield 0, (1 << bits) - 1, 0, ('####NULL_ROUTED####',)
+    else:
+        yield key[0], key[0] | ((1 << (bits - key[1])) - 1), key[1], tuple(sorted(zones))
+    metrics.count('external_routes', count)
+
+
+def _write_boundaries(runs, fib, bits, paths, chunk_records=FIB_RUN_CHUNK_RECORDS):
+    """Writes runs of addresses of one IP version, (first, last, zones) tuples in order, to the files at paths as the
+    arrays of a fib: the boundary words, high first for IPv6, then the IDs of the zone sets, interned in the
+    LinearizedFib fib. Adjacent runs with the same zone set are merged, each run is stored as its first and last
+    address, as LinearizedFib.set_runs does, and the arrays are written chunk_records boundaries at a time. Returns
+    the number of boundaries"""
+    set_ids = {}
+    arrays = [array.array('Q') for _ in range(2 if bits > 64 else 1)] + [array.array('I')]
+    count = 0
+    with contextlib.ExitStack() as stack:
+        outputs = [stack.enter_context(open(x, 'wb')) for x in paths]
+
+        def flush():
+            for arr, output in zip(arrays, outputs):
+                arr.tofile(output)
+                del arr[:]
+
+        def add_run(first, last, set_id):
+            for addr in (first,) if first == last else (first, last):
+                if bits > 64:
+                    arrays[0].append(addr >> 64)
+                    arrays[1].append(addr & MASK_64)
+                else:
+                    arrays[0].append(addr)
+                arrays[-1].append(set_id)
+            if len(arrays[-1]) >= chunk_records:
+                flush()
+            return 1 if first == last else 2
+
+        run = None
+        for first, last, zones in runs:
+            if zones not in set_ids:
+                set_ids[zones] = fib.intern_zone_set(zones)
+            set_id = set_ids[zones]
+            if run and run[2] == set_id:
+                run[1] = last
+                continue
+            if run:
+                count += add_run(*run)
+            run = [first, last, set_id]
+        count += add_run(*run)
+        flush()
+    return count
+
+
+def external_linearized_fib(ribfile, sep, f, memory, tmp_dir=None):
+    """Flattens the routes in a csv file as in '192.0.2.0/24, IFACE_OR_ZONE' out of core and writes them to the binary
+    file object f as a fib in the format of LinearizedFib.to_file, the same fib populate_linearized_fib builds. The
+    rows are read one at a time into FIB_RUN_RECORD records, which are sorted in runs of as many as fit in memory
+    bytes and written to temporary files in tmp_dir. The runs of each IP version are then merged as they are swept
+    with sweep_runs, as many at a time and in chunks as _merge_plan fits in memory bytes, and the boundaries written
+    to temporary files as they come, until the zone tables which precede them in the fib file are complete. Only the
+    zone tables and the routes enclosing the sweep are kept in memory besides the runs being sorted or merged, so the
+    memory used does not grow with the number of routes"""
+    progress = Progress('Sorted %d routes of the RIB')
+    # Each buffered record takes the bytes object and its entry in the list
+    max_records = max(memory // (sys.getsizeof(bytes(FIB_RUN_RECORD.size)) + 8), 1)
+    zone_index = {}
+    fib = LinearizedFib([], [], {}, {})
+    with tempfile.TemporaryDirectory(prefix='autozoner-', dir=tmp_dir) as tmp:
+        runs = {ver: [] for ver in IP_VERSIONS}
+        buffers = {ver: [] for ver in IP_VERSIONS}
+        buffered = 0
+        idx = 0
+        with metrics.stage('rib_parse'):
+            for idx, line in enumerate(read_rib_rows(ribfile, sep), start=1):
+                ver, net, plen = parse_prefix(line[0])
+                zone = zone_index.setdefault(line[1], len(zone_index))
+                buffers[ver].append(FIB_RUN_RECORD.pack(net >> 64, net & MASK_64, plen, zone))
+                buffered += 1
+                if buffered >= max_records:
+                    for ver, records in buffers.items():
+                        if records:
+                            runs[ver].append(_spill_run(records, tmp))
+                            records.clear()
+                    buffered = 0
+                progress.update(idx)
+            for ver, records in buffers.items():
+                if records:
+                    runs[ver].append(_spill_run(records, tmp))
+                    records.clear()
+        metrics.count('routes', idx)
+        metrics.count('sorted_runs', sum(len(x) for x in runs.values()))
+        logging.info('Sorted %d routes in %d runs', idx, sum(len(x) for x in runs.values()))
+        zone_names = list(zone_index)
+        fan_in, chunk_records = _merge_plan(memory)
+        counts = {}
+        paths = {}
+        with metrics.stage('flatten'):
+            for ver, bits in IP_VERSIONS.items():
+                logging.info('Flattening IPv%d routes', ver)
+                routes = _record_routes(_merge_runs(runs[ver], tmp, fan_in, chunk_records), bits[0], zone_names)
+                paths[ver] = [os.path.join(tmp, f'{ver}-{x}.array') for x in range(3 if bits[0] > 64 else 2)]
+                counts[ver] = _write_boundaries(sweep_runs(routes, presorted=True), fib, bits[0], paths[ver],
+                                                chunk_records)
+        logging.info('Writing the fib')
+
+        def copy_array(ver, idx):
+            with open(paths[ver][idx], 'rb') as a:
+                shutil.copyfileobj(a, f)
+
+        with metrics.stage('pack'):
+            write_fib_file(f, fib.zone_names, fib.zone_sets, counts, copy_array)
+
+
+def parse_rib_delta(deltafile, sep):
+    """Reads a csv file as in 'add, 192.0.2.0/24, IFACE_OR_ZONE' listing changes to a rib file and returns them as
+    (action, (IP version, network address, prefix length), zone) tuples, the route being as parse_prefix returns it.
+    The action is one of RIB_DELTA_ACTIONS: 'add' adds a route, or another ECMP zone to an existing route, 'withdraw'
+    removes the zone from the route, or the whole route if the zone is empty, and 'replace' sets the zones of the
+    route to those of all the 'replace' lines for it"""
+    changes = []
+    with open_text(deltafile) as a:
+        for idx, line in enumerate(csv.reader(a, delimiter=sep), start=1):
+            if not line:
+                continue
+            action = line[0].strip().lower()
+            if action not in RIB_DELTA_ACTIONS:
+                if idx == 1:
+                    logging.info('Found header in rib delta file')
+                    continue
+                logging.critical('Unknown action "%s" at line %d of rib delta file. Exiting...', line[0], idx)
+                sys.exit(1)
+            zone = line[2] if len(line) > 2 else ''
+            if not zone and action != 'withdraw':
+                logging.error('route change %s has no interface, skipping', line)
+                continue
+            changes.append((action, parse_prefix(line[1]), zone))
+    return changes
+
+
+def splice_runs(starts, run_ids, patches, last_addr):
+    """Overlays patches on runs in the form returned by LinearizedFib.runs and returns the result in the same form.
+    Patches are (lo, hi, runs) tuples sorted by address, where runs are the (first, last, zone set ID) stretches
+    covering lo to hi. Adjacent runs with the same zone set are merged"""
+    new_starts = []
+    new_ids = []
+
+    def push(start, set_id):
+        if new_starts and new_starts[-1] == start:
+            # An original run resumed after a patch is empty when the next patch starts right there
+            new_starts.pop()
+            new_ids.pop()
+        if not new_ids or new_ids[-1] != set_id:
+            new_starts.append(start)
+            new_ids.append(set_id)
+
+    def copy(first, last):
+        # Runs in the original list already differ from their neighbours, so only the first one can merge
+        if first < last:
+            push(starts[first], run_ids[first])
+            new_starts.extend(starts[first + 1:last])
+            new_ids.extend(run_ids[first + 1:last])
+
+    idx = 0
+    for lo, hi, runs in patches:
+        end = bisect.bisect_left(starts, lo, idx)
+        copy(idx, end)
+        for first, _, set_id in runs:
+            push(first, set_id)
+        idx = bisect.bisect_right(starts, hi, end)
+        if hi < last_addr and (idx == len(starts) or starts[idx] > hi + 1):
+            # The original run around the end of the patch resumes right after it
+            push(hi + 1, run_ids[idx - 1])
+    copy(idx, len(starts))
+    return new_starts, new_ids
+
+
+def apply_rib_delta(rib_dict_list, deltafile, sep):
+    """Applies the changes in a rib delta file to the routes in rib_dict_list, in place, and returns the routes whose
+    zones changed as (IP version, network address, prefix length) tuples"""
+    for ver in IP_VERSIONS:
+        # The default added by parse_rib to a rib without one must give way to a default route added by the delta
+        if rib_dict_list[ver][0].get(0) == {'####NULL_ROUTED####'}:
+            del rib_dict_list[ver][0][0]
+    before = {}
+    replaced = set()
+    for action, key, zone in parse_rib_delta(deltafile, sep):
+        ver, net, plen = key
+        level = rib_dict_list[ver][plen]
+        if key not in before:
+            before[key] = set(level.get(net, ()))
+        if action == 'replace' and key not in replaced:
+            level[net] = set()
+            replaced.add(key)
+        if action != 'withdraw':
+            level.setdefault(net, set()).add(zone)
+        elif zone:
+            level.get(net, set()).discard(zone)
+        else:
+            level.pop(net, None)
+        if net in level and not level[net]:
+            del level[net]
+    for ver in IP_VERSIONS:
+        if not rib_dict_list[ver][0]:
+            rib_dict_list[ver][0][0] = {'####NULL_ROUTED####'}
+    changed = [key for key, zones in before.items() if rib_dict_list[key[0]][key[2]].get(key[1]) != zones]
+    logging.warning('Rib delta changes the zones of %d prefixes', len(changed))
+    metrics.count('delta_prefixes', len(changed))
+    return changed
+
+
+def rib_changes(old_rib_dict_list, new_rib_dict_list):
+    """Returns the routes whose zones differ between two parsed ribs, including the routes present in only one of
+    them, as (IP version, network address, prefix length) tuples"""
+    changed = []
+    for ver in IP_VERSIONS:
+        for plen, (old_level, new_level) in enumerate(zip(old_rib_dict_list[ver], new_rib_dict_list[ver])):
+            if old_level != new_level:
+                changed += [(ver, net, plen) for net in old_level.keys() | new_level.keys()
+                            if old_level.get(net) != new_level.get(net)]
+    logging.warning('The ribs differ in the zones of %d prefixes', len(changed))
+    return changed
+
+
+def patch_linearized_fib(fib, rib_dict_list, changed):
+    """Returns a new LinearizedFib for the routes in rib_dict_list, given the fib of the same routes before the zones
+    of the routes in changed, as (IP version, network address, prefix length) tuples, were changed, along with the
+    address intervals flattened again for each IP version. Only the address intervals of the changed routes are
+    flattened, from the routes inside and covering them, and spliced into the boundaries of fib, which gives the same
+    boundaries and zones as flattening all the routes"""
+    new_fib = LinearizedFib(list(fib.zone_names), list(fib.zone_sets), fib.boundary_words, fib.set_ids)
+    changed_intervals = {ver: [] for ver in IP_VERSIONS}
+    for ver, bits in IP_VERSIONS.items():
+        # Changed prefixes nested in another changed prefix are flattened with it
+        outer = []
+        for _, net, plen in sorted(x for x in changed if x[0] == ver):
+            end = net | ((1 << (bits[0] - plen)) - 1)
+            if not outer or end > outer[-1][1]:
+                outer.append((net, end, plen))
+        if not outer:
+            continue
+        intervals = [x[:2] for x in outer]
+        changed_intervals[ver] = intervals
+        interval_starts = [x[0] for x in intervals]
+        interval_routes = [[] for _ in outer]
+        set_ids = {}
+
+        def route(net, plen, zones):
+            if id(zones) not in set_ids:
+                set_ids[id(zones)] = new_fib.intern_zone_set(zones)
+            return net, net | ((1 << (bits[0] - plen)) - 1), plen, set_ids[id(zones)]
+
+        for plen in range(min(x[2] for x in outer), bits[0] + 1):
+            level = rib_dict_list[ver][plen]
+            step = 1 << (bits[0] - plen)
+            inside = [x for x in range(len(outer)) if outer[x][2] <= plen]
+            if sum((intervals[x][1] - intervals[x][0]) // step + 1 for x in inside) <= len(level):
+                # Looking the prefixes of the intervals up is cheaper than going through the level
+                for idx in inside:
+                    for net in range(intervals[idx][0], intervals[idx][1] + 1, step):
+                        if net in level:
+                            interval_routes[idx].append(route(net, plen, level[net]))
+                continue
+            for net, zones in level.items():
+                idx = bisect.bisect_right(interval_starts, net) - 1
+                if idx >= 0 and net | (step - 1) <= intervals[idx][1]:
+                    interval_routes[idx].append(route(net, plen, zones))
+        for idx, (net, _, net_plen) in enumerate(outer):
+            for plen in range(net_plen):
+                supernet = net >> (bits[0] - plen) << (bits[0] - plen)
+                if supernet in rib_dict_list[ver][plen]:
+                    interval_routes[idx].append(route(supernet, plen, rib_dict_list[ver][plen][supernet]))
+        patches = [(lo, hi, list(sweep_runs(routes, lo, hi)))
+                   for (lo, hi), routes in zip(intervals, interval_routes)]
+        logging.info('Splicing %d flattened IPv%d intervals into the fib', len(patches), ver)
+        new_fib.splice(ver, patches)
+    return new_fib, changed_intervals
+
+
+def update_linearized_fib(fib, rib_dict_list, deltafile, sep):
+    """Applies the changes in a rib delta file to the routes in rib_dict_list, in place, and returns a new
+    LinearizedFib for the updated routes, patched from fib with patch_linearized_fib"""
+    return patch_linearized_fib(fib, rib_dict_list, apply_rib_delta(rib_dict_list, deltafile, sep))[0]
+
+
+def file_digest(prefix, *paths):
+    """Returns the hex digest of a prefix string followed by the contents of each of the files in paths which is not
+    None"""
+    digest = hashlib.sha256(prefix.encode('utf-8'))
+    for path in paths:
+        if path:
+            digest.update(b'\x00')
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fib_cache_key(ribfile, sep, deltafile=None):
+    """Returns the hex digest identifying the fib built from a rib file: the hash of the file contents, the csv
+    separator and FIB_BUILDER_VERSION, and of the contents of the rib delta file applied to it if any"""
+    return file_digest(f'{FIB_BUILDER_VERSION}{sep}', ribfile, deltafile)
+
+
+def evict_fib_cache(cache_dir, max_entries, max_bytes, suffix='.fib'):
+    """Removes the least recently used fibs, or the files ending with suffix, from the cache directory until at most
+    max_entries of them and max_bytes bytes are left. A limit of 0 disables it"""
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(suffix):
+            file_stat = os.stat(os.path.join(cache_dir, name))
+            entries.append((file_stat.st_mtime, file_stat.st_size, name))
+    entries.sort(reverse=True)
+    total = 0
+    for idx, (_, size, name) in enumerate(entries):
+        total += size
+        if (max_entries and idx >= max_entries) or (max_bytes and total > max_bytes):
+            logging.info('Evicting %s from the cache', name)
+            os.remove(os.path.join(cache_dir, name))
+
+
+def write_cache_file(path, write, mode='wb'):
+    """Writes a cache file through write, called with the file open in mode, to a temporary file which replaces path
+    once complete, so that an interrupted or failed write does not leave a partial cache file behind"""
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, mode, encoding=None if 'b' in mode else 'utf-8') as f:
+            write(f)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+
+def cached_linearized_fib(ribfile, sep, engine='sweep', cache_dir=FIB_CACHE_DIR, max_entries=FIB_CACHE_MAX_ENTRIES,
+                          max_bytes=0, deltafile=None, workers=1, reduce=False, memory=0):
+    """Returns the LinearizedFib for a rib file from the cache directory, memory mapped, building and caching it first
+    if the cache has no fib for the current contents of the file. With a rib delta file the fib of the rib file alone
+    is taken from the cache, or built and cached, and updated with the delta. With memory the fib of the rib file is
+    built out of core, with external_linearized_fib writing it straight to the cache file, whatever the engine, workers
+    and reduce"""
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f'{fib_cache_key(ribfile, sep, deltafile)}.fib')
+    try:
+        with metrics.stage('cache_load'):
+            fib = LinearizedFib.load(path)
+        os.utime(path)
+        logging.warning('Loaded fib from cache file %s', path)
+        metrics.count('cache_hits')
+        return fib
+    except FileNotFoundError:
+        logging.warning('Fib for this rib not present in the cache, creating it for next time...')
+    except ValueError as e:
+        logging.warning('Discarding unreadable cache file %s: %s', path, e)
+    if deltafile:
+        fib = cached_linearized_fib(ribfile, sep, engine, cache_dir, max_entries, max_bytes, workers=workers,
+                                    reduce=reduce, memory=memory)
+        rib_dict_list = parse_rib(ribfile, sep)
+        with metrics.stage('rib_delta'):
+            fib = update_linearized_fib(fib, rib_dict_list, deltafile, sep)
+    elif memory:
+        logging.warning('Building fib out of core into cache file %s', path)
+        write_cache_file(path, lambda f: external_linearized_fib(ribfile, sep, f, memory, cache_dir))
+        evict_fib_cache(cache_dir, max_entries, max_bytes)
+        return LinearizedFib.load(path)
+    else:
+        fib = populate_linearized_fib(ribfile, sep, engine, workers, reduce)
+    logging.warning('Dumping fib to cache file %s', path)
+    with metrics.stage('cache_write'):
+        write_cache_file(path, fib.to_file)
+    evict_fib_cache(cache_dir, max_entries, max_bytes)
+    return fib
+
+
+def cached_host_table(fib, cache_dir=FIB_CACHE_DIR, max_entries=FIB_CACHE_MAX_ENTRIES, max_bytes=0):
+    """Returns the HostTable of a fib from the cache directory, memory mapped, building and caching it first if the
+    cache has no host table for the contents of the fib"""
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f'{fib.digest()}.hosts')
+    try:
+        with metrics.stage('cache_load'):
+            host_table = HostTable.load(path)
+        os.utime(path)
+        logging.warning('Loaded host table from cache file %s', path)
+        return host_table
+    except FileNotFoundError:
+        logging.warning('Host table for this fib not present in the cache, creating it for next time...')
+    except ValueError as e:
+        logging.warning('Discarding unreadable cache file %s: %s', path, e)
+    with metrics.stage('host_table'):
+        host_table = HostTable.from_fib(fib)
+    logging.warning('Dumping host table to cache file %s', path)
+    with metrics.stage('cache_write'):
+        write_cache_file(path, host_table.to_file)
+    evict_fib_cache(cache_dir, max_entries, max_bytes, '.hosts')
+    return host_table
+
+
+def attach_host_table(fib, cache_dir=None, max_entries=FIB_CACHE_MAX_ENTRIES, max_bytes=0):
+    """Gives a fib the HostTable zone_finder looks up objects within a /24 in, from the cache directory with
+    cached_host_table if cache_dir is set"""
+    if cache_dir:
+        fib.host_table = cached_host_table(fib, cache_dir, max_entries, max_bytes)
+    else:
+        with metrics.stage('host_table'):
+            fib.host_table = HostTable.from_fib(fib)
+
+
+def object_cache_key(fib, null_route):
+    """Returns the hex digest identifying the object cache of a fib: the digest of its contents and the null_route
+    setting, which both change the zones of the objects"""
+    return hashlib.sha256(f'{fib.digest()}{int(null_route)}'.encode('utf-8')).hexdigest()
+
+
+class ObjectCache:
+    """Objects resolved against one fib, kept in a file of the cache directory between runs. The (IP version, first
+    address, last address) bounds of each object string are kept, so the string is not parsed again, along with the
+    zones looked up for each bounds, with ####NULL_ROUTED####, so the object is not looked up again. Only lookups are
+    kept, since the zones an object inherits from a covering object depend on which objects are resolved together.
+    The bounds are shared with the ObjectParser of the Autozoner using the cache, which adds the strings it parses"""
+
+    def __init__(self, path, max_entries=FIB_CACHE_MAX_ENTRIES, max_bytes=0):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bounds = {}
+        self.zones = {}
+        self.changed = False
+        self.saved_objects = 0
+        try:
+            with metrics.stage('cache_load'), open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data['format'] != OBJECT_CACHE_FORMAT_VERSION:
+                raise ValueError(f'incompatible format {data["format"]}')
+            self.bounds = {x: tuple(y) for x, y in data['objects'].items()}
+            zone_sets = data['zone_sets']
+            self.zones = {tuple(x[:3]): zone_sets[x[3]] for x in data['lookups']}
+            self.saved_objects = len(self.bounds)
+            logging.warning('Loaded %d objects and %d lookups from object cache file %s', len(self.bounds),
+                            len(self.zones), path)
+        except FileNotFoundError:
+            logging.warning('No object cache for this fib, creating it for next time...')
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            logging.warning('Discarding unreadable object cache file %s: %s', path, e)
+
+    @classmethod
+    def for_fib(cls, cache_dir, fib, null_route, max_entries=FIB_CACHE_MAX_ENTRIES, max_bytes=0):
+        """Returns the object cache of a fib with the null_route setting in the cache directory"""
+        os.makedirs(cache_dir, exist_ok=True)
+        return cls(os.path.join(cache_dir, f'{object_cache_key(fib, null_route)}.objects'), max_entries, max_bytes)
+
+    def save(self):
+        """Writes the cache file if objects were added, and removes the least recently used object cache files over
+        the limits, as evict_fib_cache does for fibs"""
+        if not self.changed and len(self.bounds) == self.saved_objects:
+            if os.path.exists(self.path):
+                os.utime(self.path)
+            return
+        zone_sets = {}
+        lookups = [list(x) + [zone_sets.setdefault(tuple(sorted(y)), len(zone_sets))] for x, y in self.zones.items()]
+        logging.warning('Dumping %d objects and %d lookups to object cache file %s', len(self.bounds), len(self.zones),
+                        self.path)
+        data = {'format': OBJECT_CACHE_FORMAT_VERSION, 'zone_sets': list(zone_sets), 'objects': self.bounds,
+                'lookups': lookups}
+        with metrics.stage('cache_write'):
+            write_cache_file(self.path, lambda f: json.dump(data, f), 'w')
+        self.changed = False
+        self.saved_objects = len(self.bounds)
+        evict_fib_cache(os.path.dirname(self.path), self.max_entries, self.max_bytes, '.objects')
+
+
+def fib_total_zones(fib, null_route):
+    """Returns the zones found in a fib for each IP version, without ####NULL_ROUTED#### unless null_route is set,
+    and the set of zones of all IP versions without ####NULL_ROUTED####"""
+    total_zones = {}
+    for ver in IP_VERSIONS:
+        total_zones[ver] = list(fib.version_zones(ver))
+        if not null_route and '####NULL_ROUTED####' in total_zones[ver]:
+            total_zones[ver].remove('####NULL_ROUTED####')
+    total_zones_all_proto = set([x for xs in total_zones for x in total_zones[xs]])
+    try:
+        total_zones_all_proto.remove('####NULL_ROUTED####')
+    except KeyError:
+        pass
+    return total_zones, total_zones_all_proto
+
+
+def share_linearized_fib(fib):
+    """Copies a LinearizedFib into a new block of shared memory, in the format written by to_file, which worker
+    processes attach to by name and use in place with LinearizedFib.from_buffer. The caller closes and unlinks it"""
+    buffer = io.BytesIO()
+    fib.to_file(buffer)
+    shm = shared_memory.SharedMemory(create=True, size=buffer.tell())
+    shm.buf[:buffer.tell()] = buffer.getbuffer()
+    return shm
+
+
+_job_state = {}
+
+
+def _init_job_worker(log_level, shm_name, state):
+    """Process pool initializer for --jobs. Attaches the fib in the shared memory block shm_name, if any, and keeps
+    it along with the rest of the state the tasks of the pool need"""
+    logging.basicConfig(level=log_level, format=LOG_FORMAT)
+    if shm_name:
+        _job_state['shm'] = shared_memory.SharedMemory(name=shm_name)
+        _job_state['fib'] = LinearizedFib.from_buffer(_job_state['shm'].buf)
+    _job_state.update(state)
+
+
 def zone_finder(netobj, fib, tot_zones, null_route):
     """Takes an object and returns the possible interfaces or zones those packets might be forwarded out
-    of, based on a pseudo fib. Accepts ip_network object or a range as (ip_address, ip_address)"""
-    if type(netobj) != tuple:
-        logging.debug('Checking network %s', netobj)
-        netobj_version = netobj.version
-        if netobj.prefixlen == 0:
-            logging.debug('Object is /0 so contains all zones in the IPv%d FIB', netobj_version)
-            return tot_zones[netobj_version]
-        object_start = int(netobj.network_address)
-        object_end = int(netobj.broadcast_address)
+    of, based on a LinearizedFib. Accepts ip_network object, a range as (ip_address, ip_address) or the (IP version,
+    first address, last address) bounds returned by parse_object. The boundaries are binary searched, so the lookup
+    time does not depend on where the object sits in the address space. IPv4 objects within a /24 are read from the
+    HostTable of the fib instead if it has one"""
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    netobj_version, object_start, object_end = _object_bounds(netobj)
+    if object_start == 0 and object_end == 2 ** IP_VERSIONS[netobj_version][0] - 1:
+        if debug:
+            logging.debug('Object %s contains all address space so contains all zones in the IPv%d FIB',
+                          _object_label(netobj), netobj_version)
+        return tot_zones[netobj_version]
+    if fib.host_table is not None and netobj_version == 4 and \
+            object_start >> HOST_TABLE_BLOCK_BITS == object_end >> HOST_TABLE_BLOCK_BITS:
+        set_ids = fib.host_table.set_ids(object_start, object_end)
     else:
-        logging.debug('Checking range %s', netobj)
-        netobj_version = netobj[0].version
-        object_start = int(netobj[0])
-        object_end = int(netobj[1])
-        if object_start == 0 and object_end == (2 ** IP_VERSIONS[netobj_version][0] - 1):
-            logging.debug('Range contains all address space so contains all zones in the IPv%d FIB', netobj_version)
-            return tot_zones[netobj_version]
-    logging.debug('Object is IPv%d', netobj_version)
-    logging.debug('Looking up possible routes for object %s', netobj)
-    slice_start = 0
-    slice_end = None
-    start_found = False
-    for idx, element in enumerate(fib[netobj_version]):
-        if not start_found:
-            if object_start < element[0]:
-                slice_start = idx - 1
-                start_found = True
-            elif object_start == element[0]:
-                slice_start = idx
-                start_found = True
-        if start_found:
-            if object_end < element[0]:
-                # We are past the objective so by slicing list[x:y] we get only the zone at place y-1
-                slice_end = idx
-                break
-            elif object_end == element[0]:
-                # We are on the exact route delimiter, so we want to include it fully
-                slice_end = idx + 1
-                break
-    if slice_end == slice_start:
-        # List[x:x] doesn't return anything. Overslicing also doesn't cause any IndexError, so we can do list[x:x+1]
-        slice_end += 1
-    zones = [x for y in fib[netobj_version][slice_start:slice_end] for x in y[1]]
-    zones = list(set(zones))
-    logging.debug('Checked all zones for object %s: %s', netobj, zones)
+        boundaries = fib.boundaries[netobj_version]
+        # The last boundary at or before the start of the object carries the zones the object starts in
+        slice_start = bisect.bisect_right(boundaries, object_start) - 1
+        # By slicing list[x:y] we get the zones up to place y-1, which is the last boundary at or before the end of
+        # the object. When the object ends exactly on a route delimiter that route is included fully
+        slice_end = bisect.bisect_right(boundaries, object_end)
+        if slice_end == slice_start:
+            # List[x:x] doesn't return anything. Overslicing also doesn't cause any IndexError, so we can do
+            # list[x:x+1]
+            slice_end += 1
+        set_ids = fib.set_ids[netobj_version][slice_start:slice_end]
+    zone_set_names = fib.zone_set_names
+    zones = list({x for y in set(set_ids) for x in zone_set_names[y]})
+    if debug:
+        logging.debug('Checked all zones for object %s: %s', _object_label(netobj), zones)
+    return _null_route_filter(netobj, zones, null_route)
+
+
+def _null_route_filter(netobj, zones, null_route):
+    """Warns when some of the addresses of an object have no route, and removes ####NULL_ROUTED#### from its zones
+    unless null_route is set"""
     if '####NULL_ROUTED####' in zones:
         if len(zones) == 1:
-            logging.warning('No destinations in %s match an existing route', netobj)
+            logging.warning('No destinations in %s match an existing route', _object_label(netobj))
         else:
-            logging.warning('Some destinations in %s do not match any routes', netobj)
+            logging.warning('Some destinations in %s do not match any routes', _object_label(netobj))
         if not null_route:
             zones.remove('####NULL_ROUTED####')
     return zones
 
 
+def _object_bounds(netobj):
+    """Returns the IP version and the first and last address of an ip_network object or an (ip_address, ip_address)
+    range as integers, and bounds in that form as they are"""
+    if type(netobj) != tuple:
+        object_start = int(netobj.network_address)
+        return netobj.version, object_start, object_start | ((1 << (netobj.max_prefixlen - netobj.prefixlen)) - 1)
+    if len(netobj) == 3:
+        return netobj
+    return netobj[0].version, int(netobj[0]), int(netobj[1])
+
+
+def _object_label(netobj):
+    """Returns an object as zone_finder takes it in a form fit for the logs: bounds are written as the network they
+    span, or as a range if they span none"""
+    if type(netobj) != tuple or len(netobj) != 3:
+        return netobj
+    netobj_version, object_start, object_end = netobj
+    address = IP_ADDRESS_CLASSES[netobj_version]
+    size = object_end - object_start + 1
+    if size & (size - 1) or object_start & (size - 1):
+        return f'{address(object_start)}-{address(object_end)}'
+    return f'{address(object_start)}/{IP_VERSIONS[netobj_version][0] - size.bit_length() + 1}'
+
+
+def _numpy_keys(words, count):
+    """Returns integer addresses given as arrays of 64 bit words as a NumPy array that searchsorted can compare: the
+    words themselves for IPv4, and for IPv6 the 16 byte big endian encoding of the high and low word, whose byte-wise
+    ordering is the numeric ordering of the 128 bit addresses"""
+    if len(words) == 1:
+        return numpy.frombuffer(words[0], dtype=numpy.uint64, count=count)
+    keys = numpy.empty((count, 2), dtype='>u8')
+    keys[:, 0] = numpy.frombuffer(words[0], dtype=numpy.uint64, count=count)
+    keys[:, 1] = numpy.frombuffer(words[1], dtype=numpy.uint64, count=count)
+    return keys.view('S16').ravel()
+
+
+def batch_zone_finder(netobjs, fib, tot_zones, null_route):
+    """Resolves a list of objects at once, returning the same list of zones for each of them as zone_finder. With
+    NumPy the slice bounds of all the objects of an IP version are located with a single searchsorted against the fib
+    boundaries and the zone set IDs in every slice are deduplicated together, otherwise each object goes through
+    zone_finder"""
+    if numpy is None:
+        logging.info('NumPy not available, resolving objects one by one')
+        return [zone_finder(x, fib, tot_zones, null_route) for x in netobjs]
+    results = [None] * len(netobjs)
+    object_bounds = [_object_bounds(x) for x in netobjs]
+    for ver, bits in IP_VERSIONS.items():
+        positions = []
+        bounds = []
+        for idx, (netobj_version, object_start, object_end) in enumerate(object_bounds):
+            if netobj_version != ver:
+                continue
+            if object_start == 0 and object_end == 2 ** bits[0] - 1:
+                results[idx] = tot_zones[ver]
+                continue
+            positions.append(idx)
+            bounds.append((object_start >> 64, object_start & MASK_64, object_end >> 64, object_end & MASK_64))
+        if not positions:
+            continue
+        logging.info('Batch resolving %d IPv%d objects', len(positions), ver)
+        count = len(fib.set_ids[ver])
+        boundaries = _numpy_keys(fib.boundary_words[ver], count)
+        set_ids = numpy.frombuffer(fib.set_ids[ver], dtype=numpy.uint32, count=count)
+        words = numpy.array(bounds, dtype=numpy.uint64)
+        if bits[0] > 64:
+            object_starts = _numpy_keys([words[:, 0].copy(), words[:, 1].copy()], len(positions))
+            object_ends = _numpy_keys([words[:, 2].copy(), words[:, 3].copy()], len(positions))
+        else:
+            object_starts = words[:, 1]
+            object_ends = words[:, 3]
+        # Same slicing as zone_finder
+        slice_starts = numpy.searchsorted(boundaries, object_starts, side='right').astype(numpy.int64) - 1
+        slice_ends = numpy.searchsorted(boundaries, object_ends, side='right').astype(numpy.int64)
+        slice_ends[slice_ends == slice_starts] += 1
+        lengths = slice_ends - slice_starts
+        found = [set() for _ in positions]
+        wide = lengths > BATCH_WIDE_SLICE
+        for x in numpy.flatnonzero(wide):
+            found[x].update(numpy.unique(set_ids[slice_starts[x]:slice_ends[x]]).tolist())
+        narrow = numpy.flatnonzero(~wide)
+        if len(narrow):
+            # Expand every slice into the fib positions it covers, tagged with the object it belongs to, then
+            # deduplicate the (object, zone set ID) pairs in one pass
+            narrow_lengths = lengths[narrow]
+            owners = numpy.repeat(narrow, narrow_lengths)
+            offsets = numpy.arange(int(narrow_lengths.sum())) - numpy.repeat(numpy.cumsum(narrow_lengths) -
+                                                                              narrow_lengths, narrow_lengths)
+            pairs = owners * len(fib.zone_sets) + set_ids[numpy.repeat(slice_starts[narrow], narrow_lengths) + offsets]
+            for owner, set_id in zip(*numpy.divmod(numpy.unique(pairs), len(fib.zone_sets))):
+                found[owner].add(set_id)
+        for x, idx in enumerate(positions):
+            zones = list({y for set_id in found[x] for y in fib.zone_set_names[set_id]})
+            results[idx] = _null_route_filter(netobjs[idx], zones, null_route)
+    return results
+
+
+def _covering_objects(object_bounds):
+    """Takes the (IP version, first address, last address) bounds of objects and returns their indexes in an order
+    which puts every object after the objects covering it, along with the index of the innermost object covering
+    each object, None for the objects covered by no other. Sorting the objects by start address, and by decreasing
+    end address for the same start, gives that order, and a sweep with a stack of the objects covering the current
+    one finds the innermost in O(n log n)"""
+    order = sorted(range(len(object_bounds)), key=lambda x: (object_bounds[x][0], object_bounds[x][1],
+                                                             -object_bounds[x][2]))
+    parents = [None] * len(object_bounds)
+    stack = []
+    for idx in order:
+        netobj_version, _, object_end = object_bounds[idx]
+        while stack and (object_bounds[stack[-1]][0] != netobj_version or object_bounds[stack[-1]][2] < object_end):
+            # Objects ending before this one ends cannot cover it
+            stack.pop()
+        if stack:
+            parents[idx] = stack[-1]
+        stack.append(idx)
+    return order, parents
+
+
+def resolve_objects(netobjs, fib, tot_zones, null_route, batch=False, lookups=None):
+    """Resolves a list of distinct objects, in any of the forms zone_finder takes, and returns a dictionary mapping each
+    of them to its zones, along with the number of lookups skipped. An object covered by another object which resolves
+    to a single zone is guaranteed to resolve to the same zone, so it inherits it without a lookup. Each object is
+    assigned its innermost covering object with _covering_objects, and objects are then resolved level by level from
+    the outermost ones, with batch_zone_finder if batch is set or zone_finder otherwise. lookups, if given, maps the
+    bounds of objects to the zones previously looked up for them in the same fib, with ####NULL_ROUTED####: those are
+    not looked up again, and the new lookups are added to it"""
+    # Objects are looked up with ####NULL_ROUTED#### and it is only removed from the results at the end, since an
+    # object partly without a route is not a single-zone object even though a single zone is left once it is removed.
+    # Whether an object spanning the whole address space is partly without a route is unknown without null_route
+    if not null_route and '####NULL_ROUTED####' in fib.zone_names:
+        tot_zones = {x: list(y) + ['####NULL_ROUTED####'] for x, y in tot_zones.items()}
+    object_bounds = [_object_bounds(x) for x in netobjs]
+    order, parents = _covering_objects(object_bounds)
+    levels = []
+    depths = [0] * len(netobjs)
+    for idx in order:
+        if parents[idx] is not None:
+            depths[idx] = depths[parents[idx]] + 1
+        if depths[idx] == len(levels):
+            levels.append([])
+        levels[depths[idx]].append(idx)
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    progress = Progress('Resolved %d of at most %d objects')
+    results = [None] * len(netobjs)
+    skipped = 0
+    resolved = 0
+    for level in levels:
+        level_lookups = []
+        for idx in level:
+            parent = parents[idx]
+            if parent is not None and len(results[parent]) == 1:
+                if debug:
+                    logging.debug('Object %s is guaranteed to resolve to the same zones as %s which covers it, '
+                                  'skipping', _object_label(netobjs[idx]), _object_label(netobjs[parent]))
+                results[idx] = results[parent]
+                skipped += 1
+            elif lookups is not None and object_bounds[idx] in lookups:
+                results[idx] = lookups[object_bounds[idx]]
+            else:
+                level_lookups.append(idx)
+        if batch:
+            for idx, zones in zip(level_lookups, batch_zone_finder([netobjs[x] for x in level_lookups], fib,
+                                                                    tot_zones, True)):
+                results[idx] = zones
+            resolved += len(level_lookups)
+        else:
+            for idx in level_lookups:
+                results[idx] = zone_finder(netobjs[idx], fib, tot_zones, True)
+                resolved += 1
+                progress.update(resolved, len(netobjs) - skipped)
+        if lookups is not None:
+            lookups.update((object_bounds[x], results[x]) for x in level_lookups)
+    logging.warning('Resolved %d objects, skipped the lookup of %d objects covered by a single-zone object',
+                    resolved, skipped)
+    if not null_route:
+        results = [[x for x in zones if x != '####NULL_ROUTED####'] for zones in results]
+    return dict(zip(netobjs, results)), skipped
+
+
+def _resolve_objects_job(task):
+    """Process pool task resolving a chunk of objects with resolve_objects, given with the previous lookups of its
+    objects if any, and returning the lookups as well"""
+    netobjs, lookups = task
+    results, skipped = resolve_objects(netobjs, _job_state['fib'], _job_state['tot_zones'], _job_state['null_route'],
+                                       _job_state['batch'], lookups)
+    return results, skipped, lookups
+
+
+def parallel_resolve_objects(netobjs, fib, tot_zones, null_route, batch=False, jobs=0, lookups=None):
+    """Resolves objects like resolve_objects in a pool of worker processes, one per CPU if jobs is 0, which share the
+    fib through shared memory. Each object and the objects it covers are resolved in the same chunk, so they inherit
+    zones exactly as they would if all the objects were resolved together"""
+    jobs = jobs or os.cpu_count() or 1
+    object_bounds = [_object_bounds(x) for x in netobjs]
+    order = sorted(range(len(netobjs)), key=lambda x: (object_bounds[x][0], object_bounds[x][1], -object_bounds[x][2]))
+    # Objects covered by no other object start a new tree, and a chunk only ends between two trees
+    chunk_size = len(netobjs) // (jobs * 4) + 1
+    chunks = [[]]
+    root = None
+    for idx in order:
+        netobj_version, _, object_end = object_bounds[idx]
+        if root is None or root[0] != netobj_version or root[2] < object_end:
+            root = object_bounds[idx]
+            if len(chunks[-1]) >= chunk_size:
+                chunks.append([])
+        chunks[-1].append(netobjs[idx])
+    if lookups is None:
+        tasks = [(x, None) for x in chunks]
+    else:
+        tasks = [(x, {y: lookups[y] for y in map(_object_bounds, x) if y in lookups}) for x in chunks]
+    logging.info('Resolving %d objects in %d chunks with %d jobs', len(netobjs), len(chunks), jobs)
+    results = {}
+    skipped = 0
+    shm = share_linearized_fib(fib)
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=_init_job_worker,
+                                                    initargs=(logging.getLogger().level, shm.name,
+                                                              {'tot_zones': tot_zones, 'null_route': null_route,
+                                                               'batch': batch})) as pool:
+            for chunk_results, chunk_skipped, chunk_lookups in pool.map(_resolve_objects_job, tasks):
+                results.update(chunk_results)
+                skipped += chunk_skipped
+                if lookups is not None:
+                    lookups.update(chunk_lookups)
+    finally:
+        shm.close()
+        shm.unlink()
+    return results, skipped
+
+
+def check_protected_string(row, idx):
+    """Raises PolicyError if a row of the policy file contains the string used internally for addresses without
+    routes"""
+    for cell in row:
+        if '####NULL_ROUTED####' in cell:
+            raise PolicyError(f'Found protected string "####NULL_ROUTED####" in policy file at line {idx}. This zone '
+                              f'is used internally and cannot be present')
+
+
+def policy_columns(header, options):
+    """Finds the source and destination address columns in the header of the policy file and returns their indexes,
+    the source one being False when source zones are not analyzed, and the header of the zoned output. Raises
+    PolicyError if a column is missing or its output column is already present"""
+    if options.source:
+        logging.info('Looking for source column %s', options.source_column)
+        if options.source_column not in header:
+            raise PolicyError(f'Source column {options.source_column} not present in the file')
+        src_index = header.index(options.source_column)
+        logging.info('Found source column')
+        if f'{options.source_column}_ZONE' in header:
+            raise PolicyError(f'Output column {options.source_column}_ZONE is already present in the file')
+    else:
+        logging.info('Source address will not be analyzed')
+        src_index = False
+    logging.info('Looking for destination column %s', options.destination_column)
+    if options.destination_column not in header:
+        raise PolicyError(f'Destination column {options.destination_column} not present in the file')
+    dest_index = header.index(options.destination_column)
+    logging.info('Found destination column')
+    if f'{options.destination_column}_ZONE' in header:
+        raise PolicyError(f'Output column {options.destination_column}_ZONE is already present in the file')
+    output_header = header.copy()
+    if src_index:
+        output_header.insert(src_index, f'{options.source_column}_ZONE')
+    output_header.insert(dest_index, f'{options.destination_column}_ZONE')
+    if options.split_behavior:
+        output_header.append('SPLIT')
+    return src_index, dest_index, output_header
+
+
+class ObjectParser:
+    """Memoized parser of the address cells of the policies. Each distinct cell is split into its members, and each
+    distinct member validated and parsed into (IP version, first address, last address) bounds with parse_object,
+    only once however many policies repeat them"""
+
+    def __init__(self, bounds=None, cells=None):
+        self.bounds = {} if bounds is None else bounds
+        self.cells = {} if cells is None else cells
+
+    def parse(self, member):
+        """Returns the bounds of an object string. Raises ValueError, with the string as its message, if it is corrupt
+        or empty"""
+        try:
+            return self.bounds[member]
+        except KeyError:
+            pass
+        if not isinstance(member, str) or not member or not IP_SANITY_REGEX.match(member):
+            raise ValueError(member)
+        try:
+            bounds = self.bounds[member] = parse_object(member)
+        except ValueError:
+            raise ValueError(member) from None
+        return bounds
+
+    def members(self, cell, address_separator):
+        """Returns the members of an address cell as a tuple, parsing those not seen yet. Raises ValueError as parse
+        does for the first corrupt or empty member"""
+        cells = self.cells.setdefault(address_separator, {})
+        try:
+            return cells[cell]
+        except KeyError:
+            pass
+        members = tuple(cell.split(address_separator))
+        for member in members:
+            self.parse(member)
+        cells[cell] = members
+        return members
+
+
+def gather_objects(rows, src_index, dest_index, address_separator, start=1, progress=True, parser=None):
+    """Validates the members of the source and destination columns of the policy rows, which are consumed one at a
+    time and numbered from start, and returns a dictionary mapping each distinct member to its bounds along with the
+    number of rows. The cells are parsed with parser, an ObjectParser, so a cell or member seen before is not parsed
+    again. Raises PolicyError for a corrupt or empty member"""
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    progress = Progress('Searched %d policies for objects', progress)
+    if parser is None:
+        parser = ObjectParser()
+    columns = [(dest_index, 'destination')]
+    if src_index:
+        columns.insert(0, (src_index, 'source'))
+    objects = {}
+    seen = set()
+    idx = start - 1
+    for idx, row in enumerate(rows, start=start):
+        check_protected_string(row, idx)
+        for column, name in columns:
+            cell = row[column]
+            if cell in seen:
+                continue
+            try:
+                members = parser.members(cell, address_separator)
+            except ValueError as e:
+                raise PolicyError(f'Found corrupt or empty object "{e}" at line {idx} and {name} column {column}: '
+                                  f'{row}') from None
+            if debug:
+                logging.debug('Found %s in rulebase at line %d', members, idx)
+            seen.add(cell)
+            for member in members:
+                objects[member] = parser.bounds[member]
+        progress.update(idx)
+    return objects, idx - start + 1
+
+
+def build_zone_cache(objects, fib, tot_zones, null_route, batch=False, jobs=1, object_cache=None):
+    """Resolves objects, a dictionary mapping address strings as found in the policies to their bounds, and returns a
+    dictionary mapping each string to its zones, with parallel_resolve_objects if jobs is not 1. Strings with the same
+    bounds are resolved once. With an ObjectCache of the fib, the lookups found in it are not looked up again, and the
+    new ones are added to it"""
+    distinct = list(set(objects.values()))
+    logging.info('Resolving all objects found in policies')
+    lookups = None if object_cache is None else object_cache.zones
+    cached = 0 if lookups is None else len(lookups)
+    if jobs != 1:
+        express_cache, skipped = parallel_resolve_objects(distinct, fib, tot_zones, null_route, batch, jobs, lookups)
+    else:
+        express_cache, skipped = resolve_objects(distinct, fib, tot_zones, null_route, batch, lookups)
+    looked_up = len(distinct) - skipped
+    if object_cache is not None:
+        hits = looked_up - (len(lookups) - cached)
+        looked_up -= hits
+        object_cache.changed |= looked_up > 0
+        logging.warning('Object cache hit ratio %.1f%%: %d of %d lookups found in the cache',
+                        100 * hits / (hits + looked_up) if hits + looked_up else 100, hits, hits + looked_up)
+        metrics.count('object_cache_hits', hits)
+        metrics.count('object_cache_misses', looked_up)
+    metrics.count('lookups', looked_up)
+    metrics.count('lookups_skipped', skipped)
+    logging.info('Finished resolving objects')
+    return {x: express_cache[y] for x, y in objects.items()}
+
+
+def _zone_cell(cell, final_cache, total_zones_all_proto, options, cells):
+    """Returns the zones of an address cell of a policy, memoized in the cells dictionary, as a tuple of the sorted
+    zones, the lists of zones written in the column, the same joined with the address separator, and "all" if the
+    zones are replaced by "any" due to -a, "limit" if they are due to -z, "split" if they are split due to -z and -b
+    or None otherwise"""
+    try:
+        return cells[cell]
+    except KeyError:
+        pass
+    zones = sorted(set().union(*(final_cache[x] for x in cell.split(options.address_separator))))
+    routed = [x for x in zones if x != '####NULL_ROUTED####']
+    if options.all_zones and set(routed) == total_zones_all_proto:
+        kind, chunks = 'all', [['any']]
+    elif options.zone_limit and len(routed) > options.zone_limit:
+        if options.split_behavior:
+            kind = 'split'
+            chunks = [zones[x:x + options.zone_limit] for x in range(0, len(zones), options.zone_limit)]
+        else:
+            kind, chunks = 'limit', [['any']]
+    else:
+        kind, chunks = None, [zones]
+    cells[cell] = zones, chunks, [options.address_separator.join(x) for x in chunks], kind
+    return cells[cell]
+
+
+def zone_policy(row, src_index, dest_index, final_cache, total_zones_all_proto, options, cells=None):
+    """Adds the zones to a policy row and returns the resulting output rows, more than one when the policy is split.
+    The zones of each address cell are worked out once with _zone_cell and kept in cells, if given, for the policies
+    zoned later with the same objects and options, since rulebases repeat the same cells across many policies. The
+    row given is left as it is"""
+    if cells is None:
+        cells = {}
+    row = list(row)
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    output_rows = []
+    if debug:
+        logging.debug('Checking policy %s', row)
+    # The destination cell is read before the source zones column is inserted
+    dest_zones, dest_chunks, dest_values, dest_kind = _zone_cell(row[dest_index], final_cache, total_zones_all_proto,
+                                                                 options, cells)
+    if src_index:
+        src_zones, src_chunks, src_values, src_kind = _zone_cell(row[src_index], final_cache,
+                                                                 total_zones_all_proto, options, cells)
+        if src_kind == 'all':
+            logging.warning('Policy %s source contains all the zones, replacing with "any" due to -a flag', row)
+        elif src_kind == 'split':
+            logging.warning('Splitting policy %s due to -z and -b flag', row)
+        elif src_kind == 'limit':
+            logging.warning('Number of source zones %d for policy %s exceeds the configured maximum of %d, '
+                            'replacing with "any"', len(src_zones), row, options.zone_limit)
+        elif not src_zones:
+            logging.warning('No source zones found for policy %s, probably missing routes', row)
+        row.insert(src_index, src_chunks)
+    if dest_kind == 'all':
+        logging.warning('Policy %s destination contains all the zones, replacing with "any" due to -a flag', row)
+    elif dest_kind == 'split':
+        logging.warning('Splitting policy %s due to -z and -b flag', row)
+    elif dest_kind == 'limit':
+        logging.warning('Number of destination zones %d for policy %s exceeds the configured maximum of %d, '
+                        'replacing with "any"', len(dest_zones), row, options.zone_limit)
+    elif not dest_zones:
+        logging.error('No destination zones found for policy %s, probably missing routes', row)
+    row.insert(dest_index, dest_chunks)
+    if debug:
+        if src_index:
+            logging.debug('Source zones for policy %s: %s', row, src_zones)
+        logging.debug('Destination zones for policy %s: %s', row, dest_zones)
+    final_row = row.copy()
+    if src_index:
+        if options.split_behavior:
+            if len(src_values) > 1 or len(dest_values) > 1:
+                final_row.append('true')
+            else:
+                final_row.append('false')
+        for src_value in src_values:
+            final_row[src_index] = src_value
+            for dest_value in dest_values:
+                final_row[dest_index] = dest_value
+                output_rows.append(final_row.copy())
+    else:
+        if options.split_behavior:
+            if len(dest_values) > 1:
+                final_row.append('true')
+            else:
+                final_row.append('false')
+        for dest_value in dest_values:
+            final_row[dest_index] = dest_value
+            output_rows.append(final_row.copy())
+    return output_rows
+
+
+def _zone_policies_job(task):
+    """Process pool task returning the output rows of each policy row in a chunk with zone_policy, given the chunk
+    and the zones of its objects. The zones of the cells are kept in the worker for the next chunks, as the pool
+    zones the policies of a single run"""
+    rows, final_cache = task
+    cells = _job_state.setdefault('cells', {})
+    return [zone_policy(row, _job_state['src_index'], _job_state['dest_index'], final_cache,
+                        _job_state['total_zones_all_proto'], _job_state['options'], cells) for row in rows]
+
+
+def parallel_zone_policies(chunks, src_index, dest_index, total_zones_all_proto, options, jobs=0):
+    """Zones chunks of policy rows, given as (rows, dictionary of the zones of their objects) tuples, in a pool of
+    worker processes, one per CPU if jobs is 0, and yields the output rows of each policy in the original order, as
+    zone_policy would return them. At most two chunks per worker are in flight, so memory use does not depend on the
+    number of rows"""
+    jobs = jobs or os.cpu_count() or 1
+    in_flight = collections.deque()
+    state = {'src_index': src_index, 'dest_index': dest_index, 'total_zones_all_proto': total_zones_all_proto,
+             'options': options}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=_init_job_worker,
+                                                initargs=(logging.getLogger().level, None, state)) as pool:
+        chunks = iter(chunks)
+        while True:
+            for chunk in chunks:
+                in_flight.append(pool.submit(_zone_policies_job, chunk))
+                if len(in_flight) >= jobs * 2:
+                    break
+            if not in_flight:
+                break
+            yield from in_flight.popleft().result()
+
+
+def zone_row_options(options=None):
+    """Returns the options of zone_policy and policy_columns as an object with attributes, from ZONE_ROW_DEFAULTS
+    updated with options, a dictionary or an object such as the parsed command line arguments"""
+    merged = dict(ZONE_ROW_DEFAULTS)
+    if isinstance(options, dict):
+        merged.update(options)
+    elif options is not None:
+        merged.update({x: getattr(options, x) for x in ZONE_ROW_DEFAULTS})
+    return argparse.Namespace(**merged)
+
+
+class Autozoner:
+    """Zones firewall policies against a LinearizedFib. The zones of every object resolved are kept, so a built fib
+    can be reused for many policy sets without loading it or resolving the same objects again:
+
+    autozoner = Autozoner.from_rib('rib-example.csv')
+    autozoner.resolve('192.0.2.0/24')
+    for row in autozoner.zone_rows(csv.reader(f), {'source': True}):
+
+    The objects and cells already parsed by the ObjectParser parser, if given, are not parsed again
+    """
+
+    def __init__(self, fib, null_route=False, batch=False, jobs=1, object_cache=None, parser=None):
+        self.fib = fib
+        self.null_route = null_route
+        self.batch = batch
+        self.jobs = jobs
+        self.object_cache = object_cache
+        self.total_zones, self.total_zones_all_proto = fib_total_zones(fib, null_route)
+        self.cache = {}
+        self.parser = ObjectParser(None if object_cache is None else object_cache.bounds)
+        if parser is not None:
+            self.parser.bounds.update(parser.bounds)
+            self.parser.cells = parser.cells
+
+    @classmethod
+    def from_rib(cls, ribfile, sep=',', engine='sweep', deltafile=None, workers=1, cache_dir=None,
+                 cache_max_entries=FIB_CACHE_MAX_ENTRIES, cache_max_bytes=0, null_route=False, batch=False, jobs=1,
+                 object_cache_dir=None, host_table=False, reduce=False, fib_memory=0):
+        """Builds the fib of a csv file as in '192.0.2.0/24, IFACE_OR_ZONE', updated with the rib delta file if any.
+        With cache_dir the fib is taken from the fib cache in that directory, or built and added to it. With
+        object_cache_dir the objects are resolved with the ObjectCache of the fib in that directory, which
+        save_object_cache writes back. With host_table the fib is given a HostTable, cached along with it. With reduce
+        the routes are reduced with reduce_rib before being flattened, which gives the same fib. With fib_memory the fib
+        is built out of core in about that many bytes, as external_linearized_fib does"""
+        if fib_memory and (engine != 'sweep' or workers != 1 or reduce):
+            logging.warning('The out of core build flattens the routes with the sweep engine in a single process, '
+                            'without reducing them')
+        if cache_dir:
+            fib = cached_linearized_fib(ribfile, sep, engine, cache_dir, cache_max_entries, cache_max_bytes, deltafile,
+                                        workers, reduce, fib_memory)
+        else:
+            fib = populate_linearized_fib(ribfile, sep, engine, workers, reduce, fib_memory)
+            if deltafile:
+                rib_dict_list = parse_rib(ribfile, sep)
+                with metrics.stage('rib_delta'):
+                    fib = update_linearized_fib(fib, rib_dict_list, deltafile, sep)
+        if host_table:
+            attach_host_table(fib, cache_dir, cache_max_entries, cache_max_bytes)
+        object_cache = None
+        if object_cache_dir:
+            object_cache = ObjectCache.for_fib(object_cache_dir, fib, null_route, cache_max_entries, cache_max_bytes)
+        return cls(fib, null_route, batch, jobs, object_cache)
+
+    @classmethod
+    def from_options(cls, options):
+        """Builds the fib as set by the parsed command line arguments"""
+        return cls.from_rib(options.rib, options.csv_separator, options.fib_engine, options.rib_delta,
+                            options.fib_workers, options.cache_dir if options.pickled_fib else None,
+                            options.cache_max_entries, options.cache_max_mb * 2 ** 20, options.null_route,
+                            options.batch_resolve, options.jobs, options.cache_dir if options.object_cache else None,
+                            options.host_table, options.reduce_rib, options.fib_memory_mb * 2 ** 20)
+
+    def resolve_all(self, objects):
+        """Returns a dictionary mapping each object string, written as in the policies, to its zones. The objects not
+        resolved yet are parsed with the ObjectParser of the Autozoner, which keeps them for the next policies, and
+        resolved together, so covering objects are looked up once for all the objects they cover. The lists of zones
+        returned are copies, which the caller can change"""
+        missing = {}
+        for member in objects:
+            if member not in self.cache:
+                try:
+                    missing[member] = self.parser.parse(member)
+                except ValueError:
+                    raise PolicyError(f'Found corrupt or empty object "{member}"') from None
+        if missing:
+            self.cache.update(build_zone_cache(missing, self.fib, self.total_zones, self.null_route, self.batch,
+                                               self.jobs, self.object_cache))
+        return {x: list(self.cache[x]) for x in objects}
+
+    def save_object_cache(self):
+        """Writes the objects resolved so far to the object cache file, if the object cache is used"""
+        if self.object_cache is not None:
+            self.object_cache.save()
+
+    def resolve(self, member):
+        """Returns a copy of the list of zones of one object string"""
+        return self.resolve_all([member])[member]
+
+    def _resolved_chunks(self, rows, src_index, dest_index, options):
+        """Yields the rows in chunks of POLICY_CHUNK_ROWS, with the zones of the objects of each chunk"""
+        idx = 1
+        while True:
+            chunk = [row for _, row in zip(range(POLICY_CHUNK_ROWS), rows)]
+            if not chunk:
+                return
+            objects, _ = gather_objects(chunk, src_index, dest_index, options.address_separator, idx, False,
+                                        self.parser)
+            yield chunk, self.resolve_all(objects)
+            idx += len(chunk)
+
+    def zone_rows(self, rows, options=None):
+        """Zones policy rows, the first of which is the header, and yields the output header and then the output
+        rows. The options are those of zone_row_options. Rows are consumed lazily, a chunk of POLICY_CHUNK_ROWS at a
+        time, and the objects of each chunk not resolved yet are resolved together. Raises PolicyError for policies
+        which cannot be zoned"""
+        options = zone_row_options(options)
+        rows = iter(rows)
+        header = next(rows, [])
+        check_protected_string(header, 0)
+        src_index, dest_index, output_header = policy_columns(header, options)
+        yield output_header
+        chunks = self._resolved_chunks(rows, src_index, dest_index, options)
+        if self.jobs != 1:
+            policies = parallel_zone_policies(chunks, src_index, dest_index, self.total_zones_all_proto, options,
+                                              self.jobs)
+        else:
+            cells = {}
+            policies = (zone_policy(row, src_index, dest_index, self.cache, self.total_zones_all_proto, options,
+                                    cells) for chunk, _ in chunks for row in chunk)
+        progress = Progress('Done checking %d policies')
+        idx = 0
+        rows_out = 0
+        split = 0
+        for idx, output_rows in enumerate(policies, start=1):
+            yield from output_rows
+            rows_out += len(output_rows)
+            if len(output_rows) > 1:
+                split += 1
+            progress.update(idx)
+        metrics.count('policies', idx)
+        metrics.count('output_rows', rows_out)
+        metrics.count('policies_split', split)
+
+
+def gather_policy_file(options, parser=None):
+    """Reads the policy file options.input and returns the distinct members of its address columns, mapped to their
+    bounds, along with the number of policies, as gather_objects does with the ObjectParser parser. Raises
+    PolicyError for policies which cannot be zoned"""
+    logging.info('Opening file %s', options.input)
+    with open(options.input, 'r', encoding='utf-8') as f:
+        reader = csv.reader(f, delimiter=options.csv_separator)
+        header = next(reader, [])
+        check_protected_string(header, 0)
+        src_index, dest_index, _ = policy_columns(header, options)
+        logging.info('Gathering all sources and destinations')
+        return gather_objects(reader, src_index, dest_index, options.address_separator, parser=parser)
+
+
+def write_zoned_file(autozoner, options):
+    """Zones the policy file options.input into options.output_file with Autozoner.zone_rows and returns the number
+    of output rows. The output is written to a temporary file which replaces options.output_file once complete"""
+    logging.info('Writing csv to file %s', options.output_file)
+    tmp_output = f'{options.output_file}.{os.getpid()}.tmp'
+    output_rows = -1
+    try:
+        with open(options.input, 'r', encoding='utf-8') as f, \
+                open(tmp_output, 'w', newline='', encoding='utf-8') as o:
+            writer = csv.writer(o, delimiter=options.csv_separator)
+            for row in autozoner.zone_rows(csv.reader(f, delimiter=options.csv_separator), options):
+                writer.writerow(row)
+                output_rows += 1
+    except BaseException:
+        if os.path.exists(tmp_output):
+            os.remove(tmp_output)
+        raise
+    os.replace(tmp_output, options.output_file)
+    return output_rows
+
+
+def impacted_objects(objects, intervals, old, new):
+    """Returns the object strings of objects, mapped to their bounds as gather_objects returns them, whose zones
+    differ between the Autozoners old and new, whose fibs differ only within the intervals, sorted and disjoint
+    (first, last) address tuples for each IP version, and a function returning the strings and bounds of the given
+    objects along with those of the objects covering them. The objects
+    overlapping an interval are resolved in both fibs, along with the objects covering them, which overlap it too.
+    An object outside the intervals looks up the same zones in both fibs, so its zones can only change when it
+    inherits them from a covering object whose zones changed, and only those objects are looked up"""
+    distinct = list(set(objects.values()))
+    positions = {x: idx for idx, x in enumerate(distinct)}
+    order, parents = _covering_objects(distinct)
+    interval_starts = {ver: [x[0] for x in intervals[ver]] for ver in IP_VERSIONS}
+    overlapping = []
+    for idx in order:
+        netobj_version, object_start, object_end = distinct[idx]
+        # The last interval starting before the end of the object is the only one which can overlap it
+        interval = bisect.bisect_right(interval_starts[netobj_version], object_end) - 1
+        if interval >= 0 and intervals[netobj_version][interval][1] >= object_start:
+            overlapping.append(idx)
+    old_zones = [None] * len(distinct)
+    new_zones = [None] * len(distinct)
+    for autozoner, zones in ((old, old_zones), (new, new_zones)):
+        resolved, _ = resolve_objects([distinct[x] for x in overlapping], autozoner.fib, autozoner.total_zones,
+                                      autozoner.null_route, autozoner.batch)
+        for idx in overlapping:
+            zones[idx] = resolved[distinct[idx]]
+    changed = [old_zones[x] is not None and set(old_zones[x]) != set(new_zones[x]) for x in range(len(distinct))]
+    for idx in order:
+        parent = parents[idx]
+        if old_zones[idx] is not None or parent is None or not changed[parent]:
+            continue
+        if len(old_zones[parent]) == 1 and len(new_zones[parent]) == 1:
+            own_zones = None
+        else:
+            own_zones = zone_finder(distinct[idx], old.fib, old.total_zones, old.null_route)
+        old_zones[idx] = old_zones[parent] if len(old_zones[parent]) == 1 else own_zones
+        new_zones[idx] = new_zones[parent] if len(new_zones[parent]) == 1 else own_zones
+        changed[idx] = set(old_zones[idx]) != set(new_zones[idx])
+
+    def with_covering(members):
+        covering = set()
+        for idx in (positions[objects[x]] for x in members):
+            while idx is not None and idx not in covering:
+                covering.add(idx)
+                idx = parents[idx]
+        return {x: bounds for x, bounds in objects.items() if positions[bounds] in covering}
+
+    return {x for x, bounds in objects.items() if changed[positions[bounds]]}, with_covering
+
+
+def write_impact_file(old, new, intervals, options):
+    """Writes to options.output_file the policies of options.input whose zones differ between the Autozoners old and
+    new, whose fibs differ only within intervals as given to impacted_objects, and returns their number. Each policy
+    is written as its output rows with the old zones and then with the new zones, marked "old" and "new" in an added
+    IMPACT column. Only the policies with an object whose zones change are zoned, and only their objects and the
+    objects covering them are resolved, which resolves them as a run zoning all the policies would. Raises
+    PolicyError for policies which cannot be zoned"""
+    objects, policy_count = gather_policy_file(options, old.parser)
+    if options.all_zones and old.total_zones_all_proto != new.total_zones_all_proto:
+        logging.warning('The zones of the fib changed, so every policy can be replaced by "any" due to -a flag')
+        changing = set(objects)
+
+        def with_covering(_):
+            return objects
+    else:
+        changing, with_covering = impacted_objects(objects, intervals, old, new)
+    logging.warning('The zones of %d of %d objects change', len(changing), len(objects))
+    with open(options.input, 'r', encoding='utf-8') as f:
+        reader = csv.reader(f, delimiter=options.csv_separator)
+        header = next(reader, [])
+        src_index, dest_index, output_header = policy_columns(header, options)
+        needed = set()
+        for row in reader:
+            members = old.parser.members(row[dest_index], options.address_separator)
+            if src_index:
+                members += old.parser.members(row[src_index], options.address_separator)
+            if not changing.isdisjoint(members):
+                needed.update(members)
+    needed = with_covering(needed)
+    old.resolve_all(needed)
+    new.resolve_all(needed)
+    needed = set(needed)
+    logging.info('Writing csv to file %s', options.output_file)
+    tmp_output = f'{options.output_file}.{os.getpid()}.tmp'
+    changed = 0
+    old_cells = {}
+    new_cells = {}
+    try:
+        with open(options.input, 'r', encoding='utf-8') as f, \
+                open(tmp_output, 'w', newline='', encoding='utf-8') as o:
+            reader = csv.reader(f, delimiter=options.csv_separator)
+            next(reader, [])
+            writer = csv.writer(o, delimiter=options.csv_separator)
+            writer.writerow(output_header + ['IMPACT'])
+            for row in reader:
+                members = old.parser.members(row[dest_index], options.address_separator)
+                if src_index:
+                    members += old.parser.members(row[src_index], options.address_separator)
+                if not needed.issuperset(members):
+                    continue
+                old_rows = zone_policy(list(row), src_index, dest_index, old.cache, old.total_zones_all_proto,
+                                       options, old_cells)
+                new_rows = zone_policy(list(row), src_index, dest_index, new.cache, new.total_zones_all_proto,
+                                       options, new_cells)
+                if old_rows != new_rows:
+                    writer.writerows(x + ['old'] for x in old_rows)
+                    writer.writerows(x + ['new'] for x in new_rows)
+                    changed += 1
+    except BaseException:
+        if os.path.exists(tmp_output):
+            os.remove(tmp_output)
+        raise
+    os.replace(tmp_output, options.output_file)
+    logging.warning('The zones of %d of %d policies change', changed, policy_count)
+    return changed
+
+
+def _offset_lines(f, offsets):
+    """Yields the lines of a binary file decoded as utf-8, appending the offset each starts at to offsets"""
+    while True:
+        offset = f.tell()
+        line = f.readline()
+        if not line:
+            return
+        offsets.append(offset)
+        yield line.decode('utf-8')
+
+
+def _max_tree(values):
+    """Returns the implicit binary tree of the maxima of values: node 1 is the root, the children of node i are 2i and
+    2i + 1, and the leaves are values, from node len(values)"""
+    size = len(values)
+    tree = [0] * size + list(values)
+    for node in range(size - 1, 0, -1):
+        tree[node] = max(tree[2 * node], tree[2 * node + 1])
+    return tree
+
+
+def _max_tree_at_least(tree, count, value):
+    """Returns the indexes of the first count values of a _max_tree which are at least value, in any order. Only the
+    subtrees whose maximum is at least value are visited, so it takes O((m + 1) log n) for m indexes found"""
+    size = len(tree) // 2
+    nodes = []
+    lo, hi = size, size + count
+    while lo < hi:
+        if lo & 1:
+            nodes.append(lo)
+            lo += 1
+        if hi & 1:
+            hi -= 1
+            nodes.append(hi)
+        lo >>= 1
+        hi >>= 1
+    found = []
+    while nodes:
+        node = nodes.pop()
+        if tree[node] >= value:
+            if node >= size:
+                found.append(node - size)
+            else:
+                nodes.extend((2 * node, 2 * node + 1))
+    return found
+
+
+class PolicyIndex:
+    """Reverse index of a policy file zoned against a fib, answering which policies have an object overlapping,
+    covering or within an address range, or have a zone, without zoning the policies again. For each IP version the
+    distinct objects are sorted by start address, and a _max_tree of their end addresses is built on load, so the
+    objects covering an address are found among those starting before it without scanning them, and the objects
+    starting within a range by binary search. Since rulebases repeat the same address cells across many policies,
+    each object and each zone lists the distinct cells it is found in, and each policy its destination and source
+    cells. The policies are numbered as in the errors, from 1 after the header, and the offset of each in the file is
+    kept so that the matching policies are read back without keeping the rows:
+
+    index = PolicyIndex.from_policy_file(autozoner, options)
+    index.object_lines('10.64.0.0/17', 'cover')
+    """
+
+    def __init__(self, data):
+        self.header = data['header']
+        self.src_index, self.dest_index = data['columns']
+        self.offsets = data['offsets']
+        self.zone_sets = data['zone_sets']
+        self.cell_zones = data['cell_zones']
+        self.row_cells = data['row_cells']
+        self.objects = {int(x): y for x, y in data['objects'].items()}
+        self.end_trees = {x: _max_tree(y['ends']) for x, y in self.objects.items()}
+        # The policies of each cell and the cells of each zone are worked out again on load rather than stored
+        self.cell_rows = [{}, {}]
+        for column, cells in enumerate(self.row_cells):
+            for idx, cell in enumerate(cells, start=1):
+                self.cell_rows[column].setdefault(cell, []).append(idx)
+        self.zones = {}
+        for cell, zone_set in enumerate(self.cell_zones):
+            for zone in self.zone_sets[zone_set]:
+                self.zones.setdefault(zone, []).append(cell)
+
+    @classmethod
+    def from_policy_file(cls, autozoner, options):
+        """Indexes the policy file options.input, with the columns and separators of options, resolving its objects
+        with the Autozoner, which keeps them. Raises PolicyError for policies which cannot be zoned"""
+        logging.info('Opening file %s', options.input)
+        offsets = []
+        row_offsets = []
+        cells = {}
+        row_cells = [[], []]
+
+        def indexed_rows():
+            # Only the offset of each policy and the IDs of its distinct cells are kept, the rows are not
+            while True:
+                offsets.clear()
+                row = next(reader, None)
+                if row is None:
+                    return
+                row_offsets.append(offsets[0])
+                yield row
+                for column, cell_index in enumerate(columns):
+                    row_cells[column].append(cells.setdefault(row[cell_index], len(cells)))
+
+        with open(options.input, 'rb') as f:
+            reader = csv.reader(_offset_lines(f, offsets), delimiter=options.csv_separator)
+            header = next(reader, [])
+            check_protected_string(header, 0)
+            src_index, dest_index, output_header = policy_columns(header, zone_row_options(
+                {x: getattr(options, x) for x in ('source', 'source_column', 'destination_column')}))
+            columns = [dest_index] + ([src_index] if src_index else [])
+            objects, policy_count = gather_objects(indexed_rows(), src_index, dest_index, options.address_separator,
+                                                   parser=autozoner.parser)
+        cache = autozoner.resolve_all(objects)
+        zone_sets = {}
+        cell_zones = []
+        object_cells = {}
+        for cell, cell_id in cells.items():
+            members = autozoner.parser.members(cell, options.address_separator)
+            for netobj in set(objects[x] for x in members):
+                object_cells.setdefault(netobj, []).append(cell_id)
+            zones = tuple(sorted(set().union(*(cache[x] for x in members))))
+            cell_zones.append(zone_sets.setdefault(zones, len(zone_sets)))
+        index = {}
+        for ver in IP_VERSIONS:
+            netobjs = sorted((x for x in object_cells if x[0] == ver), key=lambda x: (x[1], -x[2]))
+            index[ver] = {'starts': [x[1] for x in netobjs], 'ends': [x[2] for x in netobjs],
+                          'cells': [object_cells[x] for x in netobjs]}
+        logging.warning('Indexed %d objects in %d distinct cells of %d policies', len(object_cells), len(cells),
+                        policy_count)
+        return cls({'header': output_header, 'columns': [src_index, dest_index], 'offsets': row_offsets,
+                    'zone_sets': list(zone_sets), 'cell_zones': cell_zones, 'row_cells': row_cells,
+                    'objects': index})
+
+    @classmethod
+    def load(cls, path):
+        """Reads an index written by to_file. Raises ValueError if the file is not a valid index"""
+        with open(path, 'r', encoding='utf-8') as f:
+            try:
+                data = json.load(f)
+                if data['format'] != POLICY_INDEX_FORMAT_VERSION:
+                    raise ValueError(f'incompatible format {data["format"]}')
+                return cls(data)
+            except (KeyError, IndexError, TypeError) as e:
+                raise ValueError(f'invalid index: {e}') from None
+
+    def to_file(self, f):
+        """Writes the index as JSON to a text file"""
+        f.write(json.dumps({'format': POLICY_INDEX_FORMAT_VERSION, 'header': self.header,
+                            'columns': [self.src_index, self.dest_index], 'offsets': self.offsets,
+                            'zone_sets': self.zone_sets, 'cell_zones': self.cell_zones, 'row_cells': self.row_cells,
+                            'objects': self.objects}, separators=(',', ':')))
+
+    def _lines(self, cells, column):
+        """Returns the sorted numbers of the policies with one of the cells in the "source" or "destination" column,
+        or in either if column is None"""
+        lines = set()
+        for position in [0, 1] if column is None else [['destination', 'source'].index(column)]:
+            cell_rows = self.cell_rows[position]
+            for cell in cells:
+                lines.update(cell_rows.get(cell, ()))
+        return sorted(lines)
+
+    def object_lines(self, member, match='overlap', column=None):
+        """Returns the sorted numbers of the policies with an object overlapping, covering or within an object string
+        written as in the policies, as set by match, one of QUERY_MATCHES, in the "source" or "destination" column or
+        in either if column is None. Raises PolicyError if the object is corrupt"""
+        try:
+            netobj_version, query_start, query_end = ObjectParser().parse(member)
+        except ValueError:
+            raise PolicyError(f'Found corrupt or empty query "{member}"') from None
+        index = self.objects[netobj_version]
+        starts = index['starts']
+        ends = index['ends']
+        # The objects starting at or before the start of the query which end at or after an address cover it
+        before = bisect.bisect_right(starts, query_start)
+        if match == 'cover':
+            found = _max_tree_at_least(self.end_trees[netobj_version], before, query_end)
+        elif match == 'within':
+            found = [x for x in range(bisect.bisect_left(starts, query_start), bisect.bisect_right(starts, query_end))
+                     if ends[x] <= query_end]
+        else:
+            found = _max_tree_at_least(self.end_trees[netobj_version], before, query_start) + \
+                list(range(before, bisect.bisect_right(starts, query_end)))
+        return self._lines({x for idx in found for x in index['cells'][idx]}, column)
+
+    def zone_lines(self, zone, column=None):
+        """Returns the sorted numbers of the policies with zone in the zones of the "source" or "destination" column,
+        or of either if column is None"""
+        return self._lines(self.zones.get(zone, []), column)
+
+    def rows(self, path, lines, csv_separator=',', address_separator=';'):
+        """Reads the policies numbered lines from the policy file indexed, at path, and yields them with the zones of
+        their address columns added as in the zoned output, all the zones of each joined with the address
+        separator"""
+        with open(path, 'rb') as f:
+            for line in lines:
+                f.seek(self.offsets[line - 1])
+                row = next(csv.reader(_offset_lines(f, []), delimiter=csv_separator))
+                zone_sets = [self.zone_sets[self.cell_zones[x[line - 1]]] for x in self.row_cells if x]
+                if self.src_index:
+                    row.insert(self.src_index, address_separator.join(zone_sets[1]))
+                row.insert(self.dest_index, address_separator.join(zone_sets[0]))
+                yield row
+
+
+def policy_index_key(options):
+    """Returns the hex digest identifying the PolicyIndex of the policy file options.input: the hash of its contents,
+    of the fib_cache_key of the rib and rib delta files, and of the options changing the columns and zones indexed"""
+    prefix = (f'{POLICY_INDEX_FORMAT_VERSION}\x00{fib_cache_key(options.rib, options.csv_separator, options.rib_delta)}'
+              f'\x00{int(options.null_route)}\x00{options.source and options.source_column}\x00'
+              f'{options.destination_column}\x00{options.csv_separator}\x00{options.address_separator}')
+    return file_digest(prefix, options.input)
+
+
+def cached_policy_index(options):
+    """Returns the PolicyIndex of the policy file options.input from the cache directory options.cache_dir, building
+    and caching it first if the cache has no index for the current contents of the policy and rib files. The
+    objects are resolved by the Autozoner of the command line options, so the fib cache and the object cache are
+    used as set by them"""
+    os.makedirs(options.cache_dir, exist_ok=True)
+    path = os.path.join(options.cache_dir, f'{policy_index_key(options)}.index')
+    try:
+        with metrics.stage('cache_load'):
+            index = PolicyIndex.load(path)
+        os.utime(path)
+        logging.warning('Loaded policy index from cache file %s', path)
+        return index
+    except FileNotFoundError:
+        logging.warning('Index for these policies not present in the cache, creating it for next time...')
+    except ValueError as e:
+        logging.warning('Discarding unreadable cache file %s: %s', path, e)
+    autozoner = Autozoner.from_options(options)
+    with metrics.stage('policy_index'):
+        index = PolicyIndex.from_policy_file(autozoner, options)
+    autozoner.save_object_cache()
+    logging.warning('Dumping policy index to cache file %s', path)
+    with metrics.stage('cache_write'):
+        write_cache_file(path, index.to_file, 'w')
+    evict_fib_cache(options.cache_dir, options.cache_max_entries, options.cache_max_mb * 2 ** 20, '.index')
+    return index
+
+
+class ZoneService:
+    """State of the zone lookup server: an Autozoner for the rib file in the command line options, which is built
+    again when the rib file or the rib delta file changes"""
+
+    def __init__(self, options):
+        self.options = options
+        self.lock = threading.Lock()
+        self.stamp = None
+        self.autozoner = None
+        self.reloading = False
+        self.refresh()
+
+    def file_stamp(self):
+        """Returns the modification time and size of the rib file and of the rib delta file"""
+        return [(os.stat(x).st_mtime_ns, os.stat(x).st_size) for x in (self.options.rib, self.options.rib_delta) if x]
+
+    def refresh(self):
+        """Reloads the fib if the rib or rib delta file changed since it was loaded and returns the Autozoner. The new
+        Autozoner is built outside the lock by a single request, the others being answered with the previous one
+        meanwhile, and swapped in when it is ready. If the files cannot be loaded the previous fib is kept until they
+        change again, and while they cannot be read, as when the rib file is being replaced, the previous fib is
+        served"""
+        try:
+            stamp = self.file_stamp()
+        except OSError as e:
+            with self.lock:
+                if self.autozoner is None:
+                    raise
+                logging.warning('Could not read the rib file, serving the previous fib: %s', e)
+                return self.autozoner
+        with self.lock:
+            if stamp == self.stamp or self.reloading:
+                return self.autozoner
+            self.reloading = True
+            autozoner = self.autozoner
+        try:
+            if autozoner is not None:
+                logging.warning('Rib file changed, reloading the fib')
+            try:
+                autozoner = Autozoner.from_options(self.options)
+            except (Exception, SystemExit):
+                if autozoner is None:
+                    raise
+                logging.exception('Could not reload the fib, keeping the previous one')
+            with self.lock:
+                self.autozoner = autozoner
+                self.stamp = stamp
+        finally:
+            with self.lock:
+                self.reloading = False
+        return autozoner
+
+    def zones(self, objects):
+        """Returns a dictionary mapping each object string, written as in the policies, to its sorted zones"""
+        return {x: sorted(zones) for x, zones in self.refresh().resolve_all(objects).items()}
+
+    def zone_rows(self, header, rows, overrides=None):
+        """Zones policy rows as the command line does, with the options of zone_row_options in overrides replacing
+        those of the command line, and returns the output header and rows"""
+        options = {x: getattr(self.options, x) for x in ZONE_ROW_DEFAULTS}
+        for key, value in (overrides or {}).items():
+            if key not in ZONE_ROW_DEFAULTS:
+                raise PolicyError(f'Option {key} cannot be set per request')
+            options[key] = value
+        output = list(self.refresh().zone_rows([header] + list(rows), options))
+        return output[0], output[1:]
+
+
+def _request_list(request, key, item_type):
+    """Returns the list under key in a JSON request. Raises TypeError if it is not a list of item_type, so that a
+    single string is not taken for a list of its characters"""
+    value = request[key]
+    if not isinstance(value, list) or not all(isinstance(x, item_type) for x in value):
+        raise TypeError(f'{key} must be a list of {"strings" if item_type is str else "lists"}')
+    return value
+
+
+class ZoneRequestHandler(http.server.BaseHTTPRequestHandler):
+    """JSON API of the zone lookup server:
+    GET /status returns the rib file and the number of fib boundaries of each IP version
+    POST /zones with { "objects": [ "192.0.2.0/24", "192.0.2.10-192.0.2.100" ] } returns { "zones": { object: zones } }
+    POST /zone-rows with { "header": [ ... ], "rows": [ [ ... ] ], "options": { ... } } returns the zoned
+    { "header": [ ... ], "rows": [ [ ... ] ] }, the options being any of ZONE_ROW_DEFAULTS"""
+
+    def log_message(self, format, *args):
+        logging.info('%s %s', self.client_address[0] if self.client_address else 'unix', format % args)
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != '/status':
+            self.send_json(404, {'error': f'Unknown path {self.path}'})
+            return
+        service = self.server.zone_service
+        fib = service.refresh().fib
+        self.send_json(200, {'rib': service.options.rib, 'rib_delta': service.options.rib_delta,
+                             'boundaries': {ver: len(fib.set_ids[ver]) for ver in IP_VERSIONS}})
+
+    def do_POST(self):
+        service = self.server.zone_service
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if self.path == '/zones':
+                self.send_json(200, {'zones': service.zones(_request_list(request, 'objects', str))})
+            elif self.path == '/zone-rows':
+                header, rows = service.zone_rows(_request_list(request, 'header', str),
+                                                 _request_list(request, 'rows', list), request.get('options'))
+                self.send_json(200, {'header': header, 'rows': rows})
+            else:
+                self.send_json(404, {'error': f'Unknown path {self.path}'})
+        except (PolicyError, ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+            logging.error('Bad request to %s: %s', self.path, e)
+            self.send_json(400, {'error': f'{type(e).__name__}: {e}'})
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP server listening on a Unix socket"""
+    daemon_threads = True
+
+
+def serve(options):
+    """Runs the zone lookup server until interrupted, listening for HTTP on options.serve if it is HOST:PORT, or on
+    the Unix socket at that path otherwise"""
+    service = ZoneService(options)
+    if SERVE_ADDRESS_REGEX.match(options.serve):
+        host, _, port = options.serve.rpartition(':')
+        server = http.server.ThreadingHTTPServer((host, int(port)), ZoneRequestHandler)
+    else:
+        if os.path.exists(options.serve) and stat.S_ISSOCK(os.stat(options.serve).st_mode):
+            logging.info('Removing stale socket %s', options.serve)
+            os.remove(options.serve)
+        server = UnixHTTPServer(options.serve, ZoneRequestHandler)
+    server.zone_service = service
+    logging.warning('Serving zone lookups on %s', options.serve)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.warning('Stopping the server')
+    finally:
+        server.server_close()
+        if not SERVE_ADDRESS_REGEX.match(options.serve):
+            os.remove(options.serve)
+
+
+def read_manifest(path, defaults):
+    """Reads a JSON manifest, a list of jobs each setting the rib, input and output_file of the job and optionally
+    other MANIFEST_JOB_KEYS, and returns the options of each job as a namespace, the command line arguments in
+    defaults filling in those the job does not set"""
+    with open(path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if not isinstance(manifest, list) or not all(isinstance(x, dict) for x in manifest):
+        logging.critical('Manifest %s must be a list of jobs. Exiting...', path)
+        sys.exit(1)
+    jobs = []
+    outputs = set()
+    for idx, job in enumerate(manifest, start=1):
+        unknown = sorted(set(job) - set(MANIFEST_JOB_KEYS))
+        if unknown:
+            logging.critical('Unknown option %s in job %d of manifest %s. Exiting...', unknown[0], idx, path)
+            sys.exit(1)
+        for key in ('rib', 'input', 'output_file'):
+            if not job.get(key):
+                logging.critical('Job %d of manifest %s has no %s. Exiting...', idx, path, key)
+                sys.exit(1)
+        if job['output_file'] in outputs:
+            logging.critical('Job %d of manifest %s writes to the output file %s of another job. Exiting...', idx,
+                             path, job['output_file'])
+            sys.exit(1)
+        outputs.add(job['output_file'])
+        options = argparse.Namespace(**vars(defaults))
+        vars(options).update(job)
+        options.jobs = 1
+        jobs.append(options)
+    return jobs
+
+
+def _run_manifest_group(task):
+    """Runs the jobs of a manifest which share a fib, given as (job number, options, policy file number, objects,
+    number of policies, ObjectParser) tuples, and returns their summaries. The fib is built or loaded once, and the
+    objects of a policy file are resolved once for all the jobs using it with the same null_route setting, without
+    parsing them again as the ObjectParser which gathered them already holds them. The objects of different policy
+    files are resolved separately, as each would be in a run of its own, since an object inherits the zones of the
+    objects covering it which are resolved along with it"""
+    summaries = {}
+    first = task[0][1]
+    try:
+        autozoner = Autozoner.from_options(first)
+    except (Exception, SystemExit) as e:
+        logging.error('Could not build the fib of rib %s: %s', first.rib, e)
+        return {x[0]: {'status': 'error', 'error': f'Could not build the fib: {e}'} for x in task}
+    fib = autozoner.fib
+    object_caches = {first.null_route: autozoner.object_cache}
+    autozoners = {}
+    for idx, options, policy, objects, policy_count, parser in task:
+        if options.null_route not in object_caches:
+            object_caches[options.null_route] = None
+            if options.object_cache:
+                object_caches[options.null_route] = ObjectCache.for_fib(options.cache_dir, fib, options.null_route,
+                                                                        options.cache_max_entries,
+                                                                        options.cache_max_mb * 2 ** 20)
+        if (policy, options.null_route) not in autozoners:
+            autozoners[policy, options.null_route] = Autozoner(fib, options.null_route, options.batch_resolve,
+                                                               object_cache=object_caches[options.null_route],
+                                                               parser=parser)
+            autozoners[policy, options.null_route].resolve_all(objects)
+        start = time.perf_counter()
+        try:
+            output_rows = write_zoned_file(autozoners[policy, options.null_route], options)
+        except (PolicyError, OSError) as e:
+            logging.error('Job %d failed: %s', idx, e)
+            summaries[idx] = {'status': 'error', 'error': str(e)}
+            continue
+        summaries[idx] = {'status': 'ok', 'policies': policy_count, 'objects': len(objects),
+                          'output_rows': output_rows, 'seconds': round(time.perf_counter() - start, 3)}
+    for object_cache in object_caches.values():
+        if object_cache is not None:
+            object_cache.save()
+    return summaries
+
+
+def run_manifest(options):
+    """Runs the zoning jobs of the manifest options.manifest, writes a csv summary of the jobs to options.output_file
+    and returns the exit status: 1 if any job failed. Each distinct policy file is read and its objects parsed once
+    for all the jobs using it, and the jobs are grouped by fib, identified by the contents of their rib and rib delta
+    files, so that each distinct fib is built or loaded once. With options.jobs the groups run in parallel"""
+    jobs = read_manifest(options.manifest, options)
+    summaries = [{'job': idx, 'rib': x.rib, 'input': x.input, 'output_file': x.output_file, 'status': 'error'}
+                 for idx, x in enumerate(jobs, start=1)]
+    gathered = {}
+    groups = {}
+    with metrics.stage('gather'):
+        for idx, job in enumerate(jobs, start=1):
+            try:
+                key = (file_digest(job.csv_separator, job.input), job.source and job.source_column,
+                       job.destination_column, job.address_separator)
+                if key not in gathered:
+                    parser = ObjectParser()
+                    try:
+                        gathered[key] = (len(gathered),) + gather_policy_file(job, parser) + (parser,)
+                    except PolicyError as e:
+                        gathered[key] = e
+                if isinstance(gathered[key], PolicyError):
+                    raise gathered[key]
+                fib_key = fib_cache_key(job.rib, job.csv_separator, job.rib_delta)
+            except (PolicyError, OSError) as e:
+                logging.error('Job %d failed: %s', idx, e)
+                summaries[idx - 1]['error'] = str(e)
+                continue
+            summaries[idx - 1]['fib'] = fib_key[:12]
+            groups.setdefault(fib_key, []).append((idx, job) + gathered[key])
+    logging.warning('Running %d jobs on %d distinct policy files and %d distinct fibs', len(jobs), len(gathered),
+                    len(groups))
+    metrics.count('manifest_jobs', len(jobs))
+    metrics.count('distinct_policy_files', len(gathered))
+    metrics.count('distinct_fibs', len(groups))
+    workers = min(options.jobs or os.cpu_count() or 1, len(groups))
+    with metrics.stage('output'):
+        if workers > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_job_worker,
+                                                        initargs=(logging.getLogger().level, None, {})) as pool:
+                results = list(pool.map(_run_manifest_group, groups.values()))
+        else:
+            results = [_run_manifest_group(x) for x in groups.values()]
+    for result in results:
+        for idx, summary in result.items():
+            summaries[idx - 1].update(summary)
+    failed = [x['job'] for x in summaries if x['status'] != 'ok']
+    if failed:
+        logging.error('%d of %d jobs failed: %s', len(failed), len(jobs), ', '.join(str(x) for x in failed))
+    with open(options.output_file, 'w', newline='', encoding='utf-8') as o:
+        writer = csv.DictWriter(o, MANIFEST_SUMMARY_FIELDS)
+        writer.writeheader()
+        writer.writerows(summaries)
+    return 1 if failed else 0
+
+
+def run_impact(options):
+    """Writes the policies of options.input whose zones change when the rib options.rib, updated with the rib delta
+    file if any, is replaced by the rib options.impact. The fib of the new rib is not built from scratch: the routes
+    which differ between the two ribs are flattened again and spliced into the fib of the old rib, which can come
+    from the fib cache, and only the objects overlapping them or inheriting their zones are resolved again"""
+    old = Autozoner.from_options(options)
+    old_rib_dict_list = parse_rib(options.rib, options.csv_separator)
+    if options.rib_delta:
+        apply_rib_delta(old_rib_dict_list, options.rib_delta, options.csv_separator)
+    new_rib_dict_list = parse_rib(options.impact, options.csv_separator)
+    with metrics.stage('rib_delta'):
+        new_fib, intervals = patch_linearized_fib(old.fib, new_rib_dict_list,
+                                                  rib_changes(old_rib_dict_list, new_rib_dict_list))
+    if options.host_table:
+        attach_host_table(new_fib, options.cache_dir if options.pickled_fib else None, options.cache_max_entries,
+                          options.cache_max_mb * 2 ** 20)
+    new_object_cache = None
+    if options.object_cache:
+        new_object_cache = ObjectCache.for_fib(options.cache_dir, new_fib, options.null_route,
+                                               options.cache_max_entries, options.cache_max_mb * 2 ** 20)
+    new = Autozoner(new_fib, options.null_route, options.batch_resolve, options.jobs, new_object_cache)
+    # Objects must not be resolved before write_impact_file picks which ones, as they inherit the zones of the
+    # objects covering them which are resolved along with them
+    old = Autozoner(old.fib, options.null_route, options.batch_resolve, options.jobs, old.object_cache)
+    with metrics.stage('output'):
+        write_impact_file(old, new, intervals, options)
+    old.save_object_cache()
+    new.save_object_cache()
+
+
+def run_query(options):
+    """Writes the policies of options.input matching all of the queries in options.query, objects matched as set by
+    options.query_match, and options.query_zone, zones, with the zones of their address columns, and returns their
+    number. The policies are looked up in the PolicyIndex from cached_policy_index"""
+    index = cached_policy_index(options)
+    with metrics.stage('query'):
+        lines = None
+        for query in options.query:
+            found = index.object_lines(query, options.query_match)
+            lines = set(found) if lines is None else lines.intersection(found)
+        for zone in options.query_zone:
+            found = index.zone_lines(zone)
+            lines = set(found) if lines is None else lines.intersection(found)
+        lines = sorted(lines)
+    logging.warning('Found %d of %d policies matching the queries', len(lines), len(index.offsets))
+    logging.info('Writing csv to file %s', options.output_file)
+    tmp_output = f'{options.output_file}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_output, 'w', newline='', encoding='utf-8') as o:
+            writer = csv.writer(o, delimiter=options.csv_separator)
+            writer.writerow(index.header)
+            writer.writerows(index.rows(options.input, lines, options.csv_separator, options.address_separator))
+    except BaseException:
+        if os.path.exists(tmp_output):
+            os.remove(tmp_output)
+        raise
+    os.replace(tmp_output, options.output_file)
+    return len(lines)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Takes a csv file containing firewall policies, a routing table, and '
                                                  'adds the correct source/destination interface or zone for each '
@@ -222,8 +3065,10 @@ if __name__ == '__main__':
                                                  '192.0.2.1, 192.0.2.0/24, 192.0.2.100/24, 192.0.2.1-192.0.2.100, '
                                                  '2001:db8::1, 2001:db8::/64, 2001:db8::a/64, '
                                                  '2001:db8::1-2001:db8::100')
-    parser.add_argument('input', type=str, help='Input csv containing the firewall policies')
-    parser.add_argument('rib', type=str, help='Input csv containing the routes: "192.0.2.0/24","IFACE_OR_ZONE"')
+    parser.add_argument('input', type=str, nargs='?',
+                        help='Input csv containing the firewall policies, omitted with --serve and --manifest')
+    parser.add_argument('rib', type=str, nargs='?',
+                        help='Input csv containing the routes: "192.0.2.0/24","IFACE_OR_ZONE", omitted with --manifest')
     parser.add_argument('-o', '--output-file', type=str, default='zoned.csv',
                         help='The name of the output file containing the policy list. Default: zoned.csv')
     parser.add_argument('-s', '--source', action='store_true', default=False, help='Analyze the source address column. '
@@ -253,304 +3098,140 @@ if __name__ == '__main__':
                              'destination')
     parser.add_argument('-c', '--csv-separator', type=str, default=',', help='CSV separator. Default: ","')
     parser.add_argument('-r', '--address-separator', type=str, default=';', help='CSV separator. Default: ";"')
-    parser.add_argument('-p', '--pickled-fib', action='store_true', default=False, help='Read the fib from disk '
-                                                                                   f'(./{FIB_DISK_CACHE}) that was '
-                                                                                   'saved from a previous run using '
-                                                                                   'this option, without recalculating '
-                                                                                   'it from the csv rib file. Default: '
-                                                                                   'False')
+    parser.add_argument('-p', '--pickled-fib', action='store_true', default=False,
+                        help='Read the fib from the cache directory if it was saved there by a previous run with this '
+                             'option and the same rib file contents, instead of recalculating it from the csv rib '
+                             'file. Default: False')
+    parser.add_argument('--cache-dir', type=str, default=FIB_CACHE_DIR,
+                        help=f'Directory holding the fibs cached by -p and the objects cached by --object-cache. '
+                             f'Default: {FIB_CACHE_DIR}')
+    parser.add_argument('--cache-max-entries', type=int, default=FIB_CACHE_MAX_ENTRIES,
+                        help='Maximum number of fibs kept in the cache directory, least recently used are removed '
+                             f'first. 0 for no limit. Default: {FIB_CACHE_MAX_ENTRIES}')
+    parser.add_argument('--cache-max-mb', type=int, default=0,
+                        help='Maximum total size in MiB of the fibs kept in the cache directory. Default: no limit')
+    parser.add_argument('--object-cache', action='store_true', default=False,
+                        help='Keep the objects resolved against each fib in the cache directory, so that later runs '
+                             'against the same fib with the same -n setting only parse and look up new objects. The '
+                             'cache limits apply to these files as well. Default: False')
+    parser.add_argument('--host-table', action='store_true', default=False,
+                        help='Look the IPv4 objects within a /24, such as hosts, up in a DIR-24-8 style table of the '
+                             'fib instead of binary searching it. The table takes 64 MiB plus 1 KiB for each /24 '
+                             'split between routes, and is cached along with the fib by -p. It is not used by '
+                             '--batch-resolve or by the processes of -j. Default: False')
+    parser.add_argument('-d', '--rib-delta', type=str, default=None,
+                        help='Csv file of route changes to apply on top of the rib: "add|withdraw|replace",'
+                             '"192.0.2.0/24","IFACE_OR_ZONE". Only the address ranges of the changed prefixes are '
+                             'flattened again, so with -p a fib cached for the rib is updated in seconds. '
+                             'Default: None')
+    parser.add_argument('--reduce-rib', action='store_true', default=False,
+                        help='Before flattening the routes, merge sibling routes with the same zones into their parent '
+                             'and drop the routes with the same zones as the route covering them. The fib is the '
+                             'same, and is built faster from ribs where many routes share a few zones. Default: False')
+    parser.add_argument('--fib-memory-mb', type=int, default=0,
+                        help='Build the fib out of core for ribs larger than the memory: the routes are sorted in '
+                             'runs of at most this many MiB written to temporary files, in the cache directory with '
+                             '-p, then merged, flattened and written straight to a memory mapped fib file, so the '
+                             'memory used does not grow with the number of routes. The fib is the same. Uses the '
+                             'sweep engine in a single process, and a rib delta file given with -d is still read in '
+                             'memory. Default: 0, in memory')
+    parser.add_argument('-e', '--fib-engine', type=str, choices=FIB_ENGINES, default='sweep',
+                        help='Algorithm used to flatten the routes: "sweep" in a single pass over the sorted routes, '
+                             '"split" by fragmenting covering routes level by level as in older versions, "compare" '
+                             'runs both and exits if the resulting fibs differ. Default: sweep')
+    parser.add_argument('--fib-workers', type=int, default=1,
+                        help='Number of processes flattening partitions of the address space in parallel with the '
+                             'sweep engine, 0 for one per CPU. Default: 1')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of processes resolving the objects and zoning the policies in parallel, 0 for one '
+                             'per CPU. The output is identical to a single process run. Default: 1')
+    parser.add_argument('--batch-resolve', action='store_true', default=False,
+                        help='Resolve all the objects together, vectorized with NumPy when it is installed, instead of '
+                             'one at a time. Default: False')
+    parser.add_argument('--serve', type=str, default=None, metavar='ADDRESS',
+                        help='Keep the fib of the rib loaded and answer zone lookups as JSON over HTTP, on ADDRESS if '
+                             'it is HOST:PORT or on the Unix socket at path ADDRESS otherwise, reloading the fib when '
+                             'the rib changes. The other options are the defaults of the zone-rows requests. Default: '
+                             'None')
+    parser.add_argument('--manifest', type=str, default=None,
+                        help='Run the zoning jobs listed in this JSON file instead, each a dictionary setting "rib", '
+                             '"input", "output_file" and optionally other options of the job, the command line setting '
+                             'the rest. Each distinct policy file is read and each distinct fib built once, -j sets '
+                             'the number of fibs processed in parallel and the output file is the csv summary of the '
+                             'jobs. Default: None')
+    parser.add_argument('--impact', type=str, default=None, metavar='NEW_RIB',
+                        help='Write only the policies whose zones change when the rib is replaced by NEW_RIB, with an '
+                             'IMPACT column marking their output rows with the old and the new zones. Only the '
+                             'routes which differ are flattened again, and only the objects they overlap resolved '
+                             'again. Default: None')
+    parser.add_argument('--query', type=str, action='append', default=[], metavar='OBJECT',
+                        help='Write only the policies with an object overlapping OBJECT, a host, net or range as in '
+                             'the policies, in the destination column or in the source column with -s, with all the '
+                             'zones of their address columns. The policies are looked up in an index of the policy '
+                             'file kept in the cache directory, built the first time, so later queries against the '
+                             'same policy and rib files do not zone the policies again. Given more than once, or '
+                             'along with --query-zone, the policies must match all the queries. Default: None')
+    parser.add_argument('--query-zone', type=str, action='append', default=[], metavar='ZONE',
+                        help='Write only the policies with ZONE among the zones of the destination column, or of the '
+                             'source column with -s, looked up as --query does. Default: None')
+    parser.add_argument('--query-match', type=str, choices=QUERY_MATCHES, default='overlap',
+                        help='Policy objects matching the address range of --query: those sharing any address with '
+                             'it, those covering all of it, or those within it. Default: overlap')
+    parser.add_argument('--metrics-file', '--profile', type=str, default=None,
+                        help='Write the wall time, CPU time and peak memory of each stage of the run, and counters of '
+                             'the routes, lookups and policies processed, to this JSON file. Default: None')
     parser.add_argument('-x', '--debug-level', type=str, choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
                         default='WARNING', help='Logging message verbosity. Default: WARNING')
     args = parser.parse_args()
-    logging.basicConfig(level=args.debug_level, format='%(asctime)s [%(levelname)s] %(message)s')
+    logging.basicConfig(level=args.debug_level, format=LOG_FORMAT)
     logging.debug('Starting with args %s', args)
-    if args.pickled_fib:
+    if args.serve:
+        if args.rib is None:
+            args.rib = args.input
+        serve(args)
+        if args.metrics_file:
+            metrics.to_file(args.metrics_file)
+        sys.exit(0)
+    if args.manifest:
+        status = run_manifest(args)
+        if args.metrics_file:
+            metrics.to_file(args.metrics_file)
+        sys.exit(status)
+    if args.rib is None:
+        parser.error('the following arguments are required: ' + ', '.join(x for x in ('input', 'rib')
+                                                                           if getattr(args, x) is None))
+    if args.query or args.query_zone:
         try:
-            logging.warning('Trying to get fib from file %s', FIB_DISK_CACHE)
-            with open(FIB_DISK_CACHE, 'rb') as f:
-                fib_table = pickle.load(f)
-        except FileNotFoundError:
-            logging.warning('Fib cache not present on disk, creating it for next time...')
-            fib_table = populate_linearized_fib(args.rib, args.csv_separator)
-            logging.warning('Dumping fib to disk')
-            with open(FIB_DISK_CACHE, 'wb') as f:
-                pickle.dump(fib_table, f)
-    else:
-        fib_table = populate_linearized_fib(args.rib, args.csv_separator)
-    total_zones = {}
-    for ver in IP_VERSIONS:
-        total_zones[ver] = [x for y in fib_table[ver] for x in y[1]]
-        total_zones[ver] = list(set(total_zones[ver]))
-        if not args.null_route and '####NULL_ROUTED####' in total_zones[ver]:
-            total_zones[ver].remove('####NULL_ROUTED####')
-    output_list = []
-    logging.info('Opening file %s', args.input)
-    with open(args.input, 'r', encoding='utf-8') as f:
-        parsed = list(csv.reader(f, delimiter=args.csv_separator))
-        logging.debug('%s', parsed)
-    if '####NULL_ROUTED####' in str(parsed):
-        logging.critical('Found protected string "####NULL_ROUTED####" in policy file. This zone is used internally '
-                         'and cannot be present. Exiting...')
-        sys.exit(1)
-    if args.source:
-        try:
-            logging.info('Looking for source column %s', args.source_column)
-            SRC_INDEX = parsed[0].index(args.source_column)
-            logging.info('Found source column')
-            try:
-                parsed[0].index(f'{args.source_column}_ZONE')
-                logging.critical('Output column %s_ZONE is already present in the file. Exiting...',
-                                 args.source_column)
-                sys.exit(1)
-            except ValueError:
-                pass
-        except ValueError:
-            logging.critical('Source column %s not present in the file. Exiting...', args.source_column)
+            run_query(args)
+        except PolicyError as e:
+            logging.critical('%s. Exiting...', e)
             sys.exit(1)
-    else:
-        logging.info('Source address will not be analyzed')
-        SRC_INDEX = False
-    try:
-        logging.info('Looking for destination column %s', args.destination_column)
-        DEST_INDEX = parsed[0].index(args.destination_column)
-        logging.info('Found destination column')
+        if args.metrics_file:
+            metrics.to_file(args.metrics_file)
+        sys.exit(0)
+    if args.impact:
         try:
-            parsed[0].index(f'{args.destination_column}_ZONE')
-            logging.critical('Output column %s_ZONE is already present in the file. Exiting...',
-                             args.destination_column)
+            run_impact(args)
+        except PolicyError as e:
+            logging.critical('%s. Exiting...', e)
             sys.exit(1)
-        except ValueError:
-            pass
-    except ValueError:
-        logging.critical('Destination column %s not present in the file. Exiting...', args.destination_column)
-        sys.exit(1)
-    HEADER = parsed[0]
-    if SRC_INDEX:
-        HEADER.insert(SRC_INDEX, f'{args.source_column}_ZONE')
-    HEADER.insert(DEST_INDEX, f'{args.destination_column}_ZONE')
-    if args.split_behavior:
-        HEADER.append('SPLIT')
-    output_list.append(HEADER)
-    objects_list = []
-    logging.info('Gathering all sources and destinations')
-    for idx, row in enumerate(parsed[1:], start=1):
-        if SRC_INDEX:
-            for member in row[SRC_INDEX].split(args.address_separator):
-                logging.debug('Found %s in rulebase at line %d', member, idx)
-                if not member or not IP_SANITY_REGEX.match(member):
-                    logging.critical('ERROR: Found corrupt or empty object "%s" at line %d and source column %d: %s',
-                                     member, idx, SRC_INDEX, row)
-                    sys.exit(1)
-                objects_list.append(member)
-        for member in row[DEST_INDEX].split(args.address_separator):
-            logging.debug('Found %s in rulebase at line %d', member, idx)
-            if not member or not IP_SANITY_REGEX.match(member):
-                    logging.critical('ERROR: Found corrupt or empty object "%s" at line %d and destination column %d: '
-                                     '%s', member, idx, DEST_INDEX, row)
-                    sys.exit(1)
-            objects_list.append(member)
-        if idx % 1000 == 0:
-            logging.warning('Searched %d of %d policies for objects', idx, len(parsed[1:]))
-    objects_list = list(set(objects_list))
-    exploded_list = {ver: [] for ver in IP_VERSIONS}
-    range_list = {ver: [] for ver in IP_VERSIONS}
-    for objec in objects_list:
-        range_check = objec.split('-')
-        if len(range_check) == 2:
-            logging.debug('Detected IP range %s, converting to tuple', range_check)
-            range_start = ipaddress.ip_address(range_check[0])
-            range_end = ipaddress.ip_address(range_check[1])
-            range_list[range_start.version].append((range_start, range_end))
-        else:
-            logging.debug('Converting string %s to network object', objec)
-            objec_obj = ipaddress.ip_network(objec, strict=False)
-            exploded_list[objec_obj.version].append(objec_obj)
-    # Deduplicate
-    exploded_list = {ver: list(set(l)) for ver, l in exploded_list.items()}
-    range_list = {ver: list(set(l)) for ver, l in range_list.items()}
-    # Order by increasing prefix length and increasing range size while keeping ranges separate
-    for ver in IP_VERSIONS:
-        exploded_list[ver].sort(key=lambda x: x.prefixlen)
-        range_list[ver].sort(key=lambda x: int(x[1]) - int(x[0]), reverse=True)
-    logging.info('Resolving all objects found in policies')
-    express_cache = {}
-    for ver in IP_VERSIONS:
-        done = set()
-        if exploded_list[ver]:
-            cur_plen = exploded_list[ver][0].prefixlen
-        for idx, obj in enumerate(exploded_list[ver], start=1):
-            if idx % 100 == 0:
-                logging.warning('Resolved %d of %d IPv%d objects', idx, len(exploded_list[ver]), ver)
-            if obj.prefixlen != cur_plen:
-                # Done with previous plength. Search all objects of that plength for single-zone objects
-                # If larger subnet resolves to 1 zone only, it is also valid for all smaller subnets contained in it
-                for ob in exploded_list[ver]:
-                    if ob.prefixlen == cur_plen and len(express_cache[ob]) == 1:
-                        # Check for networks we can skip
-                        ob_prefixlen = ob.prefixlen
-                        ob_network_address = ob.network_address
-                        ob_broadcast_address = ob.broadcast_address
-                        for o in exploded_list[ver]:
-                            if o not in done and o.prefixlen > ob_prefixlen and o.overlaps(ob):
-                                logging.info('Object %s is guaranteed to resolve to the same zones as %s which covers '
-                                             'it, will skip analysis', o, ob)
-                                express_cache[o] = express_cache[ob]
-                                done.add(o)
-                        # Check ranges while we're at it
-                        for r in range_list[ver]:
-                            if r not in done and r[0] >= ob_network_address and r[1] <= ob_broadcast_address:
-                                logging.info('Range object %s is guaranteed to resolve to the same zones as %s which '
-                                             'covers it, will skip analysis', r, ob)
-                                express_cache[r] = express_cache[ob]
-                                done.add(r)
-            cur_plen = obj.prefixlen
-            if obj in done:
-                logging.info('Zones for object %s inherited from covering object already analyzed, skipping', obj)
-                continue
-            express_cache[obj] = zone_finder(obj, fib_table, total_zones, args.null_route)
-            done.add(obj)
-        logging.info('Resolving ranges...')
-        for idx, rng in enumerate(range_list[ver], start=1):
-            if idx % 100 == 0:
-                logging.warning('Resolved %d of %d range objects', idx, len(range_list[ver]))
-            if rng in done:
-                logging.info('Zones for range object %s inherited from covering object already analyzed, skipping', rng)
-                continue
-            express_cache[rng] = zone_finder(rng, fib_table, total_zones, args.null_route)
-            done.add(rng)
-            # If single zone range, check if results can apply to covered ranges
-            if len(express_cache[rng]) == 1:
-                for r in range_list[ver]:
-                    if r not in done and r[0] >= rng[0] and r[1] <= rng[1]:
-                        logging.info('Range object %s is guaranteed to resolve to the same zones as %s which covers it,'
-                                     ' will skip analysis', r, rng)
-                        express_cache[r] = express_cache[rng]
-                        done.add(r)
-    logging.info('Finished resolving objects')
-    logging.info('Building the final lookup table')
-    final_cache = {}
-    for net_or_range in objects_list:
-        logging.debug('Checking string %s in the partial cache', net_or_range)
-        range_check = net_or_range.split('-')
-        if len(range_check) == 2:
-            final_cache[net_or_range] = express_cache[(ipaddress.ip_address(range_check[0]),
-                                                       ipaddress.ip_address(range_check[1]))]
-        else:
-            final_cache[net_or_range] = express_cache[ipaddress.ip_network(net_or_range, strict=False)]
-    total_zones_all_proto = set([x for xs in total_zones for x in total_zones[xs]])
+        if args.metrics_file:
+            metrics.to_file(args.metrics_file)
+        sys.exit(0)
+    autozoner = Autozoner.from_options(args)
     try:
-        total_zones_all_proto.remove('####NULL_ROUTED####')
-    except KeyError:
-        pass
-    for idx, row in enumerate(parsed[1:], start=1):
-        logging.debug('Checking policy %s', row)
-        if SRC_INDEX:
-            src_zones = []
-            for member in row[SRC_INDEX].split(args.address_separator):
-                logging.debug('Checking source address %s in policy', member)
-                src_zones += final_cache[member]
-        dest_zones = []
-        for member in row[DEST_INDEX].split(args.address_separator):
-            logging.debug('Checking destination address %s in policy', member)
-            dest_zones += final_cache[member]
-        logging.debug('Deduping and sorting zone list alphabetically')
-        if SRC_INDEX:
-            src_zones = list(set(src_zones))
-            # Sort the zones alphabetically when the policy has multiple zones
-            src_zones.sort()
-            any_check = set(src_zones)
-            try:
-                any_check.remove('####NULL_ROUTED####')
-            except KeyError:
-                pass
-            if args.all_zones and any_check == total_zones_all_proto:
-                logging.warning('Policy %s source contains all the zones, replacing with "any" due to -a flag', row)
-                row.insert(SRC_INDEX, [['any']])
-            elif args.zone_limit and len([s for s in src_zones if s != '####NULL_ROUTED####']) > args.zone_limit:
-                if args.split_behavior:
-                    logging.warning('Splitting policy %s due to -z and -b flag', row)
-                    chunks = []
-                    chunk = []
-                    for idx, zone in enumerate(src_zones, start=0):
-                        if idx != 0 and idx % args.zone_limit == 0:
-                            chunks.append(chunk)
-                            chunk = []
-                        chunk.append(zone)
-                    # Add the last little chunk if len < zone_limit
-                    if chunk:
-                        chunks.append(chunk)
-                    row.insert(SRC_INDEX, chunks)
-                else:
-                    logging.warning('Number of source zones %d for policy %s exceeds the configured maximum of %d, '
-                                    'replacing with "any"', len(src_zones), row, args.zone_limit)
-                    row.insert(SRC_INDEX, [['any']])
-            else:
-                if not src_zones:
-                    logging.warning('No source zones found for policy %s, probably missing routes', row)
-                row.insert(SRC_INDEX, [src_zones])
-        dest_zones = list(set(dest_zones))
-        dest_zones.sort()
-        any_check = set(dest_zones)
-        try:
-            any_check.remove('####NULL_ROUTED####')
-        except KeyError:
-            pass
-        if args.all_zones and any_check == total_zones_all_proto:
-            logging.warning('Policy %s destination contains all the zones, replacing with "any" due to -a flag', row)
-            row.insert(DEST_INDEX, [['any']])
-        elif args.zone_limit and len([s for s in dest_zones if s != '####NULL_ROUTED####']) > args.zone_limit:
-            if args.split_behavior:
-                logging.warning('Splitting policy %s due to -z and -b flag', row)
-                chunks = []
-                chunk = []
-                for idx, zone in enumerate(dest_zones, start=0):
-                    if idx != 0 and idx % args.zone_limit == 0:
-                        chunks.append(chunk)
-                        chunk = []
-                    chunk.append(zone)
-                # Add the last little chunk if len < zone_limit
-                if chunk:
-                    chunks.append(chunk)
-                row.insert(DEST_INDEX, chunks)
-            else:
-                logging.warning('Number of destination zones %d for policy %s exceeds the configured maximum of %d, '
-                                'replacing with "any"', len(dest_zones), row, args.zone_limit)
-                row.insert(DEST_INDEX, [['any']])
-        else:
-            if not dest_zones:
-                logging.error('No destination zones found for policy %s, probably missing routes', row)
-            row.insert(DEST_INDEX, [dest_zones])
-        if SRC_INDEX:
-            logging.debug('Source zones for policy %s:', row)
-            logging.debug('%s', src_zones)
-        logging.debug('Destination zones for policy %s:', row)
-        logging.debug('%s', dest_zones)
-        logging.debug('The final policy looks like:')
-        logging.debug('%s', row)
-        final_row = row.copy()
-        if SRC_INDEX:
-            if args.split_behavior:
-                if len(row[SRC_INDEX]) > 1 or len(row[DEST_INDEX]) > 1:
-                    final_row.append('true')
-                else:
-                    final_row.append('false')
-            for src_item in row[SRC_INDEX]:
-                final_row[SRC_INDEX] = args.address_separator.join(src_item)
-                for dest_item in row[DEST_INDEX]:
-                    final_row[DEST_INDEX] = args.address_separator.join(dest_item)
-                    output_list.append(final_row.copy())
-        else:
-            if args.split_behavior:
-                if len(row[DEST_INDEX]) > 1:
-                    final_row.append('true')
-                else:
-                    final_row.append('false')
-            for dest_item in row[DEST_INDEX]:
-                final_row[DEST_INDEX] = args.address_separator.join(dest_item)
-                output_list.append(final_row.copy())
-        if idx % 1000 == 0:
-            logging.warning('Done checking %d of %d policies', idx, len(parsed[1:]))
-    logging.info('Writing csv to file %s', args.output_file)
-    with open(args.output_file, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f, delimiter=args.csv_separator)
-        writer.writerows(output_list)
+        with metrics.stage('gather'):
+            objects, policy_count = gather_policy_file(args, autozoner.parser)
+        logging.info('Found %d objects in %d policies', len(objects), policy_count)
+        metrics.count('objects', len(objects))
+        # Resolve the objects of all the policies together, rather than a chunk of policies at a time
+        with metrics.stage('resolve'):
+            autozoner.resolve_all(objects)
+        with metrics.stage('output'):
+            write_zoned_file(autozoner, args)
+        autozoner.save_object_cache()
+    except PolicyError as e:
+        logging.critical('%s. Exiting...', e)
+        sys.exit(1)
+    if args.metrics_file:
+        metrics.to_file(args.metrics_file)
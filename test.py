@@ -1,7 +1,18 @@
 """Check that the output of the script is identical to zoned-example.csv which has been hand-checked"""
 import subprocess
 import filecmp
+import glob
+import gzip
+import shutil
 import sys
+import csv
+import json
+import logging
+import os
+import time
+import urllib.error
+import urllib.request
+from firewall_autozoner import Autozoner
 
 SCRIPT = 'firewall_autozoner.py'
 INPUT = 'policy-example.csv'
@@ -54,3 +65,413 @@ if filecmp.cmp(output, compare):
 else:
     print('Failed test 3')
     sys.exit(1)
+
+# Cross-check the sweep and split fib engines
+
+output = 'zoned-test-4.csv'
+compare = 'zoned-example-0.csv'
+subprocess.call(['python', SCRIPT, '-s', '-1', 'SRC_IP', '-2', 'DEST_IP', '-n', '-e', 'compare', '-x', 'CRITICAL', '-o',
+                 output, INPUT, INPUT_2])
+if filecmp.cmp(output, compare):
+    print('Passed test 4')
+else:
+    print('Failed test 4')
+    sys.exit(1)
+
+# Zone twice with the fib cache, the second run reading the fib from the cache
+
+output = 'zoned-test-5.csv'
+compare = 'zoned-example-0.csv'
+for _ in range(2):
+    subprocess.call(['python', SCRIPT, '-s', '-1', 'SRC_IP', '-2', 'DEST_IP', '-n', '-p', '--cache-dir',
+                     'zoned-test-cache', '-x', 'CRITICAL', '-o', output, INPUT, INPUT_2])
+if filecmp.cmp(output, compare):
+    print('Passed test 5')
+else:
+    print('Failed test 5')
+    sys.exit(1)
+
+# Apply a rib delta, equivalent to zoning against the updated rib
+
+output = 'zoned-test-6.csv'
+compare = 'zoned-example-4.csv'
+subprocess.call(['python', SCRIPT, '-s', '-1', 'SRC_IP', '-2', 'DEST_IP', '-n', '-d', 'rib-delta-example.csv', '-x',
+                 'CRITICAL', '-o', output, INPUT, INPUT_2])
+if filecmp.cmp(output, compare):
+    print('Passed test 6')
+else:
+    print('Failed test 6')
+    sys.exit(1)
+
+# Resolve all objects in one batch
+
+output = 'zoned-test-7.csv'
+compare = 'zoned-example-2.csv'
+subprocess.call(['python', SCRIPT, '-s', '-1', 'SRC_IP', '-2', 'DEST_IP', '-n', '-z', '7', '-b', '--batch-resolve',
+                 '-x', 'CRITICAL', '-o', output, INPUT, INPUT_2])
+if filecmp.cmp(output, compare):
+    print('Passed test 7')
+else:
+    print('Failed test 7')
+    sys.exit(1)
+
+# Flatten the routes with several worker processes
+
+output = 'zoned-test-8.csv'
+compare = 'zoned-example-0.csv'
+subprocess.call(['python', SCRIPT, '-s', '-1', 'SRC_IP', '-2', 'DEST_IP', '-n', '--fib-workers', '2', '-x', 'CRITICAL',
+                 '-o', output, INPUT, INPUT_2])
+if filecmp.cmp(output, compare):
+    print('Passed test 8')
+else:
+    print('Failed test 8')
+    sys.exit(1)
+
+# Resolve the objects and zone the policies with several worker processes, splitting policies
+
+output = 'zoned-test-9.csv'
+compare = 'zoned-example-2.csv'
+subprocess.call(['python', SCRIPT, '-s', '-1', 'SRC_IP', '-2', 'DEST_IP', '-n', '-z', '7', '-b', '-j', '2', '-x',
+                 'CRITICAL', '-o', output, INPUT, INPUT_2])
+if filecmp.cmp(output, compare):
+    print('Passed test 9')
+else:
+    print('Failed test 9')
+    sys.exit(1)
+
+# Zone the policies through the server, which rejects a single object string given instead of a list and keeps
+# serving the fib while the rib file is missing
+
+output = 'zoned-test-10.csv'
+compare = 'zoned-example-0.csv'
+shutil.copyfile(INPUT_2, 'zoned-test-rib-served.csv')
+server = subprocess.Popen(['python', SCRIPT, '-s', '-1', 'SRC_IP', '-2', 'DEST_IP', '-n', '-x', 'CRITICAL', '--serve',
+                           '127.0.0.1:8765', 'zoned-test-rib-served.csv'])
+with open(INPUT, 'r', encoding='utf-8') as f:
+    rows = list(csv.reader(f))
+request = urllib.request.Request('http://127.0.0.1:8765/zone-rows',
+                                 json.dumps({'header': rows[0], 'rows': rows[1:]}).encode('utf-8'))
+for _ in range(50):
+    try:
+        response = json.load(urllib.request.urlopen(request))
+        break
+    except OSError:
+        time.sleep(0.2)
+request = urllib.request.Request('http://127.0.0.1:8765/zones', json.dumps({'objects': '10.0.0.0/8'}).encode('utf-8'))
+try:
+    urllib.request.urlopen(request)
+    rejected = False
+except urllib.error.HTTPError as e:
+    rejected = e.code == 400
+os.remove('zoned-test-rib-served.csv')
+request = urllib.request.Request('http://127.0.0.1:8765/zones',
+                                 json.dumps({'objects': ['192.168.1.0/24']}).encode('utf-8'))
+try:
+    served = json.load(urllib.request.urlopen(request, timeout=10)) == {'zones': {'192.168.1.0/24': ['ZONE-BRANCHES']}}
+except OSError:
+    served = False
+server.terminate()
+server.wait()
+with open(output, 'w', newline='', encoding='utf-8') as f:
+    writer = csv.writer(f)
+    writer.writerow(response['header'])
+    writer.writerows(response['rows'])
+if filecmp.cmp(output, compare) and rejected and served:
+    print('Passed test 10')
+else:
+    print('Failed test 10')
+    sys.exit(1)
+
+# Zone the policies with the library, reusing the fib for other options
+
+output = 'zoned-test-11.csv'
+compare = 'zoned-example-0.csv'
+logging.basicConfig(level=logging.CRITICAL)
+autozoner = Autozoner.from_rib(INPUT_2, null_route=True)
+with open(INPUT, 'r', encoding='utf-8') as f, open(output, 'w', newline='', encoding='utf-8') as o:
+    csv.writer(o).writerows(autozoner.zone_rows(csv.reader(f), {'source': True, 'source_column': 'SRC_IP',
+                                                                'destination_column': 'DEST_IP'}))
+if filecmp.cmp(output, compare):
+    print('Passed test 11')
+else:
+    print('Failed test 11')
+    sys.exit(1)
+
+output = 'zoned-test-12.csv'
+compare = 'zoned-example-2.csv'
+with open(INPUT, 'r', encoding='utf-8') as f, open(output, 'w', newline='', encoding='utf-8') as o:
+    csv.writer(o).writerows(autozoner.zone_rows(csv.reader(f), {'source': True, 'source_column': 'SRC_IP',
+                                                                'destination_column': 'DEST_IP', 'zone_limit': 7,
+                                                                'split_behavior': True}))
+if filecmp.cmp(output, compare):
+    print('Passed test 12')
+else:
+    print('Failed test 12')
+    sys.exit(1)
+
+# Write the metrics of the run, counting the split policies
+
+output = 'zoned-test-13.csv'
+compare = 'zoned-example-2.csv'
+subprocess.call(['python', SCRIPT, '-s', '-1', 'SRC_IP', '-2', 'DEST_IP', '-n', '-z', '7', '-b', '--metrics-file',
+                 'zoned-test-metrics.json', '-x', 'CRITICAL', '-o', output, INPUT, INPUT_2])
+with open('zoned-test-metrics.json', 'r', encoding='utf-8') as f:
+    run_metrics = json.load(f)
+if (filecmp.cmp(output, compare) and run_metrics['counters']['policies_split'] == 7
+        and 'flatten' in run_metrics['stages']):
+    print('Passed test 13')
+else:
+    print('Failed test 13')
+    sys.exit(1)
+
+# Read a gzip compressed rib
+
+output = 'zoned-test-14.csv'
+compare = 'zoned-example-0.csv'
+with open(INPUT_2, 'rb') as f, gzip.open('zoned-test-rib.csv.gz', 'wb') as o:
+    shutil.copyfileobj(f, o)
+subprocess.call(['python', SCRIPT, '-s', '-1', 'SRC_IP', '-2', 'DEST_IP', '-n', '-x', 'CRITICAL', '-o', output, INPUT,
+                 'zoned-test-rib.csv.gz'])
+if filecmp.cmp(output, compare):
+    print('Passed test 14')
+else:
+    print('Failed test 14')
+    sys.exit(1)
+
+# Zone against several ribs and with several options in one run from a manifest
+
+jobs = [{'output_file': 'zoned-test-15-0.csv', 'null_route': True},
+        {'output_file': 'zoned-test-15-2.csv', 'null_route': True, 'zone_limit': 7, 'split_behavior': True},
+        {'output_file': 'zoned-test-15-3.csv', 'all_zones': True},
+        {'output_file': 'zoned-test-15-4.csv', 'null_route': True, 'rib_delta': 'rib-delta-example.csv'}]
+with open('zoned-test-manifest.json', 'w', encoding='utf-8') as f:
+    json.dump([dict(job, rib=INPUT_2, input=INPUT) for job in jobs], f)
+subprocess.call(['python', SCRIPT, '-s', '-1', 'SRC_IP', '-2', 'DEST_IP', '--manifest', 'zoned-test-manifest.json',
+                 '-x', 'CRITICAL', '-o', 'zoned-test-15.csv'])
+with open('zoned-test-15.csv', 'r', encoding='utf-8') as f:
+    summary = list(csv.DictReader(f))
+if (all(filecmp.cmp(f'zoned-test-15-{x}.csv', f'zoned-example-{x}.csv') for x in (0, 2, 3, 4))
+        and [x['status'] for x in summary] == ['ok'] * 4):
+    print('Passed test 15')
+else:
+    print('Failed test 15')
+    sys.exit(1)
+
+# List the policies whose zones change with the rib delta, comparing the rib with the rib after the delta
+
+output = 'zoned-test-16.csv'
+with open(INPUT_2, 'r', encoding='utf-8') as f:
+    routes = [x for x in f.read().splitlines() if not x.startswith(('172.16.0.0/16,', '192.168.1.0/24,', 'fe80::/64,'))]
+with open('zoned-test-rib-new.csv', 'w', encoding='utf-8') as f:
+    f.write('\n'.join(routes + ['100.64.0.0/10,ZONE-CGNAT', '192.168.1.0/24,ZONE-LAN', '2001:db8::/32,ZONE-CORE',
+                                '2001:db8::/32,ZONE-WAN', '0.0.0.0/0,ZONE-MPLS']) + '\n')
+subprocess.call(['python', SCRIPT, '-s', '-1', 'SRC_IP', '-2', 'DEST_IP', '-n', '--impact', 'zoned-test-rib-new.csv',
+                 '-x', 'CRITICAL', '-o', output, INPUT, INPUT_2])
+with open('zoned-example-0.csv', 'r', encoding='utf-8') as f, open('zoned-example-4.csv', 'r', encoding='utf-8') as g:
+    old_rows = list(csv.reader(f))
+    new_rows = list(csv.reader(g))
+expected = [old_rows[0] + ['IMPACT']]
+for old_row, new_row in zip(old_rows[1:], new_rows[1:]):
+    if old_row != new_row:
+        expected += [old_row + ['old'], new_row + ['new']]
+with open(output, 'r', encoding='utf-8') as f:
+    impact = list(csv.reader(f))
+if impact == expected and len(expected) > 1:
+    print('Passed test 16')
+else:
+    print('Failed test 16')
+    sys.exit(1)
+
+# Zone twice with the object cache, the second run reading the zones of every object from the cache
+
+output = 'zoned-test-17.csv'
+compare = 'zoned-example-0.csv'
+for _ in range(2):
+    subprocess.call(['python', SCRIPT, '-s', '-1', 'SRC_IP', '-2', 'DEST_IP', '-n', '--object-cache', '--cache-dir',
+                     'zoned-test-cache', '--metrics-file', 'zoned-test-metrics.json', '-x', 'CRITICAL', '-o', output,
+                     INPUT, INPUT_2])
+with open('zoned-test-metrics.json', 'r', encoding='utf-8') as f:
+    run_metrics = json.load(f)
+if (filecmp.cmp(output, compare) and run_metrics['counters']['object_cache_hits'] > 0
+        and run_metrics['counters']['object_cache_misses'] == 0):
+    print('Passed test 17')
+else:
+    print('Failed test 17')
+    sys.exit(1)
+
+# Zone twice with the host table, the second run loading it from the cache
+
+output = 'zoned-test-18.csv'
+compare = 'zoned-example-0.csv'
+passed = True
+for _ in range(2):
+    subprocess.call(['python', SCRIPT, '-s', '-1', 'SRC_IP', '-2', 'DEST_IP', '-n', '-p', '--host-table', '--cache-dir',
+                     'zoned-test-cache', '-x', 'CRITICAL', '-o', output, INPUT, INPUT_2])
+    passed = passed and filecmp.cmp(output, compare)
+if passed:
+    print('Passed test 18')
+else:
+    print('Failed test 18')
+    sys.exit(1)
+
+# Reduce the routes before flattening them with both engines, which must give the same fib
+
+output = 'zoned-test-19.csv'
+compare = 'zoned-example-0.csv'
+subprocess.call(['python', SCRIPT, '-s', '-1', 'SRC_IP', '-2', 'DEST_IP', '-n', '--reduce-rib', '-e', 'compare',
+                 '--metrics-file', 'zoned-test-metrics.json', '-x', 'CRITICAL', '-o', output, INPUT, INPUT_2])
+with open('zoned-test-metrics.json', 'r', encoding='utf-8') as f:
+    run_metrics = json.load(f)
+if filecmp.cmp(output, compare) and run_metrics['counters']['routes_reduced'] > 0:
+    print('Passed test 19')
+else:
+    print('Failed test 19')
+    sys.exit(1)
+
+# Query the policies with a zone twice, the second run reading the policy index from the cache
+
+output = 'zoned-test-20.csv'
+compare = 'zoned-example-0.csv'
+with open(compare, 'r', encoding='utf-8') as f:
+    zoned = list(csv.reader(f))
+expected = zoned[:1] + [x for x in zoned[1:] if 'ZONE-LAN' in x[1].split(';') + x[2].split(';')]
+passed = True
+for _ in range(2):
+    subprocess.call(['python', SCRIPT, '-s', '-1', 'SRC_IP', '-2', 'DEST_IP', '-n', '--query-zone', 'ZONE-LAN',
+                     '--cache-dir', 'zoned-test-cache', '-x', 'CRITICAL', '-o', output, INPUT, INPUT_2])
+    with open(output, 'r', encoding='utf-8') as f:
+        passed = passed and list(csv.reader(f)) == expected
+if passed and len(expected) > 1:
+    print('Passed test 20')
+else:
+    print('Failed test 20')
+    sys.exit(1)
+
+# Build the fib out of core with a tiny memory budget, then again into the cache and reload it
+
+output = 'zoned-test-21.csv'
+compare = 'zoned-example-0.csv'
+passed = True
+cache = 'zoned-test-cache/fib-memory'
+shutil.rmtree(cache, ignore_errors=True)
+for extra in ([], ['-p', '--cache-dir', cache], ['-p', '--cache-dir', cache]):
+    subprocess.call(['python', SCRIPT, '-s', '-1', 'SRC_IP', '-2', 'DEST_IP', '-n', '--fib-memory-mb', '1'] + extra
+                    + ['-x', 'CRITICAL', '-o', output, INPUT, INPUT_2])
+    passed = passed and filecmp.cmp(output, compare)
+if passed:
+    print('Passed test 21')
+else:
+    print('Failed test 21')
+    sys.exit(1)
+
+# Truncate the cached fib, which must be discarded and rebuilt instead of failing every later run
+
+output = 'zoned-test-22.csv'
+compare = 'zoned-example-0.csv'
+cache = 'zoned-test-cache/fib-truncated'
+shutil.rmtree(cache, ignore_errors=True)
+passed = True
+for truncate in (False, True, False):
+    for path in glob.glob(f'{cache}/*.fib') if truncate else []:
+        with open(path, 'r+b') as f:
+            f.truncate(20)
+    subprocess.call(['python', SCRIPT, '-s', '-1', 'SRC_IP', '-2', 'DEST_IP', '-n', '-p', '--cache-dir', cache, '-x',
+                     'CRITICAL', '-o', output, INPUT, INPUT_2])
+    passed = passed and filecmp.cmp(output, compare)
+if passed:
+    print('Passed test 22')
+else:
+    print('Failed test 22')
+    sys.exit(1)
+
+# Objects covered by an object partly without a route, which must not inherit its zone, with and without -n
+
+output = 'zoned-test-23.csv'
+passed = True
+for extra, compare in (([], 'zoned-example-5.csv'), (['--batch-resolve'], 'zoned-example-5.csv'),
+                       (['-n'], 'zoned-example-6.csv')):
+    subprocess.call(['python', SCRIPT, '-s', '-1', 'SRC_IP', '-2', 'DEST_IP'] + extra + ['-x', 'CRITICAL', '-o', output,
+                     'policy-noroute-example.csv', 'rib-noroute-example.csv'])
+    passed = passed and filecmp.cmp(output, compare)
+if passed:
+    print('Passed test 23')
+else:
+    print('Failed test 23')
+    sys.exit(1)
+
+# Flatten the routes in a single process and with several worker processes under different hash seeds. The fibs must
+# have the same digest, so every run shares the object cache file named after it
+
+output = 'zoned-test-24.csv'
+compare = 'zoned-example-0.csv'
+cache = 'zoned-test-cache/parallel-digest'
+shutil.rmtree(cache, ignore_errors=True)
+passed = True
+for workers, seed in (('1', '0'), ('2', '1'), ('2', '2'), ('2', '3')):
+    subprocess.call(['python', SCRIPT, '-s', '-1', 'SRC_IP', '-2', 'DEST_IP', '-n', '--fib-workers', workers,
+                     '--object-cache', '--cache-dir', cache, '-x', 'CRITICAL', '-o', output, INPUT, INPUT_2],
+                    env=dict(os.environ, PYTHONHASHSEED=seed))
+    passed = passed and filecmp.cmp(output, compare)
+if passed and len(glob.glob(f'{cache}/*.objects')) == 1:
+    print('Passed test 24')
+else:
+    print('Failed test 24')
+    sys.exit(1)
+
+# Read a rib whose header is numeric, as pandas writes for unnamed columns, which must not be taken for a route
+
+output = 'zoned-test-25.csv'
+compare = 'zoned-example-0.csv'
+with open(INPUT_2, 'r', encoding='utf-8') as f, open('zoned-test-rib-header.csv', 'w', encoding='utf-8') as g:
+    g.write('0,1\n' + f.read())
+subprocess.call(['python', SCRIPT, '-s', '-1', 'SRC_IP', '-2', 'DEST_IP', '-n', '-x', 'CRITICAL', '-o', output, INPUT,
+                 'zoned-test-rib-header.csv'])
+if filecmp.cmp(output, compare):
+    print('Passed test 25')
+else:
+    print('Failed test 25')
+    sys.exit(1)
+
+# Read a rib whose first row is a host route without a prefix length, which must be kept as a route
+
+output = 'zoned-test-26.csv'
+compare = 'zoned-example-7.csv'
+subprocess.call(['python', SCRIPT, '-s', '-1', 'SRC_IP', '-2', 'DEST_IP', '-x', 'CRITICAL', '-o', output,
+                 'policy-noroute-example.csv', 'rib-host-example.csv'])
+if filecmp.cmp(output, compare):
+    print('Passed test 26')
+else:
+    print('Failed test 26')
+    sys.exit(1)
+
+# Zone the same policy rows twice with the library, which must leave them and the resolved zones unchanged
+
+output = 'zoned-test-27.csv'
+compare = 'zoned-example-0.csv'
+with open(INPUT, 'r', encoding='utf-8') as f:
+    rows = list(csv.reader(f))
+before = [row.copy() for row in rows]
+options = {'source': True, 'source_column': 'SRC_IP', 'destination_column': 'DEST_IP'}
+first = list(autozoner.zone_rows(rows, options))
+autozoner.resolve('0.0.0.0/0').append('ZONE-CORRUPT')
+with open(output, 'w', newline='', encoding='utf-8') as o:
+    csv.writer(o).writerows(autozoner.zone_rows(rows, options))
+if rows == before and filecmp.cmp(output, compare) and first == list(autozoner.zone_rows(rows, options)):
+    print('Passed test 27')
+else:
+    print('Failed test 27')
+    sys.exit(1)
+
+# Build the fib out of core from a rib with a corrupt route, which must fail without leaving a partial cache file
+
+cache = 'zoned-test-cache/fib-failed'
+with open(INPUT_2, 'r', encoding='utf-8') as f, open('zoned-test-rib-corrupt.csv', 'w', encoding='utf-8') as g:
+    g.write(f.read() + '10.0.0.0/99,ZONE-CORRUPT\n')
+returncode = subprocess.call(['python', SCRIPT, '-s', '-1', 'SRC_IP', '-2', 'DEST_IP', '-n', '-p', '--cache-dir', cache,
+                              '--fib-memory-mb', '1', '-x', 'CRITICAL', '-o', 'zoned-test-28.csv', INPUT,
+                              'zoned-test-rib-corrupt.csv'], stderr=subprocess.DEVNULL)
+if returncode and not os.listdir(cache):
+    print('Passed test 28')
+else:
+    print('Failed test 28')
+    sys.exit(1)